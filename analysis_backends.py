@@ -0,0 +1,122 @@
+from typing import Callable, Dict, Tuple
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+# A backend clusters the valid LAB pixels of a car (N x 3) into at most k
+# clusters and returns (labels, centers_lab) with labels indexing centers_lab.
+AnalysisBackend = Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]]
+
+DEFAULT_BACKEND = 'kmeans'
+
+def assign_to_centers(
+    pixels: np.ndarray,
+    centers: np.ndarray,
+    chunk_size: int = 65536
+) -> np.ndarray:
+    """Assign every pixel to its nearest center (squared euclidean distance), in chunks."""
+    centers = centers.astype(np.float32)
+    centers_sq = np.einsum('ij,ij->i', centers, centers)
+    labels = np.empty(len(pixels), dtype=np.int64)
+
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size].astype(np.float32)
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 does not change the argmin
+        distances = centers_sq - 2.0 * (chunk @ centers.T)
+        labels[start:start + chunk_size] = np.argmin(distances, axis=1)
+
+    return labels
+
+def kmeans_backend(pixels_lab: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact path: full KMeans over every pixel."""
+    kmeans = KMeans(n_clusters=k, random_state=42)
+    labels = kmeans.fit_predict(pixels_lab)
+    return labels, kmeans.cluster_centers_
+
+def subsample_backend(
+    pixels_lab: np.ndarray,
+    k: int,
+    sample_size: int = 50000
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Fit KMeans on a fixed-seed random subsample, then assign all pixels to the centers."""
+    if len(pixels_lab) <= sample_size:
+        return kmeans_backend(pixels_lab, k)
+
+    rng = np.random.default_rng(42)
+    sample = pixels_lab[rng.choice(len(pixels_lab), sample_size, replace=False)]
+    kmeans = KMeans(n_clusters=k, random_state=42).fit(sample)
+    centers = kmeans.cluster_centers_
+    return assign_to_centers(pixels_lab, centers), centers
+
+def minibatch_backend(
+    pixels_lab: np.ndarray,
+    k: int,
+    batch_size: int = 4096
+) -> Tuple[np.ndarray, np.ndarray]:
+    """MiniBatchKMeans over all pixels."""
+    kmeans = MiniBatchKMeans(n_clusters=k, random_state=42, batch_size=batch_size, n_init=3)
+    labels = kmeans.fit_predict(pixels_lab)
+    return labels, kmeans.cluster_centers_
+
+def histogram_backend(
+    pixels_lab: np.ndarray,
+    k: int,
+    bits: int = 4
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantize LAB into a 3D histogram with 2**bits bins per channel and treat
+    the k most populated bins as clusters. Pixels of the remaining bins go to
+    the nearest kept bin; centers are the mean color of their pixels.
+    """
+    pixels = pixels_lab.astype(np.uint8)
+    shift = 8 - bits
+    bin_idx = (
+        (pixels[:, 0].astype(np.int32) >> shift) << (2 * bits)
+        | (pixels[:, 1].astype(np.int32) >> shift) << bits
+        | (pixels[:, 2].astype(np.int32) >> shift)
+    )
+    n_bins = 1 << (3 * bits)
+
+    counts = np.bincount(bin_idx, minlength=n_bins)
+    sums = np.stack([
+        np.bincount(bin_idx, weights=pixels[:, c], minlength=n_bins) for c in range(3)
+    ], axis=1)
+
+    occupied = np.flatnonzero(counts)
+    bin_means = sums[occupied] / counts[occupied, None]
+
+    # Keep the k most populated bins and map every occupied bin to its nearest kept bin
+    kept = np.argsort(counts[occupied])[::-1][:k]
+    bin_to_cluster = np.zeros(n_bins, dtype=np.int64)
+    bin_to_cluster[occupied] = assign_to_centers(bin_means, bin_means[kept])
+    bin_to_cluster[occupied[kept]] = np.arange(len(kept))
+
+    labels = bin_to_cluster[bin_idx]
+    cluster_counts = np.bincount(bin_to_cluster[occupied], weights=counts[occupied], minlength=len(kept))
+    cluster_sums = np.stack([
+        np.bincount(bin_to_cluster[occupied], weights=sums[occupied, c], minlength=len(kept)) for c in range(3)
+    ], axis=1)
+    centers = cluster_sums / cluster_counts[:, None]
+
+    return labels, centers
+
+ANALYSIS_BACKENDS: Dict[str, AnalysisBackend] = {
+    'kmeans': kmeans_backend,
+    'subsample': subsample_backend,
+    'minibatch': minibatch_backend,
+    'histogram': histogram_backend,
+}
+
+def get_backend(name: str) -> AnalysisBackend:
+    """Look up an analysis backend by name."""
+    try:
+        return ANALYSIS_BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown analysis backend '{name}'. Available: {', '.join(ANALYSIS_BACKENDS)}"
+        )
+
+def quantization_error(pixels_lab: np.ndarray, labels: np.ndarray, centers_lab: np.ndarray) -> float:
+    """Mean CIE76 delta E between each pixel and its cluster center (OpenCV 8-bit LAB input)."""
+    scale = np.array([100.0 / 255.0, 1.0, 1.0])
+    diff = (pixels_lab.astype(float) - centers_lab[labels]) * scale
+    return float(np.mean(np.linalg.norm(diff, axis=1)))
@@ -3,16 +3,15 @@ from streamlit_option_menu import option_menu
 from streamlit_extras.colored_header import colored_header
 from streamlit_extras.add_vertical_space import add_vertical_space
 from streamlit_card import card
-from PIL import Image
 from datetime import datetime
-<<<<<<< HEAD
 from car_recolor_service import CarRecolorService
-import io
+from car_parts import unpaintable_parts
+from output_encoding import QUALITY_PRESETS
+from history_store import HistoryStore
+import os
+import uuid
+import colorsys
 
-=======
-import json
-import time
->>>>>>> e5b6746e0edd00d1897de3f2e7892d5640775796
 # Configure page
 st.set_page_config(
     page_title="Car Color Studio",
@@ -20,12 +19,47 @@ st.set_page_config(
     layout="wide",
     initial_sidebar_state="expanded"
 )
-if 'recolor_service' not in st.session_state:
-    st.session_state.recolor_service = CarRecolorService(
+COLOR_PRESETS = {
+    "Midnight Black": "#000000",
+    "Arctic White": "#FFFFFF",
+    "Racing Red": "#FF0000",
+    "Ocean Blue": "#0000FF",
+    "Forest Green": "#008000",
+    "Sunset Orange": "#FFA500",
+    "Royal Purple": "#800080",
+}
+
+def hex_to_rgb(color: str) -> tuple:
+    """Convert a #RRGGBB color to an RGB tuple"""
+    color = color.lstrip('#')
+    return tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
+
+@st.cache_resource
+def get_recolor_service() -> CarRecolorService:
+    """
+    One service instance shared by all sessions; images are tracked by UUID.
+    The presets are pre-rendered as soon as an upload is analyzed.
+    """
+    return CarRecolorService(
         base_dir="images",
-        api_url="https://da6d-34-34-25-54.ngrok-free.app/"
+        api_url=os.environ.get("MASK_API_URL", "https://da6d-34-34-25-54.ngrok-free.app/"),
+        prerender_colors=[hex_to_rgb(color) for color in COLOR_PRESETS.values()]
     )
 
+@st.cache_resource
+def get_history_store() -> HistoryStore:
+    """Processing history index, persisted next to the images."""
+    return HistoryStore(base_dir="images")
+
+if 'recolor_service' not in st.session_state:
+    st.session_state.recolor_service = get_recolor_service()
+
+# The history store is shared by all sessions; each session sees its own entries
+if 'history_owner' not in st.session_state:
+    st.session_state.history_owner = uuid.uuid4().hex
+
+HISTORY_PAGE_SIZE = 5
+
 # Custom CSS for enhanced styling
 st.markdown("""
     <style>
@@ -59,24 +93,43 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-def save_history(original_image, recolored_image, color, settings):
-    """Save processing history to session state"""
-    if 'history' not in st.session_state:
-        st.session_state.history = []
-    
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    history_entry = {
-        "timestamp": timestamp,
-        "original_image": original_image,
-        "recolored_image": recolored_image,
-        "color": color,
-        "settings": settings,
-        "uuid": st.session_state.current_uuid  # Add the UUID to history
+def get_output_format():
+    """Output format of the quality chosen in Settings"""
+    return QUALITY_PRESETS[st.session_state.get('output_quality', 'High')]
+
+def save_history(recolored_image, color, settings):
+    """Record an encoded result in the processing history, saved to disk by the history store"""
+    image_uuid = st.session_state.current_uuid
+    get_history_store().add(
+        st.session_state.history_owner,
+        image_uuid,
+        color,
+        recolored_image,
+        original_thumbnail=st.session_state.recolor_service.get_thumbnail(image_uuid),
+        settings=settings,
+        max_items=st.session_state.get('max_history_items', 10)
+    )
+
+def generate_palette(base_color: str) -> dict:
+    """Harmonious variants of a base color: hue rotations and lighter/darker shades"""
+    r, g, b = (c / 255 for c in hex_to_rgb(base_color))
+    h, l, s = colorsys.rgb_to_hls(r, g, b)
+    variants = {
+        "Base": (h, l, s),
+        "Complementary": ((h + 1 / 2) % 1, l, s),
+        "Analogous +30°": ((h + 1 / 12) % 1, l, s),
+        "Analogous -30°": ((h - 1 / 12) % 1, l, s),
+        "Triadic +120°": ((h + 1 / 3) % 1, l, s),
+        "Triadic -120°": ((h - 1 / 3) % 1, l, s),
+        "Lighter": (h, min(1.0, l + 0.2), s),
+        "Darker": (h, max(0.0, l - 0.2), s),
+    }
+    return {
+        name: "#%02X%02X%02X" % tuple(round(c * 255) for c in colorsys.hls_to_rgb(*hls))
+        for name, hls in variants.items()
     }
-    st.session_state.history.append(history_entry)
 
 def main():
-    transformed_img = Image.open("D:/Car-inpainting/assets/car_recolored.png")
     if "transformed_image" not in st.session_state:
         st.session_state.transformed_image = False
     # Sidebar navigation
@@ -150,28 +203,29 @@ def main():
                 help="Drag and drop or click to upload"
             )
 
-<<<<<<< HEAD
         if uploaded_file is not None:
             # Check if this is a new file
             file_bytes = uploaded_file.getvalue()
             if 'current_image_hash' not in st.session_state or \
             st.session_state.current_image_hash != hash(file_bytes):
-                # New image uploaded
+                # New image uploaded; stop pre-rendering the previous one
+                st.session_state.recolor_service.cancel_prerender(st.session_state.get('current_uuid'))
                 st.session_state.current_image_hash = hash(file_bytes)
-                current_uuid = st.session_state.recolor_service.process_new_image(file_bytes,uploaded_file.name)
+                current_uuid = st.session_state.recolor_service.process_new_image(
+                    file_bytes, uploaded_file.name, output_format=get_output_format()
+                )
                 st.session_state.current_uuid = current_uuid
+                st.session_state.recolored_image = None
+                st.session_state.full_render = None
+                st.session_state.palette_previews = None
             st.image(uploaded_file, caption="Original Image", use_container_width=False)
 
             # Show processing status
-            status = st.session_state.recolor_service.get_processing_status()
-            if not status['analysis_complete']:
+            status = st.session_state.recolor_service.get_processing_status(st.session_state.current_uuid)
+            if status['state'] == 'failed':
+                st.error(f"Processing failed: {status['error']}")
+            elif not status['analysis_complete']:
                 st.info("Processing image... Please wait.")
-=======
-            if uploaded_file:
-                image = Image.open(uploaded_file)
-                st.image(image, caption="Original Image", use_container_width=True)
-
->>>>>>> e5b6746e0edd00d1897de3f2e7892d5640775796
             
 
         with col2:
@@ -184,20 +238,11 @@ def main():
             )
 
             if color_mode == "Preset Colors":
-                color_presets = {
-                    "Midnight Black": "#000000",
-                    "Arctic White": "#FFFFFF",
-                    "Racing Red": "#FF0000",
-                    "Ocean Blue": "#0000FF",
-                    "Forest Green": "#008000",
-                    "Sunset Orange": "#FFA500",
-                    "Royal Purple": "#800080",
-                }
                 selected_preset = st.selectbox(
                     "Choose a preset color",
-                    list(color_presets.keys())
+                    list(COLOR_PRESETS.keys())
                 )
-                selected_color = color_presets[selected_preset]
+                selected_color = COLOR_PRESETS[selected_preset]
 
             elif color_mode == "Custom Color":
                 selected_color = st.color_picker(
@@ -208,8 +253,67 @@ def main():
             else:  # Color Palette
                 st.markdown("Generate harmonious color combinations")
                 base_color = st.color_picker("Base Color", "#0000FF")
+                palette = generate_palette(base_color)
                 st.markdown("### Generated Palette")
-                # Here you could add code to generate color palettes
+                st.markdown(
+                    "".join(
+                        f'<span title="{name}" style="display:inline-block;width:2rem;height:2rem;'
+                        f'margin-right:0.25rem;border-radius:0.25rem;background:{color}"></span>'
+                        for name, color in palette.items()
+                    ),
+                    unsafe_allow_html=True
+                )
+                selected_variant = st.selectbox("Use variant", list(palette.keys()))
+                selected_color = palette[selected_variant]
+
+                # All variants are rendered from one analysis in a single pass
+                if st.button("Preview Palette", use_container_width=True):
+                    if uploaded_file:
+                        with st.spinner("Rendering palette..."):
+                            result = st.session_state.recolor_service.preview_palette(
+                                st.session_state.current_uuid,
+                                target_colors=[hex_to_rgb(color) for color in palette.values()],
+                                wait_timeout=90,
+                            )
+                        if result['success']:
+                            st.session_state.palette_previews = list(
+                                zip(palette.keys(), palette.values(), result['images'])
+                            )
+                        else:
+                            st.error(f"Error: {result['message']}")
+                    else:
+                        st.warning("Please upload an image first")
+
+                if uploaded_file is not None and st.session_state.get('palette_previews'):
+                    grid = st.columns(2)
+                    for index, (name, color, image) in enumerate(st.session_state.palette_previews):
+                        with grid[index % 2]:
+                            st.image(image, caption=f"{name} ({color})")
+
+            # Parts to leave unpainted, rebuilt locally from the cached part map
+            if uploaded_file is not None and status['analysis_complete'] and status['state'] != 'failed':
+                with st.expander("Painted Parts", expanded=False):
+                    parts = st.session_state.recolor_service.get_parts(st.session_state.current_uuid)
+                    if parts['success'] and parts['parts']:
+                        unpainted = st.multiselect(
+                            "Leave these parts unpainted",
+                            parts['parts'],
+                            default=[part for part in parts['parts'] if part in unpaintable_parts]
+                        )
+                        if st.button("Apply Parts", use_container_width=True):
+                            with st.spinner("Updating mask..."):
+                                result = st.session_state.recolor_service.select_parts(
+                                    st.session_state.current_uuid, unpainted, wait_timeout=90
+                                )
+                            if result['success']:
+                                st.session_state.recolored_image = None
+                                st.session_state.full_render = None
+                                st.session_state.palette_previews = None
+                                st.success("Painted parts updated")
+                            else:
+                                st.error(f"Error: {result['message']}")
+                    else:
+                        st.caption("No individual parts were detected for this image.")
 
             # # Advanced Settings in an organized expander
             # with st.expander("Advanced Settings", expanded=False):
@@ -242,46 +346,32 @@ def main():
             #         )
 
             # Process button
-<<<<<<< HEAD
         if st.button("Transform Color", use_container_width=True):
             if uploaded_file:
                 # Convert the selected color to BGR format
                 # This example assumes selected_color is in hex format (#RRGGBB)
-                color = selected_color.lstrip('#')
-                rgb = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
+                rgb = hex_to_rgb(selected_color)
                 
+                # Recolor the downscaled preview only; the full-resolution
+                # render runs on download
                 with st.spinner("Transforming color..."):
-                    result = st.session_state.recolor_service.recolor_current_image(
+                    result = st.session_state.recolor_service.preview_image(
+                        st.session_state.current_uuid,
                         target_color=rgb,
                         wait_timeout=90,
+                        output_format=get_output_format(),
                     )
                     
-                    if result['success']:
-                        st.session_state.recolored_image = None
-=======
-            if st.button("Transform Color", use_container_width=True):
-                if uploaded_file:
-                    with st.spinner("Processing your image..."):
-                        time.sleep(40) # Simulating the processing time
-                        with col1:
-                            st.image(transformed_img, caption="Transformed Image", use_container_width=True)
->>>>>>> e5b6746e0edd00d1897de3f2e7892d5640775796
-                        st.success("Transformation complete!")
-                        # Display the recolored image
-                        recolored_image = Image.open(result['image_path'])
-                        st.session_state.recolored_image = recolored_image
-
-            if 'recolored_image' in st.session_state:
-                if st.session_state.recolored_image:
-                    st.image(st.session_state.recolored_image , caption="Recolored Image", use_container_width=False)
-                    # if st.button("Download", use_container_width=True):
-                    #     recolored_image.save(f"{uploaded_file.name}_recolored.png")
-                    #     with open("recolored_image.png", "rb") as file:
-                    #         st.download_button(file,f"{uploaded_file.name}_recolored.png", "Download Recolored Image")
-                            
-                            # Save to history
+                if result['success']:
+                    st.success("Transformation complete!")
+                    # Encoded once; reruns display the same bytes
+                    recolored_image = result['output']
+                    st.session_state.recolored_image = recolored_image
+                    st.session_state.recolored_color = rgb
+                    st.session_state.full_render = None
+
+                    # Save to history
                     save_history(
-                        original_image=uploaded_file,
                         recolored_image=recolored_image,
                         color=selected_color,
                         settings={
@@ -297,6 +387,41 @@ def main():
             else:
                 st.warning("Please upload an image first")
 
+        if uploaded_file is not None and st.session_state.get('recolored_image') is not None:
+            st.image(st.session_state.recolored_image.display, caption="Recolored Preview", use_container_width=False)
+
+            if st.button("Render Full Resolution", use_container_width=True):
+                with st.spinner("Rendering full resolution..."):
+                    result = st.session_state.recolor_service.recolor_image(
+                        st.session_state.current_uuid,
+                        target_color=st.session_state.recolored_color,
+                        wait_timeout=90,
+                        output_format=get_output_format(),
+                    )
+                if result['success']:
+                    # Served from memory; the file is saved in the background
+                    st.session_state.full_render = (result['output'], os.path.basename(result['image_path']))
+                    # The full-resolution result replaces the preview in the history.
+                    # The service reuses its output file for every color, so the
+                    # history keeps its own copy.
+                    save_history(
+                        recolored_image=result['output'],
+                        color="#%02X%02X%02X" % tuple(st.session_state.recolored_color),
+                        settings={}
+                    )
+                else:
+                    st.error(f"Error: {result['message']}")
+
+            if st.session_state.get('full_render'):
+                output, file_name = st.session_state.full_render
+                st.download_button(
+                    label="Download Full Resolution",
+                    data=output.full,
+                    file_name=file_name,
+                    mime=output.mime_type,
+                    use_container_width=True
+                )
+
     elif selected == "History":
         colored_header(
             label="Processing History",
@@ -304,26 +429,44 @@ def main():
             color_name="blue-70"
         )
 
-        if 'history' in st.session_state and st.session_state.history:
-            for entry in st.session_state.history:
+        history = get_history_store()
+        total = history.count(st.session_state.history_owner)
+        if total:
+            pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+            page = min(st.session_state.get('history_page', 0), pages - 1)
+            nav_prev, nav_label, nav_next = st.columns([1, 2, 1])
+            with nav_prev:
+                if st.button("Newer", disabled=page == 0, use_container_width=True):
+                    page -= 1
+            with nav_next:
+                if st.button("Older", disabled=page >= pages - 1, use_container_width=True):
+                    page += 1
+            st.session_state.history_page = page
+            with nav_label:
+                st.markdown(f"Page {page + 1} of {pages} ({total} results)")
+
+            # Only the entries of the current page are loaded, as thumbnails
+            for entry in history.page(st.session_state.history_owner, page, HISTORY_PAGE_SIZE):
                 with st.container():
                     col1, col2 = st.columns(2)
                     with col1:
-                        st.image(entry["original_image"], caption="Original")
+                        if entry["original_thumbnail"]:
+                            st.image(entry["original_thumbnail"], caption="Original")
                     with col2:
-                        st.image(entry["recolored_image"], caption="Recolored")
-                        # Convert PIL Image to bytes for download
-                        img_bytes = io.BytesIO()
-                        entry["recolored_image"].save(img_bytes, format='PNG')
-                        
-                        st.download_button(
-                            label="Download Recolored Image",
-                            data=img_bytes.getvalue(),
-                            file_name="recolored_image.png",
-                            mime="image/png",
-                            key=f"download_{entry['timestamp']}"
-                        )
-                    st.markdown(f"**Processed at:** {entry['timestamp']}")
+                        st.image(entry["thumbnail"], caption=f"Recolored ({entry['color']})")
+                        data = history.read_output(entry)
+                        if data is not None:
+                            st.download_button(
+                                label="Download Recolored Image",
+                                data=data,
+                                file_name=f"recolored_image{os.path.splitext(entry['output_path'])[1]}",
+                                mime=entry["mime_type"],
+                                key=f"download_{entry['id']}"
+                            )
+                        else:
+                            st.caption("The recolored image is no longer available.")
+                    processed_at = datetime.fromtimestamp(entry["created_at"]).strftime("%Y-%m-%d %H:%M:%S")
+                    st.markdown(f"**Processed at:** {processed_at}")
                     st.divider()
         else:
             st.info("No processing history available yet")    
@@ -342,24 +485,31 @@ def main():
         with tabs[0]:
             st.toggle("Dark Mode", value=False)
             st.toggle("Auto-save Results", value=True)
-            st.number_input("Max History Items", min_value=5, max_value=50, value=10)
+            st.session_state.max_history_items = st.number_input(
+                "Max History Items", min_value=5, max_value=50,
+                value=st.session_state.get('max_history_items', 10)
+            )
+            get_history_store().trim(st.session_state.history_owner, st.session_state.max_history_items)
 
         with tabs[1]:
             st.selectbox(
                 "Default Color Mode",
                 ["Preset Colors", "Custom Color", "Color Palette"]
             )
-            st.selectbox(
+            qualities = list(QUALITY_PRESETS)
+            st.session_state.output_quality = st.selectbox(
                 "Default Quality",
-                ["Draft", "Standard", "High", "Ultra"]
+                qualities,
+                index=qualities.index(st.session_state.get('output_quality', 'High')),
+                help="Draft to High: JPEG of increasing quality, Ultra: lossless PNG"
             )
 
         with tabs[2]:
             st.text_input("Export Directory", value="./exports")
             st.toggle("Compress History", value=True)
             if st.button("Clear History"):
-                if 'history' in st.session_state:
-                    st.session_state.history = []
+                get_history_store().clear(st.session_state.history_owner)
+                st.session_state.history_page = 0
                 st.success("History cleared successfully")
 
     else:  # Help section
@@ -401,7 +551,16 @@ def main():
             st.write("For best results, use high-quality images in good lighting...")
 
         with st.expander("Can I batch process multiple images?"):
-            st.write("Batch processing is coming in a future update...")
+            st.write(
+                "Yes, with the batch command line tool. It renders every image of a manifest in "
+                "every target color, computing each car's mask and color analysis only once, "
+                "and can resume an interrupted run:"
+            )
+            st.code(
+                "python batch_recolor.py --manifest images.txt --colors-file colors.json "
+                "--api-url <masking server URL> --output-dir exports",
+                language="bash"
+            )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,273 @@
+import os
+import re
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List, Optional, Tuple, Any
+import cv2
+import numpy as np
+from mask_cache import MaskStore, hash_image
+from recolor import (
+    get_analysis_filename,
+    get_mask_client,
+    get_mask_and_parts_from_api,
+    prepare_mask,
+    get_or_create_analysis,
+    render_recolored,
+    render_recolored_tiled,
+    verify_color_format
+)
+
+def parse_color(value: str) -> Tuple[int, int, int]:
+    """Parse a '#RRGGBB' or 'R,G,B' color into an RGB tuple."""
+    value = value.strip()
+    if value.startswith('#') and len(value) == 7:
+        color = tuple(int(value[i:i + 2], 16) for i in (1, 3, 5))
+    else:
+        color = tuple(int(part) for part in value.split(','))
+    if not verify_color_format(color):
+        raise ValueError(f"Invalid color: {value}")
+    return color
+
+def load_manifest(manifest_path: str) -> List[str]:
+    """Read image paths from a manifest, one per line; blank lines and '#' comments are skipped."""
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path) as f:
+        lines = [line.strip() for line in f]
+    return [
+        line if os.path.isabs(line) else os.path.join(base, line)
+        for line in lines if line and not line.startswith('#')
+    ]
+
+def load_colors(colors_path: str) -> Dict[str, Tuple[int, int, int]]:
+    """Read target colors from a JSON file, either {"name": "#RRGGBB", ...} or a list of colors."""
+    with open(colors_path) as f:
+        colors = json.load(f)
+    if isinstance(colors, list):
+        colors = {str(color).lstrip('#'): color for color in colors}
+    return {
+        name: parse_color(color) if isinstance(color, str) else tuple(color)
+        for name, color in colors.items()
+    }
+
+def _slug(name: str) -> str:
+    """File-name-safe version of a color name."""
+    return re.sub(r'[^A-Za-z0-9_-]+', '-', name).strip('-') or 'color'
+
+def load_completed(results_path: str) -> set:
+    """(image, color) pairs already rendered successfully according to a result manifest."""
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    with open(results_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partially written line from an interrupted run
+                continue
+            if record.get('success'):
+                completed.add((record['image'], record['color']))
+    return completed
+
+def render_image_variants(
+    image_path: str,
+    output_stem: str,
+    colors: Dict[str, Tuple[int, int, int]],
+    base_dir: str,
+    api_url: str,
+    output_dir: str,
+    analysis_params: Optional[Dict[str, Any]] = None,
+    output_ext: str = '.png',
+    mask_cache_bytes: int = 512 * 1024 * 1024,
+    tile_rows: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Render every color variant of one image. The mask and analysis are
+    computed (or loaded from the content-addressed caches) once and shared by
+    all colors. With tile_rows each variant is rendered in bands of that many
+    rows into one reused output buffer. Returns one result record per color.
+    """
+    def record(color_name, success, output_path=None, message='', seconds=0.0):
+        return {
+            'image': image_path,
+            'color': color_name,
+            'rgb': list(colors[color_name]),
+            'success': success,
+            'output_path': output_path,
+            'message': message,
+            'seconds': round(seconds, 4)
+        }
+
+    try:
+        original = cv2.imread(image_path)
+        if original is None:
+            raise ValueError("Failed to load image")
+
+        mask_store = MaskStore(base_dir, max_bytes=mask_cache_bytes)
+        content_hash = hash_image(original)
+        mask = mask_store.get(content_hash)
+        if mask is None:
+            mask, part_map = get_mask_and_parts_from_api(image_path, api_url, get_mask_client(api_url))
+            mask_store.put(content_hash, mask)
+            if part_map is not None:
+                mask_store.put_parts(content_hash, part_map)
+
+        mask = prepare_mask(mask, original.shape)
+        analysis_results = get_or_create_analysis(
+            original, mask, base_dir, get_analysis_filename(content_hash), analysis_params
+        )
+    except Exception as e:
+        return [record(name, False, message=f"Failed to prepare image: {str(e)}") for name in colors]
+
+    records = []
+    output = np.empty_like(original) if tile_rows else None
+    for name, rgb in colors.items():
+        start = time.perf_counter()
+        output_path = os.path.join(output_dir, f"{output_stem}_{_slug(name)}{output_ext}")
+        try:
+            if tile_rows:
+                result = render_recolored_tiled(
+                    original, mask, np.array(rgb), analysis_results, tile_rows, out=output
+                )
+            else:
+                result = render_recolored(original, mask, np.array(rgb), analysis_results)
+            if not cv2.imwrite(output_path, result):
+                raise ValueError(f"Failed to write {output_path}")
+            records.append(record(name, True, output_path, 'Image successfully recolored',
+                                  time.perf_counter() - start))
+        except Exception as e:
+            records.append(record(name, False, message=str(e), seconds=time.perf_counter() - start))
+    return records
+
+def run_batch(
+    image_paths: List[str],
+    colors: Dict[str, Tuple[int, int, int]],
+    base_dir: str,
+    api_url: str,
+    output_dir: str,
+    results_path: Optional[str] = None,
+    workers: Optional[int] = None,
+    max_tasks_per_child: int = 8,
+    analysis_params: Optional[Dict[str, Any]] = None,
+    output_ext: str = '.png',
+    resume: bool = True,
+    tile_rows: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Render every image in every color across a process pool.
+    Each worker handles one image at a time (all of its colors), and is
+    replaced after max_tasks_per_child images to bound its memory. At most
+    two images per worker are in flight. One JSON record per (image, color)
+    is appended to results_path as it completes; with resume, pairs already
+    recorded as successful are skipped. tile_rows enables the banded,
+    bounded-memory render (see render_image_variants). Returns the records
+    of this run.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for dir_name in ['masks', 'analyses']:
+        os.makedirs(os.path.join(base_dir, dir_name), exist_ok=True)
+    results_path = results_path or os.path.join(output_dir, 'results.jsonl')
+    completed = load_completed(results_path) if resume else set()
+
+    # Pending colors per image; output names follow the image file name,
+    # numbered when two images share a name
+    tasks = []
+    stems: Dict[str, int] = {}
+    for image_path in image_paths:
+        stem, _ = os.path.splitext(os.path.basename(image_path))
+        stems[stem] = stems.get(stem, 0) + 1
+        output_stem = stem if stems[stem] == 1 else f"{stem}_{stems[stem]}"
+
+        pending = {
+            name: rgb for name, rgb in colors.items() if (image_path, name) not in completed
+        }
+        if pending:
+            tasks.append((image_path, output_stem, pending))
+
+    skipped = len(image_paths) * len(colors) - sum(len(pending) for _, _, pending in tasks)
+    print(f"Batch: {len(image_paths)} images x {len(colors)} colors, {skipped} already done")
+
+    workers = workers or os.cpu_count() or 1
+    records = []
+    with open(results_path, 'a') as results_file, ProcessPoolExecutor(
+        max_workers=workers, max_tasks_per_child=max_tasks_per_child
+    ) as executor:
+        remaining = iter(tasks)
+        in_flight = set()
+
+        def submit_next():
+            task = next(remaining, None)
+            if task is not None:
+                image_path, output_stem, pending = task
+                in_flight.add(executor.submit(
+                    render_image_variants, image_path, output_stem, pending, base_dir,
+                    api_url, output_dir, analysis_params, output_ext, tile_rows=tile_rows
+                ))
+            return task is not None
+
+        for _ in range(2 * workers):
+            if not submit_next():
+                break
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight.discard(future)
+                for record in future.result():
+                    results_file.write(json.dumps(record) + '\n')
+                    records.append(record)
+                    if not record['success']:
+                        print(f"Failed: {record['image']} [{record['color']}]: {record['message']}")
+                results_file.flush()
+                submit_next()
+
+    failed = sum(not record['success'] for record in records)
+    print(f"Batch finished: {len(records) - failed} rendered, {failed} failed")
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(description="Recolor many car images in many target colors.")
+    parser.add_argument('images', nargs='*', help="Image paths")
+    parser.add_argument('--manifest', help="File listing image paths, one per line")
+    parser.add_argument('--color', action='append', default=[], help="Target color as #RRGGBB or R,G,B (repeatable)")
+    parser.add_argument('--colors-file', help='JSON file of target colors, {"name": "#RRGGBB"} or a list')
+    parser.add_argument('--api-url', required=True, help="Masking server URL")
+    parser.add_argument('--base-dir', default='images', help="Directory holding the mask and analysis caches")
+    parser.add_argument('--output-dir', default=os.path.join('images', 'batch'), help="Directory for rendered images")
+    parser.add_argument('--results', help="Result manifest (JSON lines), defaults to <output-dir>/results.jsonl")
+    parser.add_argument('--workers', type=int, help="Worker processes (defaults to the CPU count)")
+    parser.add_argument('--max-tasks-per-child', type=int, default=8, help="Images per worker before it is replaced")
+    parser.add_argument('--format', choices=['png', 'jpg', 'webp'], default='png', help="Output image format")
+    parser.add_argument('--no-resume', action='store_true', help="Re-render pairs already in the result manifest")
+    parser.add_argument('--tile-rows', type=int,
+                        help="Render in bands of this many rows to bound memory on very large images")
+    args = parser.parse_args()
+
+    image_paths = list(args.images)
+    if args.manifest:
+        image_paths += load_manifest(args.manifest)
+    colors = {color.lstrip('#'): parse_color(color) for color in args.color}
+    if args.colors_file:
+        colors.update(load_colors(args.colors_file))
+    if not image_paths or not colors:
+        parser.error("at least one image and one color are required")
+
+    records = run_batch(
+        image_paths,
+        colors,
+        base_dir=args.base_dir,
+        api_url=args.api_url,
+        output_dir=args.output_dir,
+        results_path=args.results,
+        workers=args.workers,
+        max_tasks_per_child=args.max_tasks_per_child,
+        output_ext=f".{args.format}",
+        resume=not args.no_resume,
+        tile_rows=args.tile_rows
+    )
+    raise SystemExit(1 if any(not record['success'] for record in records) else 0)
+
+if __name__ == "__main__":
+    main()
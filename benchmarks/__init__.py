@@ -0,0 +1 @@
+"""Offline performance benchmarks for the recolor pipeline (run with `python -m benchmarks.run`)."""
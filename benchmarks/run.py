@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+import cv2
+import numpy as np
+from benchmarks.synthetic import make_car_image, make_asset_image
+from fake_mask_server import FakeMaskConfig, register_mask, start_fake_server
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline')
+TARGET_COLOR = (200, 30, 40)
+THUMBNAIL_SIDE = 512
+
+def case_id(case: Dict[str, Any]) -> str:
+    """Stable name of a benchmark case, used to match baseline entries."""
+    coverage = 'poly' if case['source'] == 'asset' else f"cov{int(round(case['coverage'] * 100))}"
+    return f"{case['source']}-{case['megapixels']:g}mp-{coverage}-k{case['k']}-{case['backend']}"
+
+def build_cases(
+    sources: List[str],
+    megapixels: List[float],
+    coverages: List[float],
+    ks: List[int],
+    backend: str
+) -> List[Dict[str, Any]]:
+    """Cartesian product of the benchmark axes; asset fixtures have a fixed mask, so no coverage axis."""
+    cases = []
+    for source, mp, k in itertools.product(sources, megapixels, ks):
+        for coverage in (coverages if source == 'synthetic' else [None]):
+            cases.append({'source': source, 'megapixels': mp, 'coverage': coverage, 'k': k, 'backend': backend})
+    return cases
+
+def _stage_seconds(timings: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Wall seconds per stage of one recolor_car call."""
+    seconds: Dict[str, float] = {}
+    for entry in timings:
+        seconds[entry['stage']] = seconds.get(entry['stage'], 0.0) + entry['wall_seconds']
+    return seconds
+
+def _thumbnail(image: np.ndarray) -> np.ndarray:
+    """Downscaled output kept for the baseline comparison."""
+    scale = THUMBNAIL_SIDE / max(image.shape[:2])
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+def run_case(case: Dict[str, Any], api_url: str, mask_dir: str, work_dir: str) -> Dict[str, Any]:
+    """
+    Run one case in a fresh process: a cold recolor (mask fetch and analysis)
+    followed by a warm one (cached mask and analysis, recolor only).
+    """
+    from instrumentation import peak_rss_bytes
+    from recolor import MaskClient, recolor_car
+
+    if case['source'] == 'asset':
+        image, mask = make_asset_image(case['megapixels'])
+    else:
+        image, mask = make_car_image(case['megapixels'], case['coverage'])
+
+    base_dir = os.path.join(work_dir, case_id(case))
+    os.makedirs(os.path.join(base_dir, 'processed'), exist_ok=True)
+    image_uuid = 'bench.png'
+    cv2.imwrite(os.path.join(base_dir, 'processed', image_uuid), image)
+    register_mask(mask_dir, image, mask)
+
+    mask_client = MaskClient(api_url, max_retries=0)
+    params = {'k': case['k'], 'backend': case['backend']}
+    runs = {}
+    for run in ('cold', 'warm'):
+        result = recolor_car(
+            image_uuid, TARGET_COLOR, base_dir, api_url,
+            analysis_params=params, mask_client=mask_client
+        )
+        if not result['success']:
+            raise RuntimeError(f"{case_id(case)}: {result['message']}")
+        runs[run] = _stage_seconds(result['timings'])
+
+    output = cv2.imread(result['image_path'])
+    pixels = image.shape[0] * image.shape[1]
+    return {
+        'case': case_id(case),
+        'megapixels': pixels / 1e6,
+        'mask_coverage': float(np.count_nonzero(mask)) / pixels,
+        'cold_seconds': runs['cold'],
+        'warm_seconds': runs['warm'],
+        'peak_rss_bytes': peak_rss_bytes(),
+        'thumbnail': _thumbnail(output),
+    }
+
+def delta_e(image_a: np.ndarray, image_b: np.ndarray) -> np.ndarray:
+    """Per-pixel CIE76 delta E between two BGR images."""
+    lab_a = cv2.cvtColor(image_a.astype(np.float32) / 255.0, cv2.COLOR_BGR2LAB)
+    lab_b = cv2.cvtColor(image_b.astype(np.float32) / 255.0, cv2.COLOR_BGR2LAB)
+    return np.linalg.norm(lab_a - lab_b, axis=2)
+
+def compare_to_baseline(
+    result: Dict[str, Any],
+    baseline: Dict[str, Any],
+    baseline_dir: str,
+    max_mean_delta_e: float,
+    max_p99_delta_e: float,
+    max_slowdown: float
+) -> List[str]:
+    """Regressions of one case against its baseline entry (empty when within tolerance)."""
+    problems = []
+    reference = cv2.imread(os.path.join(baseline_dir, baseline['thumbnail']))
+    if reference is None or reference.shape != result['thumbnail'].shape:
+        problems.append("baseline thumbnail missing or of a different size")
+    else:
+        errors = delta_e(result['thumbnail'], reference)
+        result['mean_delta_e'] = float(errors.mean())
+        result['p99_delta_e'] = float(np.percentile(errors, 99))
+        if result['mean_delta_e'] > max_mean_delta_e or result['p99_delta_e'] > max_p99_delta_e:
+            problems.append(
+                f"output differs: mean dE {result['mean_delta_e']:.2f}, p99 dE {result['p99_delta_e']:.2f}"
+            )
+
+    for run in ('cold', 'warm'):
+        total = sum(result[f'{run}_seconds'].values())
+        reference_total = sum(baseline[f'{run}_seconds'].values())
+        if reference_total > 0 and total > reference_total * max_slowdown:
+            problems.append(f"{run} run {total:.2f}s vs baseline {reference_total:.2f}s")
+    return problems
+
+def print_report(results: List[Dict[str, Any]]):
+    """Table of per-stage timings, throughput and peak memory."""
+    stages = sorted({stage for result in results for stage in result['cold_seconds']})
+    print(f"{'case':<40} {'MP':>6} {'cover':>6} {'cold s':>8} {'warm s':>8} "
+          f"{'cold MP/s':>10} {'warm MP/s':>10} {'peak MB':>8}")
+    for result in results:
+        cold = sum(result['cold_seconds'].values())
+        warm = sum(result['warm_seconds'].values())
+        peak = result['peak_rss_bytes'] / 2 ** 20 if result['peak_rss_bytes'] else float('nan')
+        print(f"{result['case']:<40} {result['megapixels']:>6.1f} {result['mask_coverage']:>6.2f} "
+              f"{cold:>8.2f} {warm:>8.2f} {result['megapixels'] / cold:>10.1f} "
+              f"{result['megapixels'] / warm:>10.1f} {peak:>8.0f}")
+
+    print("\nCold run, seconds per stage:")
+    print(f"{'case':<40} " + " ".join(f"{stage:>{max(len(stage), 8)}}" for stage in stages))
+    for result in results:
+        print(f"{result['case']:<40} " + " ".join(
+            f"{result['cold_seconds'].get(stage, 0.0):>{max(len(stage), 8)}.3f}" for stage in stages
+        ))
+
+def save_baseline(results: List[Dict[str, Any]], baseline_dir: str):
+    """Store timings and output thumbnails as the new baseline."""
+    os.makedirs(baseline_dir, exist_ok=True)
+    index_path = os.path.join(baseline_dir, 'baseline.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    for result in results:
+        thumbnail = f"{result['case']}.png"
+        cv2.imwrite(os.path.join(baseline_dir, thumbnail), result['thumbnail'])
+        index[result['case']] = {
+            'thumbnail': thumbnail,
+            'cold_seconds': result['cold_seconds'],
+            'warm_seconds': result['warm_seconds'],
+            'peak_rss_bytes': result['peak_rss_bytes'],
+        }
+
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+def run_benchmarks(cases: List[Dict[str, Any]], work_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Run every case against a local fake mask server, one fresh process per
+    case so peak RSS is measured per case and caches start cold.
+    """
+    owns_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='recolor-bench-')
+    mask_dir = os.path.join(work_dir, 'masks_registry')
+    server = start_fake_server(FakeMaskConfig(mode='mask_dir', mask_dir=mask_dir))
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    results = []
+    try:
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_case, case, api_url, mask_dir, work_dir).result()
+            results.append(result)
+            print(f"{result['case']}: cold {sum(result['cold_seconds'].values()):.2f}s, "
+                  f"warm {sum(result['warm_seconds'].values()):.2f}s")
+    finally:
+        server.shutdown()
+        if owns_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recolor pipeline offline.")
+    parser.add_argument('--sources', nargs='+', choices=['synthetic', 'asset'], default=['synthetic', 'asset'])
+    parser.add_argument('--megapixels', nargs='+', type=float, default=[1, 4, 12, 24])
+    parser.add_argument('--coverage', nargs='+', type=float, default=[0.15, 0.35, 0.6],
+                        help="Mask coverage fractions of the synthetic images")
+    parser.add_argument('--k', nargs='+', type=int, default=[50, 200], help="Cluster counts")
+    parser.add_argument('--backend', default='kmeans', help="Analysis backend")
+    parser.add_argument('--quick', action='store_true', help="Small smoke run: 1 MP, one coverage, k=50")
+    parser.add_argument('--baseline-dir', default=BASELINE_DIR)
+    parser.add_argument('--update-baseline', action='store_true', help="Store this run as the baseline")
+    parser.add_argument('--max-mean-delta-e', type=float, default=1.0)
+    parser.add_argument('--max-p99-delta-e', type=float, default=5.0)
+    parser.add_argument('--max-slowdown', type=float, default=1.25,
+                        help="Allowed ratio of cold/warm run time to the baseline")
+    parser.add_argument('--json', help="Write the raw results (without thumbnails) to this file")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.megapixels, args.coverage, args.k = [1], [0.35], [50]
+    cases = build_cases(args.sources, args.megapixels, args.coverage, args.k, args.backend)
+    results = run_benchmarks(cases)
+    print()
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([{key: value for key, value in result.items() if key != 'thumbnail'}
+                       for result in results], f, indent=2)
+
+    if args.update_baseline:
+        save_baseline(results, args.baseline_dir)
+        print(f"\nBaseline updated in {args.baseline_dir}")
+        return
+
+    index_path = os.path.join(args.baseline_dir, 'baseline.json')
+    if not os.path.exists(index_path):
+        print("\nNo baseline stored; run with --update-baseline to create one")
+        return
+    with open(index_path) as f:
+        baseline = json.load(f)
+
+    failed = False
+    print()
+    for result in results:
+        if result['case'] not in baseline:
+            print(f"{result['case']}: no baseline")
+            continue
+        problems = compare_to_baseline(
+            result, baseline[result['case']], args.baseline_dir,
+            args.max_mean_delta_e, args.max_p99_delta_e, args.max_slowdown
+        )
+        failed |= bool(problems)
+        print(f"{result['case']}: " + ("; ".join(problems) if problems else "ok"))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
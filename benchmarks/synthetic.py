@@ -0,0 +1,97 @@
+import os
+from typing import Tuple
+import cv2
+import numpy as np
+
+ASSET_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets', 'image.jpg')
+
+# Outline of the grey car in the left (original) half of assets/image.jpg, in
+# the 400 x 216 frame of that half
+ASSET_CAR_POLYGON = np.array([
+    (45, 75), (70, 40), (120, 25), (200, 22), (240, 45), (300, 75), (330, 110),
+    (340, 150), (320, 175), (260, 185), (210, 195), (170, 190), (120, 150),
+    (60, 115), (45, 95)
+], dtype=np.float32)
+
+def frame_size(megapixels: float, aspect: float = 1.5) -> Tuple[int, int]:
+    """(height, width) of a frame with the given pixel count and width/height ratio."""
+    height = int(round(np.sqrt(megapixels * 1e6 / aspect)))
+    return height, int(round(height * aspect))
+
+def make_car_image(
+    megapixels: float,
+    coverage: float = 0.35,
+    seed: int = 0,
+    body_color: Tuple[int, int, int] = (40, 60, 170)
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Deterministic car-like test image (BGR) and its 0/255 paintable mask.
+    The body is an ellipse covering roughly `coverage` of the frame, shaded
+    from the top with a specular band and sensor noise; the windows and
+    wheels are drawn on top and left out of the mask, like the unpaintable
+    parts the masking server removes.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = frame_size(megapixels)
+
+    # Ground and sky gradient
+    rows = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None, None]
+    sky = np.array([200, 180, 150], dtype=np.float32)
+    ground = np.array([70, 80, 90], dtype=np.float32)
+    image = np.broadcast_to(sky * (1 - rows) + ground * rows, (height, width, 3)).copy()
+
+    # Body ellipse with a 2.2:1 aspect, shrunk to fit the frame
+    semi_minor = np.sqrt(coverage * height * width / (np.pi * 2.2))
+    semi_minor = min(semi_minor, 0.45 * height, 0.45 * width / 2.2)
+    semi_major = 2.2 * semi_minor
+    center = (width // 2, int(height * 0.55))
+
+    body = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(body, center, (int(semi_major), int(semi_minor)), 0, 0, 360, 255, -1)
+
+    # Shading: lit from the top, with a bright specular band across the body
+    shade = 1.25 - 0.6 * rows[..., 0]
+    band_center = center[1] - 0.35 * semi_minor
+    band = np.exp(-((np.arange(height, dtype=np.float32) - band_center) / (0.08 * semi_minor + 1)) ** 2)[:, None]
+    paint = np.asarray(body_color, dtype=np.float32)
+    car = np.broadcast_to(paint * shade[..., None] + 140.0 * band[..., None], image.shape)
+    image[body > 0] = car[body > 0]
+
+    mask = body.copy()
+
+    # Windows on the upper half of the body, wheels at its lower edge
+    windows = np.zeros_like(body)
+    cv2.ellipse(windows, (center[0], int(center[1] - 0.45 * semi_minor)),
+                (int(0.55 * semi_major), int(0.3 * semi_minor)), 0, 180, 360, 255, -1)
+    wheels = np.zeros_like(body)
+    for offset in (-0.6, 0.6):
+        cv2.circle(wheels, (int(center[0] + offset * semi_major), int(center[1] + 0.75 * semi_minor)),
+                   int(0.3 * semi_minor), 255, -1)
+
+    image[windows > 0] = (60, 50, 40)
+    image[wheels > 0] = (25, 25, 25)
+    mask[(windows > 0) | (wheels > 0)] = 0
+
+    noise = rng.normal(0.0, 4.0, size=(height, width, 1)).astype(np.float32)
+    image += noise
+    return np.clip(image, 0, 255).astype(np.uint8), mask
+
+def make_asset_image(megapixels: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The original car of assets/image.jpg resampled to the given pixel count,
+    with a fixed polygon mask. Upscaled fixtures keep the photo's real color
+    distribution at benchmark resolutions.
+    """
+    asset = cv2.imread(ASSET_PATH)
+    if asset is None:
+        raise FileNotFoundError(ASSET_PATH)
+    original = asset[:, :asset.shape[1] // 2]
+
+    aspect = original.shape[1] / original.shape[0]
+    height, width = frame_size(megapixels, aspect)
+    image = cv2.resize(original, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    scale = np.array([width / original.shape[1], height / original.shape[0]], dtype=np.float32)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.fillPoly(mask, [np.round(ASSET_CAR_POLYGON * scale).astype(np.int32)], 255)
+    return image, mask
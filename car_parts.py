@@ -0,0 +1,85 @@
+from typing import Any, Dict, Iterable
+import cv2
+import numpy as np
+
+# Part category mapping of the car part model
+category_mapping_parts = {
+    "Windshield": 0,
+    "Back-windshield": 1,
+    "Front-window": 2,
+    "Back-window": 3,
+    "Front-door": 4,
+    "Back-door": 5,
+    "Front-wheel": 6,
+    "Cracked": 7,
+    "Front-bumper": 8,
+    "Back-bumper": 9,
+    "Headlight": 10,
+    "Tail-light": 11,
+    "Hood": 12,
+    "Trunk": 13,
+    "License-plate": 14,
+    "Mirror": 15,
+    "Roof": 16,
+    "Grille": 17,
+    "Rocker-panel": 18,
+    "Quarter-panel": 19,
+    "Fender": 20
+}
+
+# Reverse mapping for part categories
+id_to_part_name = {v: k for k, v in category_mapping_parts.items()}
+
+# Parts left out of the paintable mask by default
+unpaintable_parts = [
+    "Front-wheel",
+    "Back-wheel",
+    "Windshield",
+    "Back-windshield",
+    "Front-window",
+    "Back-window",
+    "Headlight",
+    "Tail-light",
+    "License-plate",
+    "Mirror",
+    "Grille"
+]
+
+# Part map value of car pixels not covered by any detected part. Other values
+# are 0 outside the car and part id + 1 on a detected part.
+CAR_BODY = 255
+
+def build_part_labels(image_size, parts: Dict[str, Any]) -> np.ndarray:
+    """
+    Label map of detected part instances: 0 where no part was detected,
+    otherwise category id + 1. Where instances overlap the unpaintable parts
+    win, then the more confident one, so leaving unpaintable_parts out of the
+    car mask through the labels gives the same mask as merging their
+    instance masks.
+    """
+    labels = np.zeros(image_size, dtype=np.uint8)
+    ordered = sorted(
+        parts["instances"],
+        key=lambda detection: (detection["part"] in unpaintable_parts, detection["confidence"])
+    )
+    for detection in ordered:
+        part_id = category_mapping_parts.get(detection["part"])
+        if part_id is not None:
+            labels[detection["mask"].astype(bool)] = part_id + 1
+    return labels
+
+def build_part_map(car_mask: np.ndarray, part_labels: np.ndarray) -> np.ndarray:
+    """Restrict a part label map to the car: 0 outside it, CAR_BODY on car pixels of no detected part."""
+    part_map = np.where(part_labels > 0, part_labels, CAR_BODY).astype(np.uint8)
+    part_map[car_mask <= 127] = 0
+    return part_map
+
+def build_paintable_mask(part_map: np.ndarray, unpaintable: Iterable[str] = unpaintable_parts) -> np.ndarray:
+    """0/255 mask of the car without the named parts, in a single lookup over the part map."""
+    lut = np.full(256, 255, dtype=np.uint8)
+    lut[0] = 0
+    for name in unpaintable:
+        part_id = category_mapping_parts.get(name)
+        if part_id is not None:
+            lut[part_id + 1] = 0
+    return cv2.LUT(part_map, lut)
@@ -1,138 +1,813 @@
 import os
 import threading
+import time
+from contextlib import contextmanager
 import cv2
-from typing import Optional, Dict, Any, Tuple
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Optional, Dict, Any, Tuple, List
+from mask_cache import MaskStore
+from memory_cache import TieredCache
+from output_encoding import EncodedOutput, OutputFormat, OutputWriter, downscale, encode_image, encode_renditions
+from car_parts import CAR_BODY, build_paintable_mask, id_to_part_name
+from instrumentation import collect, render_prometheus, span
 from recolor import (
     generate_uuid_filename,
-    get_mask_filename,
     get_analysis_filename,
-    check_existing_mask,
-    get_mask_from_api,
-    analyze_car,
-    save_analysis,
-    recolor_car
+    load_or_fetch_mask,
+    MaskClient,
+    prepare_mask,
+    get_or_create_analysis,
+    update_analysis,
+    load_or_fetch_part_map,
+    build_preview_proxy,
+    render_preview,
+    render_previews,
+    get_masked_car,
+    recolor_prepared
 )
 
+def _result_key(
+    kind: str,
+    image_uuid: str,
+    target_color: Tuple[int, int, int],
+    output_format: Optional[OutputFormat]
+) -> Tuple:
+    """Result cache key of a 'preview' or 'full' render; a preview without output_format is the unencoded one."""
+    return (kind, image_uuid, tuple(int(c) for c in target_color), output_format)
+
+class JobState(str, Enum):
+    """Lifecycle of an uploaded image: queued -> masking -> analyzing -> ready/failed."""
+    QUEUED = 'queued'
+    MASKING = 'masking'
+    ANALYZING = 'analyzing'
+    READY = 'ready'
+    FAILED = 'failed'
+
+@dataclass
+class ImageJob:
+    """Background processing state of one uploaded image."""
+    image_uuid: str
+    image_path: str
+    state: JobState = JobState.QUEUED
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    mask_complete: threading.Event = field(default_factory=threading.Event)
+    processing_complete: threading.Event = field(default_factory=threading.Event)
+    future: Optional[Future] = None
+    # Speculative preset renders scheduled once the image is ready
+    prerender: Optional[Future] = None
+    prerender_cancelled: threading.Event = field(default_factory=threading.Event)
+    # Format of the speculative full renders (the uploader's), default the service's
+    output_format: Optional[OutputFormat] = None
+    # Result key and write future of the output last written to each output path
+    persisted: Dict[str, Tuple[Tuple, Future]] = field(default_factory=dict)
+    # Downscaled image, mask and analysis maps for interactive previews
+    preview: Optional[Dict[str, Any]] = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in (JobState.READY, JobState.FAILED)
+
 class CarRecolorService:
-    def __init__(self, base_dir: str, api_url: str):
-        """Initialize the car recolor service with base directory and API URL."""
+    def __init__(
+        self,
+        base_dir: str,
+        api_url: str,
+        analysis_params: Optional[Dict[str, Any]] = None,
+        max_workers: int = 4,
+        max_jobs: int = 256,
+        mask_client: Optional[MaskClient] = None,
+        mask_cache_bytes: int = 512 * 1024 * 1024,
+        tile_rows: Optional[int] = None,
+        memory_cache_bytes: int = 1024 * 1024 * 1024,
+        memory_cache_dir: Optional[str] = None,
+        output_format: Optional[OutputFormat] = None,
+        prerender_colors: Optional[List[Tuple[int, int, int]]] = None,
+        result_cache_bytes: int = 256 * 1024 * 1024
+    ):
+        """
+        Initialize the car recolor service with base directory and API URL.
+        analysis_params selects the cluster count and analysis backend
+        (defaults to recolor.ANALYSIS_PARAMS). Uploads are processed by a pool
+        of max_workers threads; at most max_jobs jobs are kept in the registry,
+        finished jobs being dropped oldest first. mask_client overrides the
+        default pooled MaskClient (timeouts, retries, upload downscaling).
+        Masks and analyses are cached by image content, with the masks
+        directory bounded to mask_cache_bytes. With tile_rows, full-resolution
+        recolors run in bands of that many rows to bound their peak memory.
+        The decoded original, prepared mask, masked car and analysis of recent
+        images are kept in memory up to memory_cache_bytes, so repeat recolors
+        skip decoding and cache lookups; with memory_cache_dir, evicted arrays
+        spill there instead of being dropped.
+        Full-resolution results are encoded in memory with output_format
+        (default OutputFormat()) and written to disk in the background.
+        Rendered previews and results are kept in a cache of result_cache_bytes
+        keyed by image, color and output format. With prerender_colors, the
+        previews (unencoded, so any format reuses them) and full renders of
+        those colors are rendered speculatively once an image is ready, on one
+        low-priority thread that pauses between stages while interactive
+        requests are running (see cancel_prerender).
+        """
         self.base_dir = base_dir
         self.api_url = api_url
+        self.analysis_params = analysis_params
+        self.mask_client = mask_client or MaskClient(api_url, pool_size=max_workers)
+        self.mask_store = MaskStore(base_dir, max_bytes=mask_cache_bytes)
+        self.tile_rows = tile_rows
+        self.cache = TieredCache(max_bytes=memory_cache_bytes, disk_dir=memory_cache_dir)
+        self.output_format = output_format or OutputFormat()
+        self.output_writer = OutputWriter()
+        self.results = TieredCache(max_bytes=result_cache_bytes)
+        self.prerender_colors = [tuple(int(c) for c in color) for color in prerender_colors or []]
+        self.prerender_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recolor-prerender')
+        self.prerendered = 0
+        # Interactive previews/renders in flight; speculative renders wait for zero
+        self._interactive_requests = 0
+        self._idle = threading.Condition()
+        self.max_jobs = max_jobs
+        self.jobs: Dict[str, ImageJob] = {}
+        self.jobs_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='recolor-worker')
+        # Most recent upload, for single-session callers of the *_current_* helpers
         self.current_uuid = None
-        self.processing_lock = threading.Lock()
-        self.processing_thread = None
-        self.processing_complete = threading.Event()
-        self.mask_complete = threading.Event()
         self._setup_directories()
-        print("CarRecolorService initialized.") 
-        
+        print("CarRecolorService initialized.")
+
     def _setup_directories(self):
         """Create necessary directories if they don't exist."""
         for dir_name in ['processed', 'masks', 'analyses', 'output']:
             os.makedirs(os.path.join(self.base_dir, dir_name), exist_ok=True)
-    
-    def _process_image_async(self, image_path: str):
+
+    def _process_image_async(self, job: ImageJob):
         """Background processing of mask and analysis."""
         try:
-            # Generate mask
-            mask_filename = get_mask_filename(self.current_uuid)
-            mask = check_existing_mask(self.base_dir, mask_filename)
-            
-            if mask is None:
-                mask = get_mask_from_api(image_path, self.api_url)
-                cv2.imwrite(os.path.join(self.base_dir, 'masks', mask_filename), mask)
-            
-            self.mask_complete.set()
-            
-            # Perform analysis
-            original = cv2.imread(image_path)
-            mask = cv2.resize(mask, (original.shape[1], original.shape[0]))
-            _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
-            
-            masked_car = cv2.bitwise_and(original, original, mask=mask)
-            analysis_results = analyze_car(cv2.cvtColor(masked_car, cv2.COLOR_BGR2RGB))
-            
-            analysis_filename = get_analysis_filename(self.current_uuid)
-            save_analysis(analysis_results, self.base_dir, analysis_filename)
-            
-            self.processing_complete.set()
-            
+            # Generate mask, reusing the cached one for previously seen photos
+            job.state = JobState.MASKING
+            original = cv2.imread(job.image_path)
+            if original is None:
+                raise ValueError("Failed to load image")
+
+            mask, storage_name = load_or_fetch_mask(
+                job.image_uuid, job.image_path, original, self.base_dir,
+                self.api_url, self.mask_client, self.mask_store
+            )
+
+            job.mask_complete.set()
+
+            # Perform analysis; recolors reuse it through the memory and analysis caches
+            job.state = JobState.ANALYZING
+            mask = prepare_mask(mask, original.shape)
+
+            analysis_filename = get_analysis_filename(storage_name)
+            analysis_results = get_or_create_analysis(
+                original, mask, self.base_dir, analysis_filename, self.analysis_params
+            )
+            job.preview = build_preview_proxy(original, mask, analysis_results)
+            self._cache_inputs(job.image_uuid, original, mask, analysis_results)
+
+            job.state = JobState.READY
+            if self.prerender_colors and not job.prerender_cancelled.is_set():
+                job.prerender = self.prerender_executor.submit(self._prerender, job)
+
         except Exception as e:
-            print(f"Error in background processing: {str(e)}")
-            # Reset events in case of error
-            self.mask_complete.set()
-            self.processing_complete.set()
-    
-    def process_new_image(self, image_data: bytes, file_name: str) -> str:
+            print(f"Error in background processing of {job.image_uuid}: {str(e)}")
+            job.error = str(e)
+            job.state = JobState.FAILED
+        finally:
+            # Release waiters on success and on error
+            job.mask_complete.set()
+            job.processing_complete.set()
+
+    def _prune_jobs(self):
+        """Drop the oldest finished jobs once the registry exceeds max_jobs. Caller holds jobs_lock."""
+        excess = len(self.jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        finished = sorted(
+            (job for job in self.jobs.values() if job.is_finished),
+            key=lambda job: job.created_at
+        )
+        for job in finished[:excess]:
+            del self.jobs[job.image_uuid]
+
+    def process_new_image(
+        self,
+        image_data: bytes,
+        file_name: str,
+        output_format: Optional[OutputFormat] = None
+    ) -> str:
         """
         Process a new image upload.
-        Returns the UUID for the processed image.
-        """
-        with self.processing_lock:
-            # Reset processing flags
-            self.mask_complete.clear()
-            self.processing_complete.clear()
-            
-            # Generate new UUID and save image
-            file_extension = os.path.splitext(file_name)[1]
-            self.current_uuid = generate_uuid_filename() + file_extension
-            new_image_path = os.path.join(self.base_dir, 'processed', self.current_uuid)
-            
-            with open(new_image_path, 'wb') as f:
-                f.write(image_data)
-            
-            # Start background processing
-            self.processing_thread = threading.Thread(
-                target=self._process_image_async,
-                args=(new_image_path,)
+        Returns the UUID for the processed image. Full-resolution results are
+        pre-rendered in output_format (default the service's), the format the
+        uploader is expected to request.
+        """
+        # Generate new UUID and save image
+        file_extension = os.path.splitext(file_name)[1]
+        image_uuid = generate_uuid_filename() + file_extension
+        new_image_path = os.path.join(self.base_dir, 'processed', image_uuid)
+
+        with open(new_image_path, 'wb') as f:
+            f.write(image_data)
+
+        job = ImageJob(image_uuid=image_uuid, image_path=new_image_path, output_format=output_format)
+        with self.jobs_lock:
+            self.jobs[image_uuid] = job
+            self.current_uuid = image_uuid
+            self._prune_jobs()
+
+        # Start background processing
+        job.future = self.executor.submit(self._process_image_async, job)
+
+        return image_uuid
+
+    def get_job(self, image_uuid: str) -> Optional[ImageJob]:
+        """Get the job registered for an image UUID."""
+        with self.jobs_lock:
+            return self.jobs.get(image_uuid)
+
+    def _wait_for_processing(self, image_uuid: str, wait_timeout: int) -> Optional[Dict[str, Any]]:
+        """
+        Wait for the background processing of an image.
+        Returns None once it can be recolored, or the failure result dictionary.
+        Images processed by an earlier service instance have no job and are
+        accepted as long as they are on disk.
+        """
+        job = self.get_job(image_uuid)
+        image_path = os.path.join(self.base_dir, 'processed', image_uuid or '')
+
+        if job is None and not (image_uuid and os.path.exists(image_path)):
+            return {
+                'success': False,
+                'message': f'Unknown image: {image_uuid}'
+            }
+
+        if job is not None:
+            if not job.processing_complete.wait(timeout=wait_timeout):
+                return {
+                    'success': False,
+                    'message': 'Processing timeout'
+                }
+            if job.state == JobState.FAILED:
+                return {
+                    'success': False,
+                    'message': f'Processing failed: {job.error}'
+                }
+        return None
+
+    def _cache_inputs(
+        self,
+        image_uuid: str,
+        original: np.ndarray,
+        mask: np.ndarray,
+        analysis_results: Dict[str, Any]
+    ):
+        """Keep the render inputs of an image in the memory cache; its masked car is derived lazily."""
+        self.cache.put((image_uuid, 'original'), original)
+        self.cache.put((image_uuid, 'mask'), mask)
+        self.cache.put((image_uuid, 'analysis'), analysis_results)
+        self.cache.discard((image_uuid, 'masked_car'))
+        # Rendered results of the image are stale once its inputs change
+        self.results.discard_matching(lambda key: key[1] == image_uuid)
+
+    def _get_inputs(self, image_uuid: str) -> Tuple[np.ndarray, np.ndarray, Dict[str, Any]]:
+        """
+        Decoded original, prepared mask and analysis of a processed image,
+        from the memory cache; missing ones are loaded from disk (and the mask
+        and analysis caches) and cached. The arrays are shared: do not modify them.
+        """
+        original = self.cache.get((image_uuid, 'original'))
+        mask = self.cache.get((image_uuid, 'mask'))
+        analysis_results = self.cache.get((image_uuid, 'analysis'))
+        if original is not None and mask is not None and analysis_results is not None:
+            return original, mask, analysis_results
+
+        image_path = os.path.join(self.base_dir, 'processed', image_uuid)
+        if original is None:
+            with span('image_decode'):
+                original = cv2.imread(image_path)
+            if original is None:
+                raise ValueError("Failed to load image")
+
+        storage_name = self.mask_store.storage_name(image_uuid)
+        if mask is None or storage_name is None:
+            mask, storage_name = load_or_fetch_mask(
+                image_uuid, image_path, original, self.base_dir,
+                self.api_url, self.mask_client, self.mask_store
             )
-            self.processing_thread.start()
-            
-            return self.current_uuid
-    
-    def recolor_current_image(
+            with span('mask.prepare'):
+                mask = prepare_mask(mask, original.shape)
+            self.cache.discard((image_uuid, 'masked_car'))
+
+        if analysis_results is None:
+            analysis_results = get_or_create_analysis(
+                original, mask, self.base_dir, get_analysis_filename(storage_name), self.analysis_params
+            )
+
+        self.cache.put((image_uuid, 'original'), original)
+        self.cache.put((image_uuid, 'mask'), mask)
+        self.cache.put((image_uuid, 'analysis'), analysis_results)
+        return original, mask, analysis_results
+
+    def _build_preview(self, image_uuid: str) -> Dict[str, Any]:
+        """Build the preview proxy of an image that has none yet, reusing its cached mask and analysis."""
+        return build_preview_proxy(*self._get_inputs(image_uuid))
+
+    def _get_preview(self, image_uuid: str) -> Dict[str, Any]:
+        """Preview proxy of a processed image, built and kept on its job if missing."""
+        job = self.get_job(image_uuid)
+        proxy = job.preview if job is not None else None
+        if proxy is None:
+            proxy = self._build_preview(image_uuid)
+            if job is not None:
+                job.preview = proxy
+        return proxy
+
+    @contextmanager
+    def _interactive(self):
+        """Mark an interactive request in flight, holding back speculative renders."""
+        with self._idle:
+            self._interactive_requests += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._interactive_requests -= 1
+                if self._interactive_requests == 0:
+                    self._idle.notify_all()
+
+    def _wait_until_idle(self, cancelled: threading.Event):
+        """Block until no interactive request is in flight or the wait is cancelled."""
+        with self._idle:
+            while self._interactive_requests and not cancelled.is_set():
+                self._idle.wait(timeout=0.1)
+
+    def _may_continue(self, job: ImageJob) -> bool:
+        """Wait for interactive requests to finish; False once the image's speculative renders are cancelled."""
+        self._wait_until_idle(job.prerender_cancelled)
+        return not job.prerender_cancelled.is_set()
+
+    def _prerender(self, job: ImageJob):
+        """
+        Render the unencoded previews, then the full-resolution results, of the
+        prerender colors into the result cache. Full renders pause between
+        stages for interactive requests and stop there once cancelled.
+        """
+        full_format = job.output_format or self.output_format
+        for kind, output_format in (('preview', None), ('full', full_format)):
+            for color in self.prerender_colors:
+                if not self._may_continue(job):
+                    return
+                if _result_key(kind, job.image_uuid, color, output_format) in self.results:
+                    continue
+                try:
+                    with span('prerender'):
+                        if kind == 'preview':
+                            rendered = self._render_preview(job.image_uuid, color, None)
+                        else:
+                            rendered = self._render_full(
+                                job.image_uuid, color, output_format, lambda: self._may_continue(job)
+                            )
+                except Exception as e:
+                    print(f"Error pre-rendering {job.image_uuid}: {str(e)}")
+                    return
+                if rendered is None:
+                    return
+                self.prerendered += 1
+
+    def cancel_prerender(self, image_uuid: Optional[str]):
+        """Stop the speculative renders of an image, e.g. when its user uploads another one."""
+        job = self.get_job(image_uuid) if image_uuid else None
+        if job is None:
+            return
+        job.prerender_cancelled.set()
+        if job.prerender is not None:
+            job.prerender.cancel()
+
+    def _render_preview(
         self,
+        image_uuid: str,
         target_color: Tuple[int, int, int],
+        output_format: Optional[OutputFormat]
+    ) -> Dict[str, Any]:
+        """
+        Render a preview (RGB 'image', encoded 'output' with output_format) and
+        cache it. An encoded preview reuses the cached unencoded one if any.
+        """
+        preview = None
+        if output_format is not None:
+            unencoded = self.results.get(_result_key('preview', image_uuid, target_color, None))
+            preview = unencoded['image'] if unencoded is not None else None
+        if preview is None:
+            preview = render_preview(self._get_preview(image_uuid), target_color)
+        encoded = None
+        if output_format is not None:
+            encoded = encode_renditions(cv2.cvtColor(preview, cv2.COLOR_RGB2BGR), output_format)
+        rendered = {'image': preview, 'output': encoded}
+        self.results.put(_result_key('preview', image_uuid, target_color, output_format), rendered)
+        return rendered
+
+    def _render_full(
+        self,
+        image_uuid: str,
+        target_color: Tuple[int, int, int],
+        output_format: OutputFormat,
+        may_continue=None
+    ) -> Optional[EncodedOutput]:
+        """
+        Render and encode a full-resolution result and cache it. may_continue,
+        if given, is called between stages; the render stops and returns None
+        when it returns False.
+        """
+        may_continue = may_continue or (lambda: True)
+        original, mask, analysis_results = self._get_inputs(image_uuid)
+        masked_car = None
+        if not self.tile_rows:
+            if not may_continue():
+                return None
+            with span('masked_car'):
+                masked_car = self.cache.get_or_load(
+                    (image_uuid, 'masked_car'),
+                    lambda: get_masked_car(original, mask, analysis_results)
+                )
+        if not may_continue():
+            return None
+        result = recolor_prepared(
+            original, mask, analysis_results, target_color, masked_car, self.tile_rows
+        )
+        if not may_continue():
+            return None
+        encoded = encode_renditions(result, output_format)
+        self.results.put(_result_key('full', image_uuid, target_color, output_format), encoded)
+        return encoded
+
+    def preview_image(
+        self,
+        image_uuid: str,
+        target_color: Tuple[int, int, int],
+        wait_timeout: int = 30,
+        output_format: Optional[OutputFormat] = None
+    ) -> Dict[str, Any]:
+        """
+        Recolor the downscaled preview of an uploaded image, in memory.
+        Returns the result dictionary with the RGB preview under 'image';
+        recolor_image renders the matching full-resolution result. With
+        output_format the preview is also encoded, with its renditions, as an
+        EncodedOutput under 'output'. Previews are served from the result
+        cache when already rendered; a pre-rendered one only needs encoding.
+        """
+        failure = self._wait_for_processing(image_uuid, wait_timeout)
+        if failure is not None:
+            return failure
+
+        try:
+            with self._interactive():
+                rendered = self.results.get(_result_key('preview', image_uuid, target_color, output_format))
+                if rendered is None:
+                    rendered = self._render_preview(image_uuid, target_color, output_format)
+        except Exception as e:
+            return {
+                'success': False,
+                'image': None,
+                'output': None,
+                'message': f'Preview failed: {str(e)}'
+            }
+
+        return {
+            'success': True,
+            'image': rendered['image'],
+            'output': rendered['output'],
+            'message': 'Preview rendered'
+        }
+
+    def preview_palette(
+        self,
+        image_uuid: str,
+        target_colors: List[Tuple[int, int, int]],
         wait_timeout: int = 30
     ) -> Dict[str, Any]:
         """
-        Recolor the current image with the specified target color.
-        Returns the result dictionary with success status and image path.
+        Recolor the preview of an uploaded image into several colors in one pass.
+        Returns the result dictionary with one RGB preview per color under 'images'.
         """
-        if not self.current_uuid:
+        failure = self._wait_for_processing(image_uuid, wait_timeout)
+        if failure is not None:
+            return failure
+
+        try:
+            with self._interactive():
+                previews = render_previews(self._get_preview(image_uuid), target_colors)
+        except Exception as e:
             return {
                 'success': False,
-                'message': 'No image currently loaded'
+                'images': None,
+                'message': f'Preview failed: {str(e)}'
             }
-        
-        # Wait for processing to complete
-        if not self.processing_complete.wait(timeout=wait_timeout):
+
+        return {
+            'success': True,
+            'images': list(previews),
+            'message': 'Palette rendered'
+        }
+
+    def _update_mask(self, image_uuid: str, edit) -> Dict[str, Any]:
+        """
+        Replace the mask of a processed image with edit(original, content hash,
+        prepared mask), update its analysis incrementally and rebuild its preview.
+        The edit is stored for this upload only; the server's mask of the photo,
+        shared with other uploads of it, and its analysis are left untouched.
+        """
+        try:
+            with self._interactive():
+                image_path = os.path.join(self.base_dir, 'processed', image_uuid)
+                original, mask, _ = self._get_inputs(image_uuid)
+                content_hash = self.mask_store.resolve(image_uuid)
+                if content_hash is None:
+                    raise ValueError("No cached mask for this image")
+                # The cached mask is shared with concurrent renders, so edit a copy
+                mask = edit(image_path, content_hash, mask.copy())
+                if not mask.any():
+                    raise ValueError("The edited mask is empty")
+                # Later renders of this upload load the edit and hit the updated analysis
+                if not self.mask_store.put_edit(image_uuid, mask):
+                    raise ValueError("Failed to save mask")
+
+                # Release the cached mapping of the upload's analysis, which is replaced
+                self.cache.discard((image_uuid, 'analysis'))
+                analysis_results = update_analysis(
+                    original, mask, self.base_dir,
+                    get_analysis_filename(self.mask_store.edit_name(image_uuid)), self.analysis_params,
+                    base_filename=get_analysis_filename(content_hash)
+                )
+                preview = build_preview_proxy(original, mask, analysis_results)
+                self._cache_inputs(image_uuid, original, mask, analysis_results)
+        except Exception as e:
             return {
                 'success': False,
-                'message': 'Processing timeout'
+                'message': f'Mask edit failed: {str(e)}'
             }
-        
+
+        job = self.get_job(image_uuid)
+        if job is not None:
+            job.preview = preview
+        return {
+            'success': True,
+            'incremental': 'drift_pixels' in analysis_results,
+            'message': 'Mask updated'
+        }
+
+    def edit_mask(
+        self,
+        image_uuid: str,
+        add_mask: Optional[np.ndarray] = None,
+        remove_mask: Optional[np.ndarray] = None,
+        wait_timeout: int = 30
+    ) -> Dict[str, Any]:
+        """
+        Add pixels to or remove pixels from the paintable mask of an uploaded
+        image, e.g. to paint a part the masking server left out. add_mask and
+        remove_mask are 0/255 masks of the changed pixels, resized to the image.
+        The analysis is updated incrementally, re-clustering only after large
+        cumulative edits, and the preview is rebuilt. Returns the result
+        dictionary; 'incremental' is False when the car was re-analyzed.
+        """
+        failure = self._wait_for_processing(image_uuid, wait_timeout)
+        if failure is not None:
+            return failure
+
+        def edit(image_path, content_hash, mask):
+            if add_mask is not None:
+                mask[prepare_mask(add_mask, mask.shape) > 0] = 255
+            if remove_mask is not None:
+                mask[prepare_mask(remove_mask, mask.shape) > 0] = 0
+            return mask
+
+        return self._update_mask(image_uuid, edit)
+
+    def select_parts(
+        self,
+        image_uuid: str,
+        unpaintable_parts: List[str],
+        wait_timeout: int = 30
+    ) -> Dict[str, Any]:
+        """
+        Choose which parts of an uploaded image are left unpainted (names from
+        car_parts.category_mapping_parts; car_parts.unpaintable_parts is the
+        default). The mask is rebuilt from the image's cached part map without
+        calling the masking server, then handled like edit_mask.
+        """
+        failure = self._wait_for_processing(image_uuid, wait_timeout)
+        if failure is not None:
+            return failure
+
+        def edit(image_path, content_hash, mask):
+            part_map = load_or_fetch_part_map(
+                image_path, content_hash, self.api_url, self.mask_client, self.mask_store
+            )
+            return prepare_mask(build_paintable_mask(part_map, unpaintable_parts), mask.shape)
+
+        return self._update_mask(image_uuid, edit)
+
+    def get_parts(self, image_uuid: str, wait_timeout: int = 30) -> Dict[str, Any]:
+        """Names of the parts detected on an uploaded image, under 'parts'."""
+        failure = self._wait_for_processing(image_uuid, wait_timeout)
+        if failure is not None:
+            return failure
+
+        try:
+            content_hash = self.mask_store.resolve(image_uuid)
+            part_map = self.mask_store.get_parts(content_hash) if content_hash else None
+            if part_map is None:
+                raise ValueError("No part map for this image")
+        except Exception as e:
+            return {
+                'success': False,
+                'parts': [],
+                'message': str(e)
+            }
+
+        part_ids = [value - 1 for value in np.unique(part_map) if 0 < value < CAR_BODY]
+        return {
+            'success': True,
+            'parts': [id_to_part_name[part_id] for part_id in part_ids if part_id in id_to_part_name],
+            'message': 'Parts loaded'
+        }
+
+    def recolor_image(
+        self,
+        image_uuid: str,
+        target_color: Tuple[int, int, int],
+        wait_timeout: int = 30,
+        output_format: Optional[OutputFormat] = None
+    ) -> Dict[str, Any]:
+        """
+        Recolor an uploaded image at full resolution with the specified target color.
+        Returns the result dictionary with success status, the encoded result
+        and its display and thumbnail renditions as an EncodedOutput under
+        'output', and the per-stage 'timings' of the call. The file at
+        'image_path' is written in the background; 'saved' is the future of
+        that write. output_format overrides the service's format. Results
+        already in the result cache (e.g. pre-rendered presets) are returned
+        without rendering, with 'cached' set, and are not written again when
+        the file already holds them. The image's decoded original,
+        mask, masked car and analysis come from the memory cache when present.
+        """
+        failure = self._wait_for_processing(image_uuid, wait_timeout)
+        if failure is not None:
+            return failure
+
         # Perform recoloring
-        image_path = os.path.join(self.base_dir, 'processed', self.current_uuid)
-        output_path = os.path.join(self.base_dir, 'output', f"recolored_{self.current_uuid}")
-        
-        result = recolor_car(
-            image_uuid=self.current_uuid,
-            target_color=target_color,
-            base_dir=self.base_dir,
-            api_url=self.api_url,
-            output_path=output_path
+        output_format = output_format or self.output_format
+        output_path = os.path.join(
+            self.base_dir, 'output', f"recolored_{os.path.splitext(image_uuid)[0]}{output_format.extension}"
         )
-        
+
+        key = _result_key('full', image_uuid, target_color, output_format)
+        with collect() as timings, self._interactive():
+            try:
+                encoded = self.results.get(key)
+                cached = encoded is not None
+                if not cached:
+                    encoded = self._render_full(image_uuid, target_color, output_format)
+                result = {
+                    'success': True,
+                    'image_path': output_path,
+                    'output': encoded,
+                    'cached': cached,
+                    'saved': self._persist(image_uuid, key, output_path, encoded, cached),
+                    'message': 'Image successfully recolored'
+                }
+            except Exception as e:
+                result = {
+                    'success': False,
+                    'image_path': None,
+                    'output': None,
+                    'message': f'Recolor failed: {str(e)}'
+                }
+        result['timings'] = timings
         return result
-    
-    def get_processing_status(self) -> Dict[str, bool]:
-        """Get the current processing status."""
+
+    def _persist(
+        self,
+        image_uuid: str,
+        key: Tuple,
+        output_path: str,
+        encoded: EncodedOutput,
+        cached: bool
+    ) -> Future:
+        """
+        Schedule writing a full-resolution result to output_path and return the
+        write's future. A cached result the file already holds (or is being
+        written with) is not written again.
+        """
+        job = self.get_job(image_uuid)
+        if job is None:
+            return self.output_writer.submit(output_path, encoded.full)
+        with self.jobs_lock:
+            persisted = job.persisted.get(output_path)
+            if cached and persisted is not None and persisted[0] == key:
+                saved = persisted[1]
+                if not saved.done() or (saved.exception() is None and os.path.exists(output_path)):
+                    return saved
+            saved = self.output_writer.submit(output_path, encoded.full)
+            job.persisted[output_path] = (key, saved)
+        return saved
+
+    def recolor_current_image(
+        self,
+        target_color: Tuple[int, int, int],
+        wait_timeout: int = 30
+    ) -> Dict[str, Any]:
+        """Recolor the most recently uploaded image."""
+        if not self.current_uuid:
+            return {
+                'success': False,
+                'message': 'No image currently loaded'
+            }
+        return self.recolor_image(self.current_uuid, target_color, wait_timeout)
+
+    def get_thumbnail(self, image_uuid: str, max_side: int = 256) -> Optional[bytes]:
+        """JPEG thumbnail of an uploaded image, shrunk from its cached decoded original when possible."""
+        original = self.cache.get((image_uuid, 'original'))
+        if original is None:
+            original = cv2.imread(os.path.join(self.base_dir, 'processed', image_uuid))
+            if original is None:
+                return None
+        return encode_image(downscale(original, max_side), 'jpeg', 85)
+
+    def get_processing_status(self, image_uuid: Optional[str] = None) -> Dict[str, Any]:
+        """Get the processing status of an image (the most recent upload by default)."""
+        job = self.get_job(image_uuid or self.current_uuid)
+        if job is None:
+            return {
+                'state': None,
+                'mask_complete': False,
+                'analysis_complete': False,
+                'error': None
+            }
         return {
-            'mask_complete': self.mask_complete.is_set(),
-            'analysis_complete': self.processing_complete.is_set()
+            'state': job.state.value,
+            'mask_complete': job.mask_complete.is_set(),
+            'analysis_complete': job.processing_complete.is_set(),
+            'error': job.error
         }
-    
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters of the content-addressed mask cache."""
+        return self.mask_store.stats()
+
+    def get_memory_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters of the in-memory cache of decoded images, masks and analyses."""
+        return self.cache.stats()
+
+    def get_result_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters of the rendered result cache, and the number of speculative renders."""
+        return dict(self.results.stats(), prerendered=self.prerendered)
+
+    def get_metrics(self) -> str:
+        """Prometheus text exposition of stage timings, job states and cache counters."""
+        with self.jobs_lock:
+            states = [job.state for job in self.jobs.values()]
+
+        lines = ["# TYPE recolor_jobs gauge"]
+        for state in JobState:
+            lines.append(f'recolor_jobs{{state="{state.value}"}} {states.count(state)}')
+
+        cache_metrics = [
+            ('mask_cache', self.mask_store.stats(), ['hits', 'misses', 'evictions'], ['entries', 'bytes']),
+            ('memory_cache', self.cache.stats(),
+             ['hits', 'disk_hits', 'misses', 'evictions', 'spills'], ['entries', 'bytes']),
+            ('result_cache', self.get_result_cache_stats(),
+             ['hits', 'misses', 'evictions', 'prerendered'], ['entries', 'bytes']),
+        ]
+        for cache_name, cache_stats, counters, gauges in cache_metrics:
+            for name in counters + gauges:
+                metric_type = 'counter' if name in counters else 'gauge'
+                metric = f"recolor_{cache_name}_{name}" + ("_total" if metric_type == 'counter' else "")
+                lines.append(f"# TYPE {metric} {metric_type}")
+                lines.append(f"{metric} {cache_stats[name]}")
+
+        return render_prometheus('recolor') + "\n".join(lines) + "\n"
+
     def get_current_uuid(self) -> Optional[str]:
-        """Get the current image UUID."""
-        return self.current_uuid
\ No newline at end of file
+        """Get the most recently uploaded image UUID."""
+        return self.current_uuid
+
+    def shutdown(self, wait: bool = True):
+        """Stop the workers and speculative renders, finish pending output writes and close the mask client."""
+        with self.jobs_lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.prerender_cancelled.set()
+        self.executor.shutdown(wait=wait)
+        for job in jobs:
+            # Jobs finishing during the shutdown may have scheduled one more
+            job.prerender_cancelled.set()
+            if job.prerender is not None:
+                job.prerender.cancel()
+        self.prerender_executor.shutdown(wait=wait)
+        self.output_writer.shutdown(wait=wait)
+        self.mask_client.close()
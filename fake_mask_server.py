@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from dataclasses import dataclass, asdict
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+import cv2
+import numpy as np
+from mask_cache import hash_image
+
+@dataclass
+class FakeMaskConfig:
+    """
+    Behaviour of the fake masking server.
+    mode selects how masks are made:
+      - 'ellipse': a centered ellipse covering the middle of the frame
+      - 'color_key': pixels within key_tolerance (per BGR channel) of key_color
+      - 'mask_dir': precomputed <content hash>.png masks from mask_dir, looked
+        up by the hash of the decoded upload (see register_mask), with
+        optional <content hash>_parts.png part label maps
+    Part label maps (format=parts) are empty except in 'mask_dir' mode.
+    Latency is latency_ms plus up to latency_jitter_ms plus latency_per_mp_ms
+    per megapixel of the upload. A fraction error_rate of requests fail with
+    error_status; beyond max_concurrent requests in flight the server answers
+    429 with Retry-After, like the real server's admission control.
+    """
+    mode: str = 'ellipse'
+    mask_dir: Optional[str] = None
+    key_color: Tuple[int, int, int] = (0, 255, 0)
+    key_tolerance: int = 40
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    latency_per_mp_ms: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+    max_concurrent: int = 32
+    seed: int = 0
+
+def read_upload(content_type: str, body: bytes) -> Optional[bytes]:
+    """Payload of the first file of a multipart/form-data body."""
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    for part in message.iter_parts():
+        if part.get_filename() is not None:
+            return part.get_payload(decode=True)
+    return None
+
+def register_mask(
+    mask_dir: str,
+    image: np.ndarray,
+    mask: np.ndarray,
+    part_labels: Optional[np.ndarray] = None
+):
+    """
+    Make a 'mask_dir' server answer uploads of `image` (decoded pixels) with
+    `mask`, and with `part_labels` (part id + 1, 0 for no part) for format=parts.
+    """
+    os.makedirs(mask_dir, exist_ok=True)
+    cv2.imwrite(os.path.join(mask_dir, f"{hash_image(image)}.png"), mask)
+    if part_labels is not None:
+        cv2.imwrite(os.path.join(mask_dir, f"{hash_image(image)}_parts.png"), part_labels)
+
+def make_mask(image: np.ndarray, config: FakeMaskConfig) -> np.ndarray:
+    """Deterministic mask of a decoded BGR image according to config.mode."""
+    height, width = image.shape[:2]
+    if config.mode == 'ellipse':
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.ellipse(mask, (width // 2, height // 2), (width // 3, height // 4), 0, 0, 360, 255, -1)
+        return mask
+
+    if config.mode == 'color_key':
+        key = np.array(config.key_color, dtype=np.int16)
+        lower = np.clip(key - config.key_tolerance, 0, 255).astype(np.uint8)
+        upper = np.clip(key + config.key_tolerance, 0, 255).astype(np.uint8)
+        return cv2.inRange(image, lower, upper)
+
+    if config.mode == 'mask_dir':
+        mask_path = os.path.join(config.mask_dir, f"{hash_image(image)}.png")
+        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE) if os.path.exists(mask_path) else None
+        if mask is None:
+            raise KeyError("No mask registered for this image")
+        return mask
+
+    raise ValueError(f"Unknown mode '{config.mode}'")
+
+def make_part_labels(image: np.ndarray, config: FakeMaskConfig) -> np.ndarray:
+    """Part label map of a decoded BGR image: the registered one in 'mask_dir' mode, else empty."""
+    if config.mode == 'mask_dir':
+        labels_path = os.path.join(config.mask_dir, f"{hash_image(image)}_parts.png")
+        if os.path.exists(labels_path):
+            return cv2.imread(labels_path, cv2.IMREAD_GRAYSCALE)
+    return np.zeros(image.shape[:2], dtype=np.uint8)
+
+class FakeMaskHandler(BaseHTTPRequestHandler):
+    """/generate_mask, /health and /metrics of the fake masking server."""
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self) -> FakeMaskConfig:
+        return self.server.config
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+        self._send(status, json.dumps(payload).encode(), 'application/json', headers)
+
+    def _count(self, name: str):
+        with self.server.lock:
+            self.server.stats[name] += 1
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            with self.server.lock:
+                stats = dict(self.server.stats, active=self.server.active)
+            self._send_json(200, {'status': 'healthy', 'config': asdict(self.config), **stats})
+        elif path == '/metrics':
+            with self.server.lock:
+                lines = [f"fake_mask_active {self.server.active}"]
+                lines += [f"fake_mask_{name} {value}" for name, value in self.server.stats.items()]
+            self._send(200, ("\n".join(lines) + "\n").encode(), 'text/plain')
+        else:
+            self._send_json(404, {'detail': 'Not Found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/generate_mask':
+            self._send_json(404, {'detail': 'Not Found'})
+            return
+
+        with self.server.lock:
+            self.server.stats['requests_total'] += 1
+            if self.server.active >= self.config.max_concurrent:
+                self.server.stats['rejected_total'] += 1
+                admitted = False
+            else:
+                self.server.active += 1
+                admitted = True
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not admitted:
+            self._send_json(429, {'detail': 'Mask queue is full, retry later'}, {'Retry-After': '1'})
+            return
+
+        try:
+            self._generate(url, body)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def _generate(self, url, body: bytes):
+        """Decode the upload, apply the configured latency and failures, and answer with the mask."""
+        start = time.perf_counter()
+        upload = read_upload(self.headers.get('Content-Type', ''), body)
+        image = cv2.imdecode(np.frombuffer(upload or b'', np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            self._send_json(400, {'detail': "Could not decode image. Please ensure it's a valid image file."})
+            return
+
+        with self.server.lock:
+            inject_error = self.server.rng.random() < self.config.error_rate
+            jitter = self.server.rng.random() * self.config.latency_jitter_ms
+
+        megapixels = image.shape[0] * image.shape[1] / 1e6
+        latency = (self.config.latency_ms + jitter + self.config.latency_per_mp_ms * megapixels) / 1000.0
+
+        try:
+            mask = None if inject_error else make_mask(image, self.config)
+        except KeyError as e:
+            # Unknown image in mask_dir mode: a client error, not worth retrying
+            self._send_json(400, {'detail': e.args[0]})
+            return
+        except Exception as e:
+            self._send_json(500, {'detail': str(e)})
+            return
+
+        time.sleep(max(0.0, latency - (time.perf_counter() - start)))
+
+        if inject_error:
+            self._count('errors_injected_total')
+            self._send_json(self.config.error_status, {'detail': 'Injected failure'})
+            return
+
+        _, buffer = cv2.imencode('.png', mask)
+        self._count('masks_total')
+        response_format = parse_qs(url.query).get('format')
+        if response_format == ['parts']:
+            _, labels = cv2.imencode('.png', make_part_labels(image, self.config))
+            self._send(200, buffer.tobytes() + labels.tobytes(), 'application/octet-stream',
+                       {'X-Mask-Length': str(len(buffer))})
+        elif response_format == ['png']:
+            self._send(200, buffer.tobytes(), 'image/png')
+        else:
+            self._send_json(200, {'status': 'success', 'mask': base64.b64encode(buffer.tobytes()).decode()})
+
+def create_fake_server(config: FakeMaskConfig, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """Bind a fake masking server; port=0 picks a free port (see server.server_address)."""
+    server = ThreadingHTTPServer((host, port), FakeMaskHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.lock = threading.Lock()
+    server.rng = random.Random(config.seed)
+    server.active = 0
+    server.stats = {
+        'requests_total': 0,
+        'masks_total': 0,
+        'rejected_total': 0,
+        'errors_injected_total': 0,
+    }
+    return server
+
+def start_fake_server(config: Optional[FakeMaskConfig] = None, port: int = 0) -> ThreadingHTTPServer:
+    """Serve fake masks on localhost in a background thread. Call server.shutdown() to stop."""
+    server = create_fake_server(config or FakeMaskConfig(), port=port)
+    threading.Thread(target=server.serve_forever, name='fake-mask-server', daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake masking server for offline testing and load generation.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=['ellipse', 'color_key', 'mask_dir'], default='ellipse')
+    parser.add_argument('--mask-dir', help="Directory of <content hash>.png masks (mask_dir mode)")
+    parser.add_argument('--key-color', default='0,255,0', help="B,G,R key color (color_key mode)")
+    parser.add_argument('--key-tolerance', type=int, default=40)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--latency-per-mp-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--max-concurrent', type=int, default=32, help="Requests in flight before answering 429")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.mode == 'mask_dir' and not args.mask_dir:
+        parser.error("--mask-dir is required in mask_dir mode")
+
+    config = FakeMaskConfig(
+        mode=args.mode,
+        mask_dir=args.mask_dir,
+        key_color=tuple(int(value) for value in args.key_color.split(',')),
+        key_tolerance=args.key_tolerance,
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        latency_per_mp_ms=args.latency_per_mp_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        max_concurrent=args.max_concurrent,
+        seed=args.seed,
+    )
+    server = create_fake_server(config, args.host, args.port)
+    print(f"Fake masking server ({config.mode}) on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
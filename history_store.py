@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from output_encoding import EncodedOutput, write_bytes
+
+def _file_safe(name: str) -> str:
+    """name with anything but letters, digits, '-' and '_' replaced, for use in a filename."""
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)
+
+# Version of the index schema, in SQLite's user_version
+SCHEMA_VERSION = 1
+
+class HistoryStore:
+    """
+    Bounded processing history in <base_dir>/history.
+    Entries live in a SQLite index holding a reference to the recolored
+    output on disk and small thumbnails of the original and the result, so
+    a long session costs a few kilobytes per entry instead of full images.
+    Each entry belongs to an owner (e.g. the app's session id), and every
+    method only sees the given owner's entries. Recoloring the same image
+    with the same color again replaces its entry. Beyond max_items per owner,
+    or max_total_items overall (abandoned sessions), the oldest entries are
+    dropped, with the outputs the store wrote itself.
+    """
+
+    def __init__(self, base_dir: str, max_items: int = 10, max_total_items: int = 1000):
+        self.history_dir = os.path.join(base_dir, 'history')
+        os.makedirs(self.history_dir, exist_ok=True)
+        self.db_path = os.path.join(self.history_dir, 'history.sqlite3')
+        self.max_items = max_items
+        self.max_total_items = max_total_items
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                # Entries of the unversioned schema have no owner, so nobody could see them
+                try:
+                    legacy = connection.execute("SELECT output_path, owns_output FROM entries").fetchall()
+                except sqlite3.OperationalError:
+                    legacy = []
+                connection.execute("DROP TABLE IF EXISTS entries")
+                connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                self._remove_outputs(legacy)
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    owner TEXT NOT NULL,
+                    image_uuid TEXT NOT NULL,
+                    color TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    output_path TEXT NOT NULL,
+                    owns_output INTEGER NOT NULL,
+                    mime_type TEXT NOT NULL,
+                    thumbnail BLOB NOT NULL,
+                    original_thumbnail BLOB,
+                    settings TEXT NOT NULL,
+                    UNIQUE (owner, image_uuid, color)
+                )
+                """
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_owner ON entries (owner, created_at)")
+
+    @contextmanager
+    def _connect(self):
+        """Transaction on a new connection; sqlite3 connections are not shared between threads."""
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _remove_outputs(self, rows: List[sqlite3.Row]):
+        """Delete the output files the store wrote for dropped entries."""
+        for row in rows:
+            if row['owns_output']:
+                try:
+                    os.remove(row['output_path'])
+                except OSError:
+                    pass
+
+    def add(
+        self,
+        owner: str,
+        image_uuid: str,
+        color: str,
+        output: EncodedOutput,
+        output_path: Optional[str] = None,
+        original_thumbnail: Optional[bytes] = None,
+        settings: Optional[Dict[str, Any]] = None,
+        max_items: Optional[int] = None
+    ) -> int:
+        """
+        Record a result of owner and return its entry id. output_path
+        references an output already saved elsewhere (e.g. a full-resolution
+        render); without it output.full is saved in the history directory. An
+        entry of owner for the same image and color is replaced. The owner's
+        history is then trimmed to max_items (default self.max_items).
+        """
+        color = color.upper()
+        if output_path is None:
+            owns_output = True
+            output_path = os.path.join(
+                self.history_dir,
+                f"{_file_safe(owner)}_{os.path.splitext(image_uuid)[0]}_{color.lstrip('#')}{output.extension}"
+            )
+            write_bytes(output_path, output.full)
+        else:
+            owns_output = False
+
+        with self._lock, self._connect() as connection:
+            previous = connection.execute(
+                "SELECT output_path, owns_output FROM entries WHERE owner = ? AND image_uuid = ? AND color = ?",
+                (owner, image_uuid, color)
+            ).fetchall()
+            connection.execute(
+                """
+                INSERT INTO entries (owner, image_uuid, color, created_at, output_path, owns_output,
+                                     mime_type, thumbnail, original_thumbnail, settings)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (owner, image_uuid, color) DO UPDATE SET
+                    created_at = excluded.created_at,
+                    output_path = excluded.output_path,
+                    owns_output = excluded.owns_output,
+                    mime_type = excluded.mime_type,
+                    thumbnail = excluded.thumbnail,
+                    original_thumbnail = COALESCE(excluded.original_thumbnail, original_thumbnail),
+                    settings = excluded.settings
+                """,
+                (owner, image_uuid, color, time.time(), output_path, int(owns_output), output.mime_type,
+                 output.thumbnail, original_thumbnail, json.dumps(settings or {}))
+            )
+            entry_id = connection.execute(
+                "SELECT id FROM entries WHERE owner = ? AND image_uuid = ? AND color = ?",
+                (owner, image_uuid, color)
+            ).fetchone()['id']
+        # A replaced output of the store's own is garbage unless it was overwritten in place
+        self._remove_outputs([row for row in previous if row['output_path'] != output_path])
+
+        self.trim(owner, self.max_items if max_items is None else max_items)
+        self._trim("", (), self.max_total_items)
+        return entry_id
+
+    def _trim(self, where: str, params: tuple, max_items: int) -> int:
+        """Drop the oldest entries matching where beyond max_items."""
+        with self._lock, self._connect() as connection:
+            dropped = connection.execute(
+                f"SELECT id, output_path, owns_output FROM entries {where} "
+                "ORDER BY created_at DESC LIMIT -1 OFFSET ?",
+                (*params, max(max_items, 0))
+            ).fetchall()
+            connection.executemany("DELETE FROM entries WHERE id = ?", [(row['id'],) for row in dropped])
+        self._remove_outputs(dropped)
+        return len(dropped)
+
+    def trim(self, owner: str, max_items: int) -> int:
+        """Drop the oldest entries of owner beyond max_items; returns how many were dropped."""
+        return self._trim("WHERE owner = ?", (owner,), max_items)
+
+    def count(self, owner: str) -> int:
+        """Number of entries of owner."""
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM entries WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def page(self, owner: str, page: int = 0, page_size: int = 5) -> List[Dict[str, Any]]:
+        """Entries of owner on one page, newest first, with their thumbnails but not their outputs."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT * FROM entries WHERE owner = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (owner, page_size, page * page_size)
+            ).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(row)
+            entry['settings'] = json.loads(entry['settings'])
+            entries.append(entry)
+        return entries
+
+    def read_output(self, entry: Dict[str, Any]) -> Optional[bytes]:
+        """Encoded output of an entry, or None if its file is gone."""
+        try:
+            with open(entry['output_path'], 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def clear(self, owner: str):
+        """Drop every entry of owner."""
+        self.trim(owner, 0)
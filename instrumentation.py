@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Set RECOLOR_INSTRUMENTATION=0 to turn every span into a shared no-op
+ENABLED = os.environ.get("RECOLOR_INSTRUMENTATION", "1").lower() not in ("0", "false", "no", "off")
+
+_NOOP = nullcontext()
+_local = threading.local()
+_lock = threading.Lock()
+_stage_totals: Dict[str, Dict[str, float]] = {}
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident set size of this process so far, if the platform exposes it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _collectors() -> List[List[Dict[str, Any]]]:
+    """Span collectors active on the current thread, innermost last."""
+    collectors = getattr(_local, "collectors", None)
+    if collectors is None:
+        collectors = _local.collectors = []
+    return collectors
+
+def _record(stage: str, wall: float, cpu: float, peak_rss: Optional[int], rss_growth: Optional[int]):
+    """Add a finished span to the process-wide totals and to the thread's collectors."""
+    with _lock:
+        totals = _stage_totals.get(stage)
+        if totals is None:
+            totals = _stage_totals[stage] = {
+                "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "wall_seconds_max": 0.0
+            }
+        totals["calls"] += 1
+        totals["wall_seconds"] += wall
+        totals["cpu_seconds"] += cpu
+        totals["wall_seconds_max"] = max(totals["wall_seconds_max"], wall)
+
+    collectors = _collectors()
+    if collectors:
+        entry = {
+            "stage": stage,
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(cpu, 6),
+            "peak_rss_bytes": peak_rss,
+            "rss_growth_bytes": rss_growth,
+        }
+        for collector in collectors:
+            collector.append(entry)
+
+class _Span:
+    """Measures wall time, process CPU time and peak RSS growth of a block."""
+    __slots__ = ("stage", "wall", "cpu", "rss")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.rss = peak_rss_bytes()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        rss = peak_rss_bytes()
+        growth = rss - self.rss if rss is not None and self.rss is not None else None
+        _record(self.stage, wall, cpu, rss, growth)
+        return False
+
+def span(stage: str):
+    """
+    Context manager timing one pipeline stage. CPU time is process-wide, so it
+    includes the library worker threads of the stage (and, under concurrency,
+    other requests). Returns a shared no-op when instrumentation is disabled.
+    """
+    if not ENABLED:
+        return _NOOP
+    return _Span(stage)
+
+@contextmanager
+def collect():
+    """Collect the spans finished on this thread inside the block, in completion order."""
+    spans: List[Dict[str, Any]] = []
+    if not ENABLED:
+        yield spans
+        return
+
+    collectors = _collectors()
+    collectors.append(spans)
+    try:
+        yield spans
+    finally:
+        collectors.remove(spans)
+
+def stage_totals() -> Dict[str, Dict[str, float]]:
+    """Process-wide call count, wall/CPU seconds and slowest call per stage."""
+    with _lock:
+        return {stage: dict(totals) for stage, totals in _stage_totals.items()}
+
+def reset():
+    """Forget the process-wide stage totals."""
+    with _lock:
+        _stage_totals.clear()
+
+def render_prometheus(prefix: str) -> str:
+    """Prometheus text exposition of the stage totals and the process peak RSS."""
+    totals = stage_totals()
+    metrics = [
+        ("stage_calls_total", "counter", "calls"),
+        ("stage_wall_seconds_total", "counter", "wall_seconds"),
+        ("stage_cpu_seconds_total", "counter", "cpu_seconds"),
+        ("stage_wall_seconds_max", "gauge", "wall_seconds_max"),
+    ]
+
+    lines = []
+    for name, metric_type, key in metrics:
+        metric = f"{prefix}_{name}"
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for stage, values in sorted(totals.items()):
+            lines.append(f'{metric}{{stage="{stage}"}} {values[key]}')
+
+    peak = peak_rss_bytes()
+    if peak is not None:
+        lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+        lines.append(f"{prefix}_peak_rss_bytes {peak}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,197 @@
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+import cv2
+import numpy as np
+from benchmarks.synthetic import make_car_image
+from car_recolor_service import CarRecolorService
+from fake_mask_server import FakeMaskConfig, start_fake_server
+
+COLORS = [(200, 30, 40), (20, 60, 200), (30, 160, 60), (240, 240, 240), (15, 15, 15), (250, 170, 20)]
+
+class LatencyLog:
+    """Thread-safe record of operation latencies and failures."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.failures: Dict[str, int] = {}
+
+    def record(self, operation: str, seconds: float, success: bool):
+        with self._lock:
+            self.samples.setdefault(operation, [])
+            self.failures.setdefault(operation, 0)
+            if success:
+                self.samples[operation].append(seconds)
+            else:
+                self.failures[operation] += 1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, failures and latency percentiles (seconds) per operation."""
+        summary = {}
+        with self._lock:
+            for operation, samples in self.samples.items():
+                values = np.array(samples) if samples else np.array([np.nan])
+                summary[operation] = {
+                    'count': len(samples),
+                    'failures': self.failures[operation],
+                    'p50': float(np.percentile(values, 50)),
+                    'p90': float(np.percentile(values, 90)),
+                    'p99': float(np.percentile(values, 99)),
+                    'max': float(np.max(values)),
+                }
+        return summary
+
+def _simulate_user(
+    service: CarRecolorService,
+    uploads: List[bytes],
+    colors_per_upload: int,
+    mode: str,
+    wait_timeout: float,
+    log: LatencyLog
+):
+    """One user: upload each image, wait for it to be ready, then recolor it in several colors."""
+    for image_bytes in uploads:
+        start = time.perf_counter()
+        image_uuid = service.process_new_image(image_bytes, 'car.png')
+        job = service.get_job(image_uuid)
+        ready = job.processing_complete.wait(wait_timeout) and job.error is None
+        log.record('upload_to_ready', time.perf_counter() - start, ready)
+        if not ready:
+            continue
+
+        for color in COLORS[:colors_per_upload]:
+            if mode in ('preview', 'both'):
+                start = time.perf_counter()
+                result = service.preview_image(image_uuid, color, wait_timeout)
+                log.record('preview', time.perf_counter() - start, result['success'])
+            if mode in ('full', 'both'):
+                start = time.perf_counter()
+                result = service.recolor_image(image_uuid, color, wait_timeout)
+                log.record('full_recolor', time.perf_counter() - start, result['success'])
+
+def run_load_test(
+    api_url: str,
+    users: int = 4,
+    uploads_per_user: int = 2,
+    colors_per_upload: int = 3,
+    megapixels: float = 2.0,
+    mode: str = 'both',
+    service_workers: int = 4,
+    analysis_params: Optional[Dict[str, Any]] = None,
+    reuse_images: bool = False,
+    wait_timeout: float = 300.0
+) -> Dict[str, Any]:
+    """
+    Push concurrent users through a fresh CarRecolorService against api_url.
+    Every upload is a distinct synthetic image unless reuse_images is set, in
+    which case all users upload the same photo (exercising the mask and
+    analysis caches). Returns latency percentiles per operation.
+    """
+    # Encode every upload before the clock starts
+    encoded: Dict[int, bytes] = {}
+    user_uploads = []
+    for user in range(users):
+        uploads = []
+        for index in range(uploads_per_user):
+            seed = 0 if reuse_images else user * uploads_per_user + index
+            if seed not in encoded:
+                image, _ = make_car_image(megapixels, seed=seed)
+                encoded[seed] = cv2.imencode('.png', image)[1].tobytes()
+            uploads.append(encoded[seed])
+        user_uploads.append(uploads)
+
+    base_dir = tempfile.mkdtemp(prefix='recolor-load-')
+    service = CarRecolorService(base_dir, api_url, analysis_params=analysis_params, max_workers=service_workers)
+    log = LatencyLog()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=users, thread_name_prefix='load-user') as executor:
+            futures = [
+                executor.submit(_simulate_user, service, uploads, colors_per_upload, mode, wait_timeout, log)
+                for uploads in user_uploads
+            ]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+        cache_stats = service.get_cache_stats()
+    finally:
+        service.shutdown()
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    return {
+        'elapsed_seconds': elapsed,
+        'operations': log.summary(),
+        'mask_cache': cache_stats,
+    }
+
+def print_report(report: Dict[str, Any]):
+    """Latency percentiles and throughput per operation."""
+    print(f"\nElapsed: {report['elapsed_seconds']:.1f}s")
+    print(f"{'operation':<16} {'count':>6} {'fail':>5} {'ops/s':>7} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'max s':>8}")
+    for operation, stats in report['operations'].items():
+        throughput = stats['count'] / report['elapsed_seconds']
+        print(f"{operation:<16} {stats['count']:>6} {stats['failures']:>5} {throughput:>7.2f} "
+              f"{stats['p50']:>8.3f} {stats['p90']:>8.3f} {stats['p99']:>8.3f} {stats['max']:>8.3f}")
+    cache = report['mask_cache']
+    print(f"Mask cache: {cache['hits']} hits, {cache['misses']} misses")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test CarRecolorService with concurrent simulated users.")
+    parser.add_argument('--api-url', help="Masking server to use; by default a fake server is started in-process")
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--uploads', type=int, default=2, help="Uploads per user")
+    parser.add_argument('--colors', type=int, default=3, help=f"Recolors per upload (at most {len(COLORS)})")
+    parser.add_argument('--megapixels', type=float, default=2.0)
+    parser.add_argument('--mode', choices=['preview', 'full', 'both'], default='both')
+    parser.add_argument('--service-workers', type=int, default=4, help="CarRecolorService background workers")
+    parser.add_argument('--k', type=int, default=200, help="Analysis cluster count")
+    parser.add_argument('--backend', default='kmeans', help="Analysis backend")
+    parser.add_argument('--reuse-images', action='store_true', help="All users upload the same image")
+    parser.add_argument('--latency-ms', type=float, default=500.0, help="Fake server base latency")
+    parser.add_argument('--latency-jitter-ms', type=float, default=200.0)
+    parser.add_argument('--latency-per-mp-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fake server failure fraction")
+    parser.add_argument('--max-concurrent', type=int, default=8, help="Fake server requests in flight before 429")
+    args = parser.parse_args()
+
+    server = None
+    api_url = args.api_url
+    if api_url is None:
+        server = start_fake_server(FakeMaskConfig(
+            latency_ms=args.latency_ms,
+            latency_jitter_ms=args.latency_jitter_ms,
+            latency_per_mp_ms=args.latency_per_mp_ms,
+            error_rate=args.error_rate,
+            max_concurrent=args.max_concurrent,
+        ))
+        api_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        report = run_load_test(
+            api_url,
+            users=args.users,
+            uploads_per_user=args.uploads,
+            colors_per_upload=args.colors,
+            megapixels=args.megapixels,
+            mode=args.mode,
+            service_workers=args.service_workers,
+            analysis_params={'k': args.k, 'backend': args.backend},
+            reuse_images=args.reuse_images,
+        )
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    print_report(report)
+    if server is not None:
+        stats = server.stats
+        print(f"Fake server: {stats['requests_total']} requests, {stats['rejected_total']} rejected (429), "
+              f"{stats['errors_injected_total']} injected errors")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import os
+import json
+import hashlib
+import threading
+import uuid
+from typing import Dict, Optional, Any
+import cv2
+import numpy as np
+
+def hash_image(image: np.ndarray) -> str:
+    """Content hash of a decoded image (shape, dtype and pixels), independent of its file encoding."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.shape}{image.dtype}".encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+class MaskStore:
+    """
+    Content-addressed mask cache in <base_dir>/masks.
+    Masks are stored as <content hash>_mask.png so identical photos share one
+    mask no matter how often or by whom they are uploaded; upload UUIDs are
+    kept as aliases of the content hash. Part maps, when the server provides
+    them, are kept next to the mask as <content hash>_parts.png. Masks edited
+    by a user are kept per upload as <upload UUID>_edit.png, leaving the
+    shared mask of the photo untouched. The directory is bounded to max_bytes by evicting the least recently used
+    entries (file mtime is refreshed on every hit).
+    """
+
+    def __init__(self, base_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        self.masks_dir = os.path.join(base_dir, 'masks')
+        os.makedirs(self.masks_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.masks_dir, 'aliases.json')
+        self._lock = threading.Lock()
+        self._aliases: Dict[str, str] = self._load_aliases()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load_aliases(self) -> Dict[str, str]:
+        """Read the UUID -> content hash index."""
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_aliases(self):
+        """Atomically write the alias index. Caller holds the lock."""
+        temp_path = f"{self.index_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self._aliases, f)
+        os.replace(temp_path, self.index_path)
+
+    def mask_path(self, content_hash: str) -> str:
+        """Path of the mask stored for a content hash."""
+        return os.path.join(self.masks_dir, f"{content_hash}_mask.png")
+
+    def parts_path(self, content_hash: str) -> str:
+        """Path of the part map stored for a content hash."""
+        return os.path.join(self.masks_dir, f"{content_hash}_parts.png")
+
+    def edit_path(self, image_uuid: str) -> str:
+        """Path of the edited mask of an upload."""
+        return os.path.join(self.masks_dir, f"{os.path.splitext(image_uuid)[0]}_edit.png")
+
+    @staticmethod
+    def edit_name(image_uuid: str) -> str:
+        """Name the derived files (analysis) of an upload with an edited mask are stored under."""
+        return f"{os.path.splitext(image_uuid)[0]}_edit"
+
+    def storage_name(self, image_uuid: str) -> Optional[str]:
+        """Name the mask-derived files of an upload are stored under: its edit's, else its content hash."""
+        if os.path.exists(self.edit_path(image_uuid)):
+            return self.edit_name(image_uuid)
+        return self.resolve(image_uuid)
+
+    def resolve(self, image_uuid: str) -> Optional[str]:
+        """Content hash an upload UUID is aliased to, if known."""
+        with self._lock:
+            return self._aliases.get(image_uuid)
+
+    def register(self, image_uuid: str, image: np.ndarray) -> str:
+        """Alias an upload UUID to the content hash of its decoded image and return the hash."""
+        content_hash = hash_image(image)
+        with self._lock:
+            if self._aliases.get(image_uuid) != content_hash:
+                self._aliases[image_uuid] = content_hash
+                self._save_aliases()
+        return content_hash
+
+    def get(self, content_hash: str) -> Optional[np.ndarray]:
+        """Load the cached mask for a content hash, counting the hit or miss."""
+        path = self.mask_path(content_hash)
+        mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE) if os.path.exists(path) else None
+
+        with self._lock:
+            if mask is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return mask
+
+    def get_parts(self, content_hash: str) -> Optional[np.ndarray]:
+        """Load the cached part map for a content hash."""
+        path = self.parts_path(content_hash)
+        part_map = cv2.imread(path, cv2.IMREAD_GRAYSCALE) if os.path.exists(path) else None
+        if part_map is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return part_map
+
+    def get_edit(self, image_uuid: str) -> Optional[np.ndarray]:
+        """Load the edited mask of an upload, if any."""
+        path = self.edit_path(image_uuid)
+        mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE) if os.path.exists(path) else None
+        if mask is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return mask
+
+    def _write(self, path: str, image: np.ndarray) -> bool:
+        """Write a PNG atomically, then evict down to the size budget."""
+        try:
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp.png"
+            if not cv2.imwrite(temp_path, image):
+                return False
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f"Error saving mask: {str(e)}")
+            return False
+
+        self.evict()
+        return True
+
+    def put(self, content_hash: str, mask: np.ndarray) -> bool:
+        """Store a mask for a content hash, then evict down to the size budget."""
+        return self._write(self.mask_path(content_hash), mask)
+
+    def put_parts(self, content_hash: str, part_map: np.ndarray) -> bool:
+        """Store a part map for a content hash, then evict down to the size budget."""
+        return self._write(self.parts_path(content_hash), part_map)
+
+    def put_edit(self, image_uuid: str, mask: np.ndarray) -> bool:
+        """Store the edited mask of an upload, then evict down to the size budget."""
+        return self._write(self.edit_path(image_uuid), mask)
+
+    def _entries(self) -> Dict[str, list]:
+        """[last use, total bytes, paths] of the files of every cached content hash (or edited upload)."""
+        entries: Dict[str, list] = {}
+        for entry in os.scandir(self.masks_dir):
+            for suffix in ('_mask.png', '_parts.png', '_edit.png'):
+                if entry.is_file() and entry.name.endswith(suffix):
+                    stat = entry.stat()
+                    cached = entries.setdefault(entry.name[:-len(suffix)], [0.0, 0, []])
+                    cached[0] = max(cached[0], stat.st_mtime)
+                    cached[1] += stat.st_size
+                    cached[2].append(entry.path)
+        return entries
+
+    def evict(self):
+        """Delete least recently used masks and part maps until the directory fits in max_bytes."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries.values())
+        if total <= self.max_bytes:
+            return
+
+        evicted = set()
+        for content_hash, (_, size, paths) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                for path in paths:
+                    os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted.add(content_hash)
+
+        with self._lock:
+            self.evictions += len(evicted)
+            stale = [key for key, value in self._aliases.items() if value in evicted]
+            for key in stale:
+                del self._aliases[key]
+            if stale:
+                self._save_aliases()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters and current size of the mask cache."""
+        sizes = [size for _, size, _ in self._entries().values()]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(sizes),
+                'bytes': sum(sizes),
+                'max_bytes': self.max_bytes,
+                'aliases': len(self._aliases),
+            }
@@ -0,0 +1,964 @@
+import os
+import time
+import base64
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, List, Dict, Optional, Union, Tuple
+import cv2
+import torch
+import requests
+import numpy as np
+from PIL import Image
+from transformers import AutoModelForMaskGeneration, AutoProcessor, pipeline
+from detectron2.engine import DefaultPredictor
+from detectron2.config import get_cfg
+from detectron2 import model_zoo
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response
+import uvicorn
+from instrumentation import span, render_prometheus
+from car_parts import build_part_labels, category_mapping_parts, id_to_part_name, unpaintable_parts
+
+# Server configuration, overridable through the environment
+MODEL_PATH = os.environ.get("MODEL_PATH", "car_part_model.pth")
+DETECTOR_ID = os.environ.get("DETECTOR_ID", "IDEA-Research/grounding-dino-tiny")
+SEGMENTER_ID = os.environ.get("SEGMENTER_ID", "facebook/sam-vit-base")
+LABELS = ["car"]
+THRESHOLD = 0.8
+# torch intra-op / inter-op thread counts for CPU inference (0 keeps torch's default)
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", "0"))
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", "0"))
+WARMUP_MODELS = os.environ.get("WARMUP_MODELS", "1") == "1"
+# Micro-batching: concurrent requests arriving within BATCH_WAIT_MS are run together
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+BATCH_WAIT_MS = float(os.environ.get("BATCH_WAIT_MS", "20"))
+# Inference threads, queued/in-flight image limit before answering 429, and decode/encode threads
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", "32"))
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "4"))
+
+@dataclass
+class BoundingBox:
+    xmin: int
+    ymin: int
+    xmax: int
+    ymax: int
+
+    @property
+    def xyxy(self) -> List[float]:
+        return [self.xmin, self.ymin, self.xmax, self.ymax]
+
+@dataclass
+class DetectionResult:
+    score: float
+    label: str
+    box: BoundingBox
+    mask: Optional[np.array] = None
+
+    @classmethod
+    def from_dict(cls, detection_dict: Dict) -> 'DetectionResult':
+        return cls(score=detection_dict['score'],
+                   label=detection_dict['label'],
+                   box=BoundingBox(xmin=detection_dict['box']['xmin'],
+                                   ymin=detection_dict['box']['ymin'],
+                                   xmax=detection_dict['box']['xmax'],
+                                   ymax=detection_dict['box']['ymax']))
+
+def get_device() -> str:
+    """Device used for inference."""
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def configure_torch_threads(num_threads: int = TORCH_NUM_THREADS, interop_threads: int = TORCH_INTEROP_THREADS):
+    """Set torch CPU thread counts; 0 leaves the torch default in place."""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # Only allowed before any inter-op parallel work has started
+            print(f"Could not set inter-op threads: {e}")
+
+def _process_rss_bytes() -> Optional[int]:
+    """Resident set size of this process, if the platform exposes it."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _parameter_bytes(model: Any) -> Optional[int]:
+    """Size of a torch module's parameters and buffers."""
+    if not isinstance(model, torch.nn.Module):
+        return None
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+def load_part_model(model_path, threshold=0.4):
+    """
+    Load the Detectron2 model for part detection with instance segmentation
+
+    Args:
+        model_path (str): Path to the model weights
+        threshold (float): Detection confidence threshold
+
+    Returns:
+        DefaultPredictor: Loaded Detectron2 model predictor
+    """
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file("COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"))
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = threshold
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = 21
+    cfg.MODEL.WEIGHTS = model_path
+    cfg.MODEL.DEVICE = get_device()
+    return DefaultPredictor(cfg)
+
+class ModelRegistry:
+    """
+    Loads every model once and keeps it resident for the lifetime of the
+    process. Models are keyed by id, so requests asking for the same detector,
+    segmenter or part model share one instance.
+    """
+
+    def __init__(self, device: Optional[str] = None):
+        self.device = device or get_device()
+        self._models: Dict[Tuple[str, str], Any] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.warmup_seconds: Optional[float] = None
+
+    def _get_or_load(self, kind: str, model_id: str, loader):
+        key = (kind, model_id)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                rss_before = _process_rss_bytes()
+                start = time.perf_counter()
+                model = loader()
+                load_seconds = time.perf_counter() - start
+                rss_after = _process_rss_bytes()
+
+                self._models[key] = model
+                self._stats[f"{kind}:{model_id}"] = {
+                    'load_seconds': round(load_seconds, 3),
+                    'parameter_bytes': _parameter_bytes(getattr(model, 'model', model)),
+                    'rss_delta_bytes': (
+                        rss_after - rss_before
+                        if rss_before is not None and rss_after is not None else None
+                    ),
+                }
+                print(f"Loaded {kind} '{model_id}' in {load_seconds:.1f}s")
+        return model
+
+    def detector(self, detector_id: Optional[str] = None):
+        """Grounding DINO zero-shot object detection pipeline."""
+        detector_id = detector_id or DETECTOR_ID
+        return self._get_or_load(
+            'detector', detector_id,
+            lambda: pipeline(model=detector_id, task="zero-shot-object-detection", device=self.device)
+        )
+
+    def detector_processor(self, detector_id: Optional[str] = None):
+        """Grounding DINO processor, used to run the detector on padded batches."""
+        detector_id = detector_id or DETECTOR_ID
+        return self._get_or_load(
+            'detector_processor', detector_id,
+            lambda: AutoProcessor.from_pretrained(detector_id)
+        )
+
+    def segmenter(self, segmenter_id: Optional[str] = None) -> Tuple[Any, Any]:
+        """SAM model and its processor."""
+        segmenter_id = segmenter_id or SEGMENTER_ID
+        model = self._get_or_load(
+            'segmenter', segmenter_id,
+            lambda: AutoModelForMaskGeneration.from_pretrained(segmenter_id).to(self.device).eval()
+        )
+        processor = self._get_or_load(
+            'processor', segmenter_id,
+            lambda: AutoProcessor.from_pretrained(segmenter_id)
+        )
+        return model, processor
+
+    def part_predictor(self, model_path: Optional[str] = None):
+        """Detectron2 car part predictor."""
+        model_path = model_path or MODEL_PATH
+        return self._get_or_load('parts', model_path, lambda: load_part_model(model_path))
+
+    def load_all(self):
+        """Load the default detector, segmenter and part model."""
+        self.detector()
+        self.detector_processor()
+        self.segmenter()
+        self.part_predictor()
+
+    def warmup(self):
+        """Run each model once on a dummy image so the first request does not pay for lazy initialization."""
+        start = time.perf_counter()
+        dummy = Image.new("RGB", (256, 256), (128, 128, 128))
+        with torch.inference_mode():
+            for name, run in [
+                ('detector', lambda: self.detector()(dummy, candidate_labels=["car."], threshold=THRESHOLD)),
+                ('segmenter', lambda: _run_segmenter(dummy, [[[32, 32, 224, 224]]])),
+                ('parts', lambda: self.part_predictor()(np.array(dummy)[:, :, ::-1])),
+            ]:
+                try:
+                    run()
+                except Exception as e:
+                    print(f"Warmup of {name} failed: {e}")
+        self.warmup_seconds = round(time.perf_counter() - start, 3)
+
+    def health(self) -> Dict[str, Any]:
+        """Load time and memory of every resident model."""
+        info = {
+            'device': self.device,
+            'torch_threads': torch.get_num_threads(),
+            'models': dict(self._stats),
+            'warmup_seconds': self.warmup_seconds,
+            'process_rss_bytes': _process_rss_bytes(),
+        }
+        if torch.cuda.is_available():
+            info['cuda_memory_allocated_bytes'] = torch.cuda.memory_allocated()
+        return info
+
+registry = ModelRegistry()
+
+def mask_to_polygon(mask: np.ndarray) -> List[List[int]]:
+    # Find contours in the binary mask
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # Find the contour with the largest area
+    largest_contour = max(contours, key=cv2.contourArea)
+
+    # Extract the vertices of the contour
+    polygon = largest_contour.reshape(-1, 2).tolist()
+
+    return polygon
+
+def polygon_to_mask(polygon: List[Tuple[int, int]], image_shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Convert a polygon to a segmentation mask.
+
+    Args:
+    - polygon (list): List of (x, y) coordinates representing the vertices of the polygon.
+    - image_shape (tuple): Shape of the image (height, width) for the mask.
+
+    Returns:
+    - np.ndarray: Segmentation mask with the polygon filled.
+    """
+    # Create an empty mask
+    mask = np.zeros(image_shape, dtype=np.uint8)
+
+    # Convert polygon to an array of points
+    pts = np.array(polygon, dtype=np.int32)
+
+    # Fill the polygon with white color (255)
+    cv2.fillPoly(mask, [pts], color=(255,))
+
+    return mask
+
+def load_image(image_str: str) -> Image.Image:
+    if image_str.startswith("http"):
+        image = Image.open(requests.get(image_str, stream=True).raw).convert("RGB")
+    else:
+        image = Image.open(image_str).convert("RGB")
+
+    return image
+
+def get_boxes(results: DetectionResult) -> List[List[List[float]]]:
+    boxes = []
+    for result in results:
+        xyxy = result.box.xyxy
+        boxes.append(xyxy)
+
+    return [boxes]
+
+def refine_masks(masks: torch.BoolTensor, polygon_refinement: bool = False) -> List[np.ndarray]:
+    masks = masks.cpu().float()
+    masks = masks.permute(0, 2, 3, 1)
+    masks = masks.mean(axis=-1)
+    masks = (masks > 0).int()
+    masks = masks.numpy().astype(np.uint8)
+    masks = list(masks)
+
+    if polygon_refinement:
+        for idx, mask in enumerate(masks):
+            shape = mask.shape
+            polygon = mask_to_polygon(mask)
+            mask = polygon_to_mask(polygon, shape)
+            masks[idx] = mask
+
+    return masks
+
+def detect(
+    image: Image.Image,
+    labels: List[str],
+    threshold: float = 0.3,
+    detector_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Use Grounding DINO to detect a set of labels in an image in a zero-shot fashion.
+    """
+    object_detector = registry.detector(detector_id)
+
+    labels = [label if label.endswith(".") else label+"." for label in labels]
+
+    with torch.inference_mode():
+        results = object_detector(image,  candidate_labels=labels, threshold=threshold)
+    results = [DetectionResult.from_dict(result) for result in results]
+
+    return results
+
+def _run_segmenter(image: Image.Image, boxes: List[List[List[float]]], segmenter_id: Optional[str] = None):
+    """Run SAM on an image for the given boxes and return the post-processed masks."""
+    segmentator, processor = registry.segmenter(segmenter_id)
+
+    inputs = processor(images=image, input_boxes=boxes, return_tensors="pt").to(registry.device)
+
+    with torch.inference_mode():
+        outputs = segmentator(**inputs)
+    masks = processor.post_process_masks(
+        masks=outputs.pred_masks,
+        original_sizes=inputs.original_sizes,
+        reshaped_input_sizes=inputs.reshaped_input_sizes
+    )[0]
+    return masks
+
+def segment(
+    image: Image.Image,
+    detection_results: List[Dict[str, Any]],
+    polygon_refinement: bool = False,
+    segmenter_id: Optional[str] = None
+) -> List[DetectionResult]:
+    """
+    Use Segment Anything (SAM) to generate masks given an image + a set of bounding boxes.
+    """
+    boxes = get_boxes(detection_results)
+    masks = _run_segmenter(image, boxes, segmenter_id)
+
+    masks = refine_masks(masks, polygon_refinement)
+
+    for detection_result, mask in zip(detection_results, masks):
+        detection_result.mask = mask
+
+    return detection_results
+
+def grounded_segmentation(
+    image: Union[Image.Image, str],
+    labels: List[str],
+    threshold: float = 0.3,
+    polygon_refinement: bool = False,
+    detector_id: Optional[str] = None,
+    segmenter_id: Optional[str] = None
+) -> Tuple[np.ndarray, List[DetectionResult]]:
+    if isinstance(image, str):
+        image = load_image(image)
+
+    detections = detect(image, labels, threshold, detector_id)
+    detections = segment(image, detections, polygon_refinement, segmenter_id)
+
+    return np.array(image), detections
+
+def detect_car_parts(image_path, model_predictor=None):
+    """
+    Detect car parts in an image with instance segmentation masks
+
+    Args:
+        image_path (str or numpy.ndarray): Path to the input image or image array
+        model_predictor: Loaded Detectron2 predictor (defaults to the resident part model)
+
+    Returns:
+        dict: Dictionary containing detected parts, their masks, and other information
+    """
+    model_predictor = model_predictor or registry.part_predictor()
+
+    # Read image
+    if isinstance(image_path, str):
+        image = cv2.imread(image_path)
+    else:
+        image = image_path
+
+    if image is None:
+        raise ValueError("Could not load image")
+
+    # Run detection
+    with torch.inference_mode():
+        outputs = model_predictor(image)
+    instances = outputs["instances"].to("cpu")
+
+    # Get predictions
+    boxes = instances.pred_boxes.tensor.numpy()
+    classes = instances.pred_classes.numpy()
+    scores = instances.scores.numpy()
+    masks = instances.pred_masks.numpy()
+
+    # Prepare results
+    results = []
+    for box, mask, class_id, score in zip(boxes, masks, classes, scores):
+        part_name = id_to_part_name.get(class_id, "Unknown")
+        results.append({
+            "part": part_name,
+            "confidence": float(score),
+            "bbox": box.tolist(),  # [x1, y1, x2, y2]
+            "mask": mask  # Binary mask for the instance
+        })
+
+    return {
+        "instances": results,
+        "image_size": image.shape[:2]  # (height, width)
+    }
+
+def combine_masks(car_mask: np.ndarray, parts: Dict[str, Any]) -> np.ndarray:
+    """Merge the unpaintable part masks into the car mask."""
+    with span('combine'):
+        detections_unpaintable = [
+            detection for detection in parts["instances"]
+            if detection["part"] in unpaintable_parts
+        ]
+
+        # Create unpaintable regions mask
+        unpaintable_regions = np.zeros_like(car_mask)
+        for region in detections_unpaintable:
+            region = region['mask'].astype('uint8')
+            unpaintable_regions += region
+
+        unpaintable_regions = np.where(unpaintable_regions > 1, 1, unpaintable_regions)
+        return unpaintable_regions + car_mask
+
+def detect_batch(
+    images: List[Image.Image],
+    labels: List[str],
+    threshold: float = 0.3,
+    detector_id: Optional[str] = None
+) -> List[List[DetectionResult]]:
+    """
+    Run Grounding DINO over a padded batch of images. Returns the detections of
+    each image sorted by descending score, like detect().
+    """
+    model = registry.detector(detector_id).model
+    processor = registry.detector_processor(detector_id)
+
+    text = " ".join(label if label.endswith(".") else label+"." for label in labels)
+    inputs = processor(
+        images=images, text=[text] * len(images), padding=True, return_tensors="pt"
+    ).to(registry.device)
+
+    with torch.inference_mode():
+        outputs = model(**inputs)
+    batch_results = processor.post_process_grounded_object_detection(
+        outputs,
+        inputs.input_ids,
+        box_threshold=threshold,
+        text_threshold=threshold,
+        target_sizes=[image.size[::-1] for image in images]
+    )
+
+    detections = []
+    for result in batch_results:
+        order = torch.argsort(result["scores"], descending=True)
+        detections.append([
+            DetectionResult(
+                score=float(result["scores"][i]),
+                label=result["labels"][i],
+                box=BoundingBox(*[int(v) for v in result["boxes"][i].tolist()])
+            )
+            for i in order.tolist()
+        ])
+    return detections
+
+def segment_batch(
+    images: List[Image.Image],
+    boxes: List[List[float]],
+    polygon_refinement: bool = False,
+    segmenter_id: Optional[str] = None
+) -> List[np.ndarray]:
+    """Run SAM over a batch of images with one box per image and return one mask per image."""
+    segmentator, processor = registry.segmenter(segmenter_id)
+
+    inputs = processor(
+        images=images, input_boxes=[[box] for box in boxes], return_tensors="pt"
+    ).to(registry.device)
+
+    with torch.inference_mode():
+        outputs = segmentator(**inputs)
+    masks = processor.post_process_masks(
+        masks=outputs.pred_masks,
+        original_sizes=inputs.original_sizes,
+        reshaped_input_sizes=inputs.reshaped_input_sizes
+    )
+
+    return [refine_masks(image_masks, polygon_refinement)[0] for image_masks in masks]
+
+def detect_car_parts_batch(images: List[np.ndarray], model_predictor=None) -> List[Dict[str, Any]]:
+    """
+    Batched detect_car_parts: applies the predictor's preprocessing to every
+    image and runs the model once; detectron2 pads the batch internally.
+    """
+    model_predictor = model_predictor or registry.part_predictor()
+
+    inputs = []
+    for image in images:
+        height, width = image.shape[:2]
+        original = image[:, :, ::-1] if model_predictor.input_format == "RGB" else image
+        transformed = model_predictor.aug.get_transform(original).apply_image(original)
+        inputs.append({
+            "image": torch.as_tensor(transformed.astype("float32").transpose(2, 0, 1)),
+            "height": height,
+            "width": width,
+        })
+
+    with torch.inference_mode():
+        outputs = model_predictor.model(inputs)
+
+    batch_results = []
+    for image, output in zip(images, outputs):
+        instances = output["instances"].to("cpu")
+        results = []
+        for box, mask, class_id, score in zip(
+            instances.pred_boxes.tensor.numpy(),
+            instances.pred_masks.numpy(),
+            instances.pred_classes.numpy(),
+            instances.scores.numpy()
+        ):
+            results.append({
+                "part": id_to_part_name.get(class_id, "Unknown"),
+                "confidence": float(score),
+                "bbox": box.tolist(),  # [x1, y1, x2, y2]
+                "mask": mask  # Binary mask for the instance
+            })
+        batch_results.append({
+            "instances": results,
+            "image_size": image.shape[:2]  # (height, width)
+        })
+    return batch_results
+
+def segment_cars_batch(images: List[np.ndarray]) -> List[Union[Tuple[np.ndarray, Dict[str, Any]], Exception]]:
+    """
+    Segment the car and detect its parts for a batch of decoded BGR images.
+    Each entry is either (car mask, part detections) or the exception for
+    that image, so one bad image does not fail the whole batch. The final
+    mask (combine_masks) and the part label map (build_part_labels) are both
+    derived from these, without further inference.
+    """
+    pil_images = [Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)) for image in images]
+    results: List[Union[Tuple[np.ndarray, Dict[str, Any]], Exception]] = [None] * len(images)
+
+    # Detect the car in every image; images without a detection drop out of the batch
+    with span('detect'):
+        detections = detect_batch(pil_images, LABELS, THRESHOLD, DETECTOR_ID)
+    detected = []
+    for idx, image_detections in enumerate(detections):
+        if image_detections:
+            detected.append(idx)
+        else:
+            results[idx] = ValueError("No car detected in image")
+    if not detected:
+        return results
+
+    with span('segment'):
+        car_masks = segment_batch(
+            [pil_images[idx] for idx in detected],
+            [detections[idx][0].box.xyxy for idx in detected],
+            polygon_refinement=True,
+            segmenter_id=SEGMENTER_ID
+        )
+    with span('part_detect'):
+        parts = detect_car_parts_batch([images[idx] for idx in detected])
+
+    for idx, car_mask, image_parts in zip(detected, car_masks, parts):
+        results[idx] = (car_mask, image_parts)
+    return results
+
+def generate_masks_batch(images: List[np.ndarray]) -> List[Union[np.ndarray, Exception]]:
+    """
+    Generate the final masks (car plus unpaintable parts) for a batch of decoded
+    BGR images. Each entry is either the mask or the exception for that image.
+    """
+    return [
+        result if isinstance(result, Exception) else combine_masks(*result)
+        for result in segment_cars_batch(images)
+    ]
+
+def process_image(image: np.ndarray) -> np.ndarray:
+    """Generate the final car mask (car plus unpaintable parts) for a decoded BGR image."""
+    result = generate_masks_batch([image])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+class MicroBatcher:
+    """
+    Collects items submitted concurrently and processes them together.
+    A batch is closed when it reaches max_batch_size or max_wait_ms after its
+    first item arrived; process_batch receives the list of items and returns
+    one result (or exception) per item, which is fanned back out to each
+    caller's Future.
+
+    Batches run on num_workers inference threads. At most max_pending items
+    may be queued or in flight; try_submit refuses work beyond that so callers
+    can shed load instead of queueing without bound.
+    """
+
+    def __init__(
+        self,
+        process_batch,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_ms: float = BATCH_WAIT_MS,
+        num_workers: int = INFERENCE_WORKERS,
+        max_pending: int = MAX_QUEUE_DEPTH
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self._queue: "queue.Queue[Optional[Tuple[Any, Future]]]" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.stats = {
+            'items_total': 0,
+            'rejected_total': 0,
+            'batches_total': 0,
+            'batch_items_total': 0,
+            'batch_seconds_total': 0.0,
+        }
+        self._avg_batch_seconds = 1.0
+
+    def start(self):
+        """Start the inference threads."""
+        if not self._threads:
+            for idx in range(self.num_workers):
+                thread = threading.Thread(target=self._run, name=f"mask-batcher-{idx}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stop the inference threads once queued items are processed."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def try_submit(self, items: List[Any]) -> Optional[List[Future]]:
+        """
+        Queue all items, or none of them if that would exceed max_pending.
+        Returns one Future per item, or None when the server is saturated.
+        """
+        with self._lock:
+            if self.pending + len(items) > self.max_pending:
+                self.stats['rejected_total'] += len(items)
+                return None
+            self.pending += len(items)
+            self.stats['items_total'] += len(items)
+
+        futures = []
+        for item in items:
+            future: Future = Future()
+            future.add_done_callback(self._release)
+            self._queue.put((item, future))
+            futures.append(future)
+        return futures
+
+    def _release(self, future: Future):
+        """Done callback: the item no longer counts against max_pending."""
+        with self._lock:
+            self.pending -= 1
+
+    @property
+    def is_saturated(self) -> bool:
+        """Whether no further item can be admitted right now."""
+        return self.pending >= self.max_pending
+
+    @property
+    def queue_depth(self) -> int:
+        """Items waiting for an inference thread."""
+        return self._queue.qsize()
+
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait, estimated from recent batch latency."""
+        batches_ahead = -(-self.pending // (self.max_batch_size * self.num_workers))
+        return max(1, int(round(batches_ahead * self._avg_batch_seconds)))
+
+    def _collect(self) -> Optional[List[Tuple[Any, Future]]]:
+        """Wait for a first item, then gather more until the batch is full or the window closes."""
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is None:
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        """Inference thread: run batches until stopped."""
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            with self._lock:
+                self.running += len(items)
+            start = time.perf_counter()
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                results = [e] * len(items)
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                self.running -= len(items)
+                self.stats['batches_total'] += 1
+                self.stats['batch_items_total'] += len(items)
+                self.stats['batch_seconds_total'] += elapsed
+                self._avg_batch_seconds = 0.8 * self._avg_batch_seconds + 0.2 * elapsed
+
+            for future, result in zip(futures, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def metrics(self) -> str:
+        """Prometheus text exposition of queue depth and batching counters."""
+        with self._lock:
+            lines = [
+                "# TYPE mask_queue_depth gauge",
+                f"mask_queue_depth {self.queue_depth}",
+                "# TYPE mask_pending gauge",
+                f"mask_pending {self.pending}",
+                "# TYPE mask_running gauge",
+                f"mask_running {self.running}",
+                "# TYPE mask_queue_capacity gauge",
+                f"mask_queue_capacity {self.max_pending}",
+            ]
+            for name, value in self.stats.items():
+                metric = f"mask_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+batcher = MicroBatcher(segment_cars_batch)
+
+# Decoding uploads and encoding masks runs here instead of on the event loop
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="mask-io")
+
+def decode_image(contents: bytes) -> Optional[np.ndarray]:
+    """Decode uploaded image bytes into a BGR image."""
+    with span('decode'):
+        nparr = np.frombuffer(contents, np.uint8)
+        return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+def encode_mask_png(mask: np.ndarray) -> bytes:
+    """Encode a mask as PNG bytes."""
+    with span('encode'):
+        _, buffer = cv2.imencode('.png', mask)
+        return buffer.tobytes()
+
+def encode_mask_parts(car_mask: np.ndarray, parts: Dict[str, Any]) -> Tuple[bytes, int]:
+    """
+    Encode the car mask and its part label map as two concatenated PNGs.
+    Returns the body and the length of the car mask PNG.
+    """
+    car_png = encode_mask_png(car_mask)
+    return car_png + encode_mask_png(build_part_labels(car_mask.shape, parts)), len(car_png)
+
+def encode_mask(mask: np.ndarray) -> str:
+    """Encode a mask as a base64 PNG."""
+    return base64.b64encode(encode_mask_png(mask)).decode()
+
+async def run_io(func, *args):
+    """Run a CPU-bound helper on the bounded I/O executor."""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+def saturated_response() -> HTTPException:
+    """429 telling the client when to retry."""
+    return HTTPException(
+        status_code=429,
+        detail="Mask queue is full, retry later",
+        headers={"Retry-After": str(batcher.retry_after())}
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load and warm up all models once, before the server accepts requests."""
+    configure_torch_threads()
+    registry.load_all()
+    if WARMUP_MODELS:
+        registry.warmup()
+    batcher.start()
+    yield
+    batcher.stop()
+
+app = FastAPI(title="Car Mask Generation API", lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.post("/generate_mask")
+async def generate_mask(
+    file: UploadFile = File(...),
+    format: str = Query("json", pattern="^(json|png|parts)$")
+):
+    """
+    Generate a mask for the uploaded car image.
+    format=png returns the mask as a raw image/png body instead of base64 JSON.
+    format=parts returns the car mask (before removing unpaintable parts) and
+    a label map of part ids + 1 (0 for no part) as two concatenated PNGs; the
+    X-Mask-Length header is the length of the first one.
+    """
+    # Shed load before reading and decoding the upload
+    if batcher.is_saturated:
+        raise saturated_response()
+
+    try:
+        # Read and decode the upload
+        contents = await file.read()
+        image = await run_io(decode_image, contents)
+
+        if image is None:
+            raise HTTPException(
+                status_code=400,
+                detail="Could not decode image. Please ensure it's a valid image file."
+            )
+
+        # Concurrent requests are batched together by the micro-batcher
+        futures = batcher.try_submit([image])
+        if futures is None:
+            raise saturated_response()
+        car_mask, parts = await asyncio.wrap_future(futures[0])
+
+        if format == "parts":
+            body, mask_length = await run_io(encode_mask_parts, car_mask, parts)
+            return Response(
+                content=body,
+                media_type="application/octet-stream",
+                headers={"X-Mask-Length": str(mask_length)}
+            )
+
+        final = await run_io(combine_masks, car_mask, parts)
+        if format == "png":
+            return Response(content=await run_io(encode_mask_png, final), media_type="image/png")
+        return {
+            "status": "success",
+            "mask": await run_io(encode_mask, final)
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
+@app.post("/generate_mask_batch")
+async def generate_mask_batch(files: List[UploadFile] = File(...)):
+    """
+    Generate masks for several car images in one call. Results are returned in
+    upload order; a failing image yields an error entry instead of failing the call.
+    The whole call is rejected with 413 if it has more images than the queue
+    can ever hold (split it into smaller calls), and with 429 if its images
+    do not fit in the queue right now.
+    """
+    if len(files) > batcher.max_pending:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many images in one batch ({len(files)}); send at most {batcher.max_pending} per call"
+        )
+    if batcher.is_saturated:
+        raise saturated_response()
+
+    images = [await run_io(decode_image, await file.read()) for file in files]
+    decoded = [image for image in images if image is not None]
+
+    submitted = batcher.try_submit(decoded)
+    if submitted is None:
+        raise saturated_response()
+
+    submitted = iter(submitted)
+    results = []
+    for file, image in zip(files, images):
+        if image is None:
+            results.append({"filename": file.filename, "status": "error", "detail": "Could not decode image"})
+            continue
+        try:
+            final = await run_io(combine_masks, *await asyncio.wrap_future(next(submitted)))
+            results.append({
+                "filename": file.filename,
+                "status": "success",
+                "mask": await run_io(encode_mask, final)
+            })
+        except Exception as e:
+            results.append({"filename": file.filename, "status": "error", "detail": str(e)})
+
+    return {
+        "status": "success",
+        "results": results
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus-style queue depth, batching and per-stage timing metrics"""
+    return batcher.metrics() + render_prometheus("mask")
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint with resident model load times and memory"""
+    return {"status": "healthy", **registry.health()}
+
+def start_server(port: int = 8000, use_ngrok: bool = False, workers: int = 1):
+    """
+    Start the FastAPI server, optionally behind an ngrok tunnel (token from
+    NGROK_AUTH_TOKEN). Each of the uvicorn workers is a separate process with
+    its own models, batcher and queue limit.
+    """
+    if use_ngrok:
+        from pyngrok import ngrok
+        import nest_asyncio
+
+        ngrok.set_auth_token(os.environ["NGROK_AUTH_TOKEN"])
+        ngrok_tunnel = ngrok.connect(port)
+        print('Public URL:', ngrok_tunnel.public_url)
+        nest_asyncio.apply()
+
+    if workers > 1:
+        uvicorn.run("masking_server:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
+
+if __name__ == "__main__":
+    start_server(
+        port=int(os.environ.get("PORT", "8000")),
+        use_ngrok="NGROK_AUTH_TOKEN" in os.environ,
+        workers=int(os.environ.get("UVICORN_WORKERS", "1"))
+    )
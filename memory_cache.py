@@ -0,0 +1,200 @@
+import os
+import hashlib
+import threading
+import dataclasses
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+import numpy as np
+
+def value_bytes(value: Any) -> int:
+    """Bytes held by a cached value: its arrays and byte strings, also inside dicts, lists, tuples and dataclasses."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return value_bytes(vars(value))
+    if isinstance(value, dict):
+        return sum(value_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_bytes(item) for item in value)
+    return 0
+
+class TieredCache:
+    """
+    Thread-safe in-process LRU cache bounded by the byte size of its values
+    (numpy arrays and byte strings, or dicts, tuples and dataclasses holding them).
+    With a disk_dir, arrays evicted from memory are spilled there as .npy
+    files and memory-mapped back on a later miss, so they come back without
+    any image decoding; the disk tier is bounded to disk_max_bytes, least
+    recently used first. Evicted values that are not plain arrays are
+    dropped. Values larger than max_bytes are not kept in memory.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 1024 * 1024 * 1024,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 4 * 1024 * 1024 * 1024
+    ):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+    def _disk_path(self, key: Hashable) -> str:
+        """Spill file of a key."""
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.npy")
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Cached value of a key from memory, else from the disk tier, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        value = self._load_spilled(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, value)
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether a key is in the memory tier; does not count as a lookup."""
+        with self._lock:
+            return key in self._entries
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Cached value of a key, computing and caching it with loader() on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        """Cache a value, evicting least recently used entries down to max_bytes."""
+        size = value_bytes(value)
+        evicted: List[Tuple[Hashable, Any]] = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            if size <= self.max_bytes:
+                self._entries[key] = (value, size)
+                self.bytes += size
+            else:
+                evicted.append((key, value))
+            while self.bytes > self.max_bytes:
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+
+        # Spill outside the lock so other threads keep hitting the memory tier
+        for old_key, old_value in evicted:
+            self._spill(old_key, old_value)
+
+    def discard(self, key: Hashable):
+        """Forget a key in both tiers."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+        if self.disk_dir is not None:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def discard_matching(self, predicate: Callable[[Hashable], bool]):
+        """Forget the keys of the memory tier for which predicate(key) is true."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self.bytes -= self._entries.pop(key)[1]
+
+    def _spill(self, key: Hashable, value: Any):
+        """Write an evicted array to the disk tier."""
+        if self.disk_dir is None or not isinstance(value, np.ndarray):
+            return
+        path = self._disk_path(key)
+        try:
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                np.save(f, value)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f"Error spilling cache entry: {str(e)}")
+            return
+        with self._lock:
+            self.spills += 1
+        self._evict_disk()
+
+    def _load_spilled(self, key: Hashable) -> Optional[np.ndarray]:
+        """Memory-map a spilled array, if any."""
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            value = np.load(path, mmap_mode='r')
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def _evict_disk(self):
+        """Delete the least recently used spill files until the disk tier fits in disk_max_bytes."""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters and current size of the cache."""
+        disk_bytes = 0
+        if self.disk_dir is not None:
+            disk_bytes = sum(
+                entry.stat().st_size for entry in os.scandir(self.disk_dir)
+                if entry.is_file() and entry.name.endswith('.npy')
+            )
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'spills': self.spills,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'disk_bytes': disk_bytes,
+            }
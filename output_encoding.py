@@ -0,0 +1,151 @@
+import os
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List
+import cv2
+import numpy as np
+from instrumentation import span
+
+# Extension and MIME type of each supported output format
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+    'png': ('.png', 'image/png'),
+}
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """
+    Encoding of recolored outputs.
+    format ('jpeg', 'webp' or 'png') and quality (1-100 for JPEG and WebP;
+    WebP above 100 is lossless) or png_compression (0-9, higher is smaller
+    and slower) apply to the full-resolution image. The display rendition
+    (longest side display_max_side) and the thumbnail (thumbnail_max_side)
+    use rendition_format and rendition_quality.
+    """
+    format: str = 'jpeg'
+    quality: int = 95
+    png_compression: int = 1
+    display_max_side: int = 1280
+    thumbnail_max_side: int = 256
+    rendition_format: str = 'jpeg'
+    rendition_quality: int = 85
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format][0]
+
+    @property
+    def mime_type(self) -> str:
+        return FORMATS[self.format][1]
+
+    @property
+    def rendition_mime_type(self) -> str:
+        return FORMATS[self.rendition_format][1]
+
+# Output formats behind the app's quality setting. WebP is smaller than JPEG
+# but several times slower to encode at full resolution, so it is opt-in.
+QUALITY_PRESETS = {
+    'Draft': OutputFormat(format='jpeg', quality=75),
+    'Standard': OutputFormat(format='jpeg', quality=90),
+    'High': OutputFormat(format='jpeg', quality=95),
+    'Ultra': OutputFormat(format='png', png_compression=3),
+}
+
+@dataclass
+class EncodedOutput:
+    """Encoded renditions of one recolored image (full resolution, display and thumbnail)."""
+    full: bytes
+    display: bytes
+    thumbnail: bytes
+    mime_type: str
+    rendition_mime_type: str
+    extension: str
+
+def _encode_params(image_format: str, quality: int, png_compression: int) -> List[int]:
+    """cv2.imencode parameters of a format."""
+    if image_format == 'jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if image_format == 'webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    if image_format == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    raise ValueError(f"Unknown output format '{image_format}'")
+
+def encode_image(
+    image: np.ndarray,
+    image_format: str = 'jpeg',
+    quality: int = 95,
+    png_compression: int = 1
+) -> bytes:
+    """Encode a BGR image in memory."""
+    params = _encode_params(image_format, quality, png_compression)
+    success, buffer = cv2.imencode(FORMATS[image_format][0], image, params)
+    if not success:
+        raise ValueError(f"Failed to encode the image as {image_format}")
+    return buffer.tobytes()
+
+def downscale(image: np.ndarray, max_side: int) -> np.ndarray:
+    """Image shrunk (area interpolation) so its longest side is at most max_side."""
+    scale = max_side / max(image.shape[:2])
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+def encode_renditions(image: np.ndarray, output_format: OutputFormat) -> EncodedOutput:
+    """
+    Encode a BGR image and its display and thumbnail renditions in one pass;
+    the thumbnail is shrunk from the display rendition, not the full image.
+    """
+    with span('encode.full'):
+        full = encode_image(image, output_format.format, output_format.quality, output_format.png_compression)
+    with span('encode.renditions'):
+        display_image = downscale(image, output_format.display_max_side)
+        display = encode_image(display_image, output_format.rendition_format, output_format.rendition_quality)
+        thumbnail = encode_image(
+            downscale(display_image, output_format.thumbnail_max_side),
+            output_format.rendition_format, output_format.rendition_quality
+        )
+    return EncodedOutput(
+        full=full,
+        display=display,
+        thumbnail=thumbnail,
+        mime_type=output_format.mime_type,
+        rendition_mime_type=output_format.rendition_mime_type,
+        extension=output_format.extension,
+    )
+
+def write_bytes(path: str, data: bytes):
+    """Write a file atomically."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+class OutputWriter:
+    """
+    Persists encoded outputs off the request path, on a small pool of
+    background threads. Files appear atomically, complete or not at all.
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='output-writer')
+
+    def submit(self, path: str, data: bytes) -> Future:
+        """Schedule writing data to path; the future raises if the write failed."""
+        return self.executor.submit(self._write, path, data)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        with span('write'):
+            try:
+                write_bytes(path, data)
+            except Exception as e:
+                print(f"Error saving output {path}: {str(e)}")
+                raise
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting writes, by default after finishing the pending ones."""
+        self.executor.shutdown(wait=wait)
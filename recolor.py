@@ -1,4 +1,4 @@
-from typing import Union, Optional, Tuple, Dict, Any
+from typing import Union, Optional, Tuple, Dict, Any, List
 import os
 import cv2
 import numpy as np
@@ -6,15 +6,41 @@ import shutil
 import requests
 import uuid
 import base64
+import hashlib
+import json
 from pathlib import Path
 from io import BytesIO
 import pickle
-from sklearn.cluster import KMeans
+import time
+import random
+import threading
+from analysis_backends import DEFAULT_BACKEND, assign_to_centers, get_backend, quantization_error
+from mask_cache import MaskStore
+from car_parts import build_paintable_mask, build_part_map
+from instrumentation import span, collect
+from output_encoding import OutputFormat, OutputWriter, encode_renditions, write_bytes
 
 class CarRecolorError(Exception):
     """Custom exception for car recoloring errors"""
     pass
 
+# Parameters that affect the stored analysis; part of the analysis cache key
+ANALYSIS_PARAMS = {'k': 200, 'backend': DEFAULT_BACKEND}
+
+# On-disk analysis format: magic, version, JSON header, then 64-byte aligned
+# raw arrays that can be memory-mapped
+ANALYSIS_MAGIC = b'RCANALYS'
+ANALYSIS_FORMAT_VERSION = 1
+ANALYSIS_ALIGNMENT = 64
+
+# Longest side of the downscaled proxy used for interactive previews
+PREVIEW_MAX_SIDE = 1280
+# Rows per band of the tiled recolor path
+TILE_ROWS = 256
+# Fraction of the clustered car's pixels that may change through incremental
+# mask edits before the car is re-clustered
+MAX_MASK_DRIFT = 0.25
+
 def generate_uuid_filename() -> str:
     """Generate a UUID filename while preserving the original extension."""
     return str(uuid.uuid4())
@@ -27,6 +53,11 @@ def get_mask_filename(image_path: str) -> str:
 def get_analysis_filename(image_path: str) -> str:
     """Generate the analysis filename for a given image UUID."""
     base_uuid = os.path.splitext(image_path)[0]
+    return f"{base_uuid}_analysis.rca"
+
+def get_legacy_analysis_filename(image_path: str) -> str:
+    """Generate the legacy pickle analysis filename for a given image UUID."""
+    base_uuid = os.path.splitext(image_path)[0]
     return f"{base_uuid}_analysis.pkl"
 
 def check_existing_mask(base_dir: str, mask_filename: str) -> Optional[np.ndarray]:
@@ -49,89 +80,352 @@ def save_mask(mask: np.ndarray, base_dir: str, mask_filename: str) -> bool:
         print(f"Error saving mask: {str(e)}")
         return False
 
-def get_mask_from_api(image_path: str, api_url: str) -> np.ndarray:
+class MaskClient:
+    """
+    Reusable client for the mask generation API.
+    Keeps a pooled keep-alive session, applies connect/read timeouts, retries
+    connection errors, 429 and 5xx responses with exponential backoff and full
+    jitter, and asks the server for a raw PNG mask instead of base64 JSON.
+    Uploads can optionally be downscaled so their longest side is at most
+    max_upload_side; callers resize the mask back to the image size anyway.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 120.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10.0,
+        max_upload_side: Optional[int] = None,
+        pool_size: int = 8
+    ):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_upload_side = max_upload_side
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Delay before the next attempt: the server's Retry-After if given, else capped exponential with full jitter."""
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _prepare_upload(self, image_path: str) -> Tuple[bytes, str]:
+        """Read the upload, downscaling it to max_upload_side when configured."""
+        with open(image_path, 'rb') as image_file:
+            image_bytes = image_file.read()
+        if not self.max_upload_side:
+            return image_bytes, 'image/jpeg'
+
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise CarRecolorError(f"Failed to decode image: {image_path}")
+        scale = self.max_upload_side / max(image.shape[:2])
+        if scale >= 1:
+            return image_bytes, 'image/jpeg'
+
+        resized = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        _, buffer = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        return buffer.tobytes(), 'image/jpeg'
+
+    @staticmethod
+    def _decode_png(png_bytes: bytes) -> np.ndarray:
+        """Decode a single-channel PNG returned by the API."""
+        mask = cv2.imdecode(np.frombuffer(png_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise CarRecolorError("Failed to decode mask returned by the API")
+        return mask
+
+    @classmethod
+    def _decode_mask(cls, response: requests.Response) -> np.ndarray:
+        """Decode a raw PNG response, or the legacy base64-in-JSON response."""
+        if response.headers.get('Content-Type', '').startswith('image/png'):
+            return cls._decode_png(response.content)
+        return cls._decode_png(base64.b64decode(response.json()['mask']))
+
+    @staticmethod
+    def _error_detail(response: requests.Response) -> str:
+        """': <detail>' of a JSON error response, or ''."""
+        try:
+            detail = response.json().get('detail')
+        except (ValueError, AttributeError):
+            return ''
+        return f": {detail}" if detail else ''
+
+    @staticmethod
+    def _rejects_format(response: requests.Response) -> bool:
+        """Whether a 422 is the server's validation error for the format query parameter."""
+        try:
+            errors = response.json().get('detail')
+        except (ValueError, AttributeError):
+            return False
+        return isinstance(errors, list) and any(
+            isinstance(error, dict) and list(error.get('loc', []))[-1:] == ['format'] for error in errors
+        )
+
+    def _post(self, image_path: str, response_format: str, accept: Tuple[int, ...] = (200,)) -> requests.Response:
+        """Upload an image to /generate_mask, retrying transient failures, until a status in accept."""
+        image_bytes, content_type = self._prepare_upload(image_path)
+        full_url = f"{self.api_url}/generate_mask"
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = self.session.post(
+                    full_url,
+                    params={'format': response_format},
+                    files={'file': ('image.jpg', image_bytes, content_type)},
+                    timeout=self.timeout
+                )
+            except requests.exceptions.ConnectionError as e:
+                # Includes connect timeouts. Read timeouts are not retried: the
+                # server may still be working on the request.
+                error = f"Connection error: {str(e)}"
+            else:
+                if response.status_code in accept:
+                    return response
+                if response.status_code == 404:
+                    raise CarRecolorError(f"API endpoint not found: {full_url}")
+                if response.status_code != 429 and response.status_code < 500:
+                    raise CarRecolorError(
+                        f"API request failed with status {response.status_code}{self._error_detail(response)}"
+                    )
+                error = f"API request failed with status {response.status_code}"
+                retry_after = response.headers.get('Retry-After')
+
+            if attempt < self.max_retries:
+                time.sleep(self._backoff_delay(attempt, retry_after))
+
+        raise CarRecolorError(f"{error} (after {self.max_retries + 1} attempts)")
+
+    def get_mask(self, image_path: str) -> np.ndarray:
+        """Get the mask for an image, retrying transient failures."""
+        return self._decode_mask(self._post(image_path, 'png'))
+
+    def get_mask_parts(self, image_path: str) -> Optional[Tuple[np.ndarray, Optional[np.ndarray]]]:
+        """
+        Get the car mask and its part label map (part id + 1, 0 for no part)
+        from a single inference. Servers that ignore format=parts answer with
+        a plain (PNG or legacy JSON) mask, returned with no label map; None
+        means the server rejected the format (its format validation failed).
+        """
+        response = self._post(image_path, 'parts', accept=(200, 422))
+        if response.status_code == 422:
+            if self._rejects_format(response):
+                return None
+            raise CarRecolorError(f"API request failed with status 422{self._error_detail(response)}")
+        if not response.headers.get('Content-Type', '').startswith('application/octet-stream'):
+            return self._decode_mask(response), None
+        try:
+            mask_length = int(response.headers['X-Mask-Length'])
+        except (KeyError, ValueError):
+            return self._decode_mask(response), None
+        return (
+            self._decode_png(response.content[:mask_length]),
+            self._decode_png(response.content[mask_length:])
+        )
+
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
+
+_mask_clients: Dict[str, MaskClient] = {}
+_mask_clients_lock = threading.Lock()
+
+def get_mask_client(api_url: str) -> MaskClient:
+    """Shared default MaskClient for an API URL."""
+    with _mask_clients_lock:
+        client = _mask_clients.get(api_url)
+        if client is None:
+            client = _mask_clients[api_url] = MaskClient(api_url)
+        return client
+
+def get_mask_from_api(image_path: str, api_url: str, mask_client: Optional[MaskClient] = None) -> np.ndarray:
     """Get mask from the API for a given image."""
     try:
-        with open(image_path, 'rb') as image_file:
-            files = {'file': ('image.jpg', image_file, 'image/jpeg')}
-            
-            full_url = f"{api_url}/generate_mask"
-            response = requests.post(full_url, files=files)
-            
-            if response.status_code == 404:
-                raise Exception(f"API endpoint not found: {full_url}")
-            elif response.status_code != 200:
-                raise Exception(f"API request failed with status {response.status_code}")
-            
-            mask_base64 = response.json()['mask']
-            mask_bytes = base64.b64decode(mask_base64)
-            mask_array = np.frombuffer(mask_bytes, dtype=np.uint8)
-            mask = cv2.imdecode(mask_array, cv2.IMREAD_GRAYSCALE)
-            
-            return mask
-            
+        client = mask_client or get_mask_client(api_url)
+        return client.get_mask(image_path)
+    except Exception as e:
+        raise Exception(f"Error getting mask from API: {str(e)}")
+
+def get_mask_and_parts_from_api(
+    image_path: str,
+    api_url: str,
+    mask_client: Optional[MaskClient] = None
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Get the mask of an image and its part map (see car_parts.build_part_map)
+    from the API. The mask is the part map without the default unpaintable
+    parts, as the server would merge them; servers without part maps return
+    their mask and no part map.
+    """
+    try:
+        client = mask_client or get_mask_client(api_url)
+        mask_parts = client.get_mask_parts(image_path)
+        if mask_parts is None:
+            return client.get_mask(image_path), None
+        mask, labels = mask_parts
+        if labels is None:
+            return mask, None
+        part_map = build_part_map(mask, labels)
+        return build_paintable_mask(part_map), part_map
     except Exception as e:
         raise Exception(f"Error getting mask from API: {str(e)}")
 
-def analyze_car(masked_car_rgb: np.ndarray, k: int = 200) -> Dict[str, Any]:
+def load_or_fetch_mask(
+    image_uuid: str,
+    image_path: str,
+    original: np.ndarray,
+    base_dir: str,
+    api_url: str,
+    mask_client: Optional[MaskClient] = None,
+    mask_store: Optional[MaskStore] = None
+) -> Tuple[np.ndarray, str]:
+    """
+    Return the raw mask of an uploaded image, fetching it from the API on a miss,
+    and the name the image's derived files (analysis) are stored under.
+    With a mask_store, masks are cached by the content hash of the decoded image,
+    so re-uploads of the same photo reuse both mask and analysis; without one,
+    masks are stored per upload UUID. The store also keeps the image's part
+    map when the server provides one (see load_or_fetch_part_map). An upload
+    whose mask was edited gets its edited mask, and its own storage name
+    (MaskStore.edit_name) so its analysis does not replace the shared one.
+    """
+    if mask_store is not None:
+        with span('mask.cache_lookup'):
+            content_hash = mask_store.resolve(image_uuid) or mask_store.register(image_uuid, original)
+            edited = mask_store.get_edit(image_uuid)
+            if edited is not None:
+                return edited, mask_store.edit_name(image_uuid)
+            mask = mask_store.get(content_hash)
+        if mask is None:
+            with span('mask.fetch'):
+                mask, part_map = get_mask_and_parts_from_api(image_path, api_url, mask_client)
+            mask_store.put(content_hash, mask)
+            if part_map is not None:
+                mask_store.put_parts(content_hash, part_map)
+        return mask, content_hash
+
+    mask_filename = get_mask_filename(image_uuid)
+    with span('mask.cache_lookup'):
+        mask = check_existing_mask(base_dir, mask_filename)
+    if mask is None:
+        with span('mask.fetch'):
+            mask = get_mask_from_api(image_path, api_url, mask_client)
+        save_mask(mask, base_dir, mask_filename)
+    return mask, image_uuid
+
+def load_or_fetch_part_map(
+    image_path: str,
+    content_hash: str,
+    api_url: str,
+    mask_client: Optional[MaskClient],
+    mask_store: MaskStore
+) -> np.ndarray:
+    """
+    Part map of an image from the mask store, fetched from the API only for
+    masks cached before part maps were stored.
+    """
+    part_map = mask_store.get_parts(content_hash)
+    if part_map is None:
+        with span('mask.fetch'):
+            _, part_map = get_mask_and_parts_from_api(image_path, api_url, mask_client)
+        if part_map is None:
+            raise CarRecolorError("The masking server does not provide part maps")
+        mask_store.put_parts(content_hash, part_map)
+    return part_map
+
+def _nonblack(image: np.ndarray) -> np.ndarray:
+    """Boolean map of the pixels with any nonzero channel."""
+    return (image[..., 0] | image[..., 1] | image[..., 2]) != 0
+
+def analyze_car(
+    masked_car_rgb: np.ndarray,
+    k: int = 200,
+    backend: str = DEFAULT_BACKEND
+) -> Dict[str, Any]:
     """
     Analyze car colors using both LAB and HSV color spaces.
     Automatically adjusts number of clusters based on available pixels.
+    The clustering backend is selectable (see analysis_backends); 'kmeans'
+    is the exact path. Black pixels are treated as outside the car.
     """
-    # Convert to LAB space for brightness analysis
-    lab_image = cv2.cvtColor(masked_car_rgb[:, :, ::-1], cv2.COLOR_BGR2LAB)
-    
-    # Also get HSV for color analysis
-    hsv_image = cv2.cvtColor(masked_car_rgb[:, :, ::-1], cv2.COLOR_BGR2HSV)
-    
-    # Get valid pixels
-    pixels_lab = lab_image.reshape(-1, 3)
-    pixels_hsv = hsv_image.reshape(-1, 3)
-    mask = np.any(masked_car_rgb.reshape(-1, 3) > 0, axis=1)
-    valid_pixels_lab = pixels_lab[mask]
-    valid_pixels_hsv = pixels_hsv[mask]
+    valid_mask = _nonblack(masked_car_rgb)
+    return analyze_car_pixels(masked_car_rgb, valid_mask, k, backend, cv2.COLOR_RGB2LAB)
+
+def analyze_car_pixels(
+    image: np.ndarray,
+    valid_mask: np.ndarray,
+    k: int = 200,
+    backend: str = DEFAULT_BACKEND,
+    to_lab: int = cv2.COLOR_BGR2LAB
+) -> Dict[str, Any]:
+    """
+    analyze_car on the pixels of image (BGR, or RGB with to_lab=cv2.COLOR_RGB2LAB)
+    where valid_mask is set, without building a masked copy of the image.
+    Only those pixels are converted to LAB; HSV is only needed for the
+    cluster centers. The per-pixel maps keep the image's shape.
+    """
+    with span('analysis.color_convert'):
+        # Extract the car pixels once (in frame order) and convert only those
+        pixels = image[valid_mask]
+        valid_pixels_lab = _pixels_to_lab(pixels, to_lab)
+        del pixels
     
     # Adjust number of clusters based on available pixels
     n_pixels = len(valid_pixels_lab)
     adjusted_k = min(k, n_pixels - 1)  # Ensure k is less than number of samples
     adjusted_k = max(adjusted_k, 5)     # Ensure at least 5 clusters for meaningful analysis
     
-    # Perform k-means clustering in LAB space
-    kmeans = KMeans(n_clusters=adjusted_k, random_state=42)
-    labels = kmeans.fit_predict(valid_pixels_lab)
-    
-    # Get cluster centers and convert to different color spaces
-    centers_lab = kmeans.cluster_centers_
-    centers_bgr = np.array([
-        cv2.cvtColor(center.reshape(1, 1, 3).astype(np.uint8), 
-                    cv2.COLOR_LAB2BGR).reshape(3) 
-        for center in centers_lab
-    ])
-    centers_hsv = cv2.cvtColor(centers_bgr.reshape(-1, 1, 3), cv2.COLOR_BGR2HSV).reshape(-1, 3)
-    
-    # Calculate percentages and find dominant color
-    unique_labels, counts = np.unique(labels, return_counts=True)
-    percentages = counts / len(labels) * 100
-    dominant_idx = np.argmax(percentages)
-    
-    # Get brightness information
-    l_channel = lab_image[..., 0].astype(float)
-    valid_l = l_channel[l_channel > 0]
-    
-    brightness_mean = np.mean(valid_l)
-    brightness_std = np.std(valid_l)
+    # Cluster in LAB space
+    with span('analysis.cluster'):
+        labels, centers_lab = get_backend(backend)(valid_pixels_lab, adjusted_k)
+
+    with span('analysis.assemble'):
+        # Convert all cluster centers to BGR and HSV in one call each
+        centers_bgr = cv2.cvtColor(
+            centers_lab.astype(np.uint8).reshape(-1, 1, 3), cv2.COLOR_LAB2BGR
+        ).reshape(-1, 3)
+        centers_hsv = cv2.cvtColor(centers_bgr.reshape(-1, 1, 3), cv2.COLOR_BGR2HSV).reshape(-1, 3)
+
+        # Calculate percentages and find dominant color
+        counts = np.bincount(labels, minlength=len(centers_lab))
+        percentages = counts / len(labels) * 100
+        dominant_idx = np.argmax(percentages)
+
+        # Get brightness information; pixels outside the car have L = 0, so
+        # the lit car pixels are those with L > 0
+        valid_l = valid_pixels_lab[:, 0].astype(float)
+        lit = valid_l > 0
+        lit_l = valid_l[lit]
+
+        brightness_mean = np.mean(lit_l)
+        brightness_std = np.std(lit_l)
+        del lit_l
+
+        dark_measure = centers_hsv[dominant_idx][2]
+        # Create brightness mask relative to dominant color, dividing in place
+        base_brightness = centers_lab[dominant_idx][0]
+        np.divide(valid_l, base_brightness, out=valid_l, where=lit)
+        relative_brightness = np.zeros(valid_mask.shape, dtype=float)
+        relative_brightness[valid_mask] = valid_l
+
+        # Create full labels array
+        full_labels = np.zeros(valid_mask.shape, dtype=int)
+        full_labels[valid_mask] = labels
 
-    dark_measure = centers_hsv[dominant_idx][2]
-    # Create brightness mask relative to dominant color
-    base_brightness = centers_lab[dominant_idx][0]
-    relative_brightness = np.zeros_like(l_channel, dtype=float)
-    relative_brightness[l_channel > 0] = l_channel[l_channel > 0] / base_brightness
-    
-    # Create full labels array
-    full_labels = np.zeros(pixels_lab.shape[0], dtype=int)
-    full_labels[mask] = labels
-    full_labels = full_labels.reshape(masked_car_rgb.shape[:2])
-    
     return {
         'centers_lab': centers_lab,
         'centers_hsv': centers_hsv,
@@ -145,146 +439,886 @@ def analyze_car(masked_car_rgb: np.ndarray, k: int = 200) -> Dict[str, Any]:
             'is_dark_car': dark_measure < 40,
             'is_bright_car': dark_measure > 160,
         },
-        'valid_mask': mask.reshape(masked_car_rgb.shape[:2])
+        'valid_mask': valid_mask
     }
 
+def _to_header_value(value: Any) -> Any:
+    """Convert an analysis field to a JSON-serializable header value."""
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.tolist(), 'dtype': str(value.dtype)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {key: _to_header_value(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+def _from_header_value(value: Any) -> Any:
+    """Inverse of _to_header_value."""
+    if isinstance(value, dict):
+        if '__ndarray__' in value:
+            return np.array(value['__ndarray__'], dtype=value['dtype'])
+        return {key: _from_header_value(item) for key, item in value.items()}
+    return value
+
+def _align(offset: int) -> int:
+    """Round an offset up to the analysis array alignment."""
+    return -(-offset // ANALYSIS_ALIGNMENT) * ANALYSIS_ALIGNMENT
+
 def save_analysis(results: Dict[str, Any], base_dir: str, analysis_filename: str) -> bool:
-    """Save analysis results to a pickle file."""
+    """
+    Save analysis results in the compact analysis format.
+    Labels are stored as uint8/uint16, relative brightness as float16 and the
+    valid mask bit-packed; all other fields go into a JSON header.
+    """
     try:
         analyses_dir = os.path.join(base_dir, 'analyses')
         os.makedirs(analyses_dir, exist_ok=True)
-        
+
+        labels = results['labels']
+        label_dtype = np.uint8 if len(results['centers_lab']) <= 256 else np.uint16
+        arrays = {
+            'labels': np.ascontiguousarray(labels, dtype=label_dtype),
+            'relative_brightness': np.ascontiguousarray(results['relative_brightness'], dtype=np.float16),
+            'valid_mask': np.packbits(results['valid_mask'].reshape(-1)),
+        }
+
+        header = {
+            'version': ANALYSIS_FORMAT_VERSION,
+            'shape': list(labels.shape),
+            'fields': {
+                key: _to_header_value(value)
+                for key, value in results.items() if key not in arrays
+            },
+            'arrays': {},
+        }
+
+        # The header records array offsets, so lay out the arrays after sizing
+        # the header with placeholder offsets large enough for the final ones
+        for name, array in arrays.items():
+            header['arrays'][name] = {
+                'dtype': str(array.dtype), 'shape': list(array.shape), 'offset': 0
+            }
+        header_size = len(json.dumps(header).encode()) + 32 * len(arrays)
+        offset = _align(len(ANALYSIS_MAGIC) + 8 + header_size)
+        for name, array in arrays.items():
+            header['arrays'][name]['offset'] = offset
+            offset = _align(offset + array.nbytes)
+
+        header_bytes = json.dumps(header).encode()
+        header_bytes += b' ' * (header_size - len(header_bytes))
+
         analysis_path = os.path.join(analyses_dir, analysis_filename)
-        with open(analysis_path, 'wb') as f:
-            pickle.dump(results, f)
+        temp_path = f"{analysis_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(ANALYSIS_MAGIC)
+            f.write(np.array([ANALYSIS_FORMAT_VERSION, header_size], dtype='<u4').tobytes())
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.seek(header['arrays'][name]['offset'])
+                f.write(array.tobytes())
+        os.replace(temp_path, analysis_path)
         return True
     except Exception as e:
         print(f"Error saving analysis: {str(e)}")
         return False
 
 def load_analysis(base_dir: str, analysis_filename: str) -> Optional[Dict[str, Any]]:
-    """Load analysis results from a pickle file."""
+    """
+    Load analysis results from the compact analysis format.
+    Labels and relative brightness are memory-mapped read-only; only the
+    bit-packed valid mask is unpacked into memory.
+    """
     try:
         analysis_path = os.path.join(base_dir, 'analyses', analysis_filename)
-        if os.path.exists(analysis_path):
-            with open(analysis_path, 'rb') as f:
-                return pickle.load(f)
-        
-        return None
+        if not os.path.exists(analysis_path):
+            return None
+
+        with open(analysis_path, 'rb') as f:
+            if f.read(len(ANALYSIS_MAGIC)) != ANALYSIS_MAGIC:
+                raise CarRecolorError(f"Not an analysis file: {analysis_filename}")
+            version, header_size = np.frombuffer(f.read(8), dtype='<u4')
+            if version != ANALYSIS_FORMAT_VERSION:
+                raise CarRecolorError(f"Unsupported analysis format version {version}")
+            header = json.loads(f.read(int(header_size)))
+
+        results = {
+            key: _from_header_value(value) for key, value in header['fields'].items()
+        }
+        arrays = {
+            name: np.memmap(
+                analysis_path,
+                dtype=spec['dtype'],
+                mode='r',
+                offset=spec['offset'],
+                shape=tuple(spec['shape'])
+            )
+            for name, spec in header['arrays'].items()
+        }
+
+        shape = tuple(header['shape'])
+        results['labels'] = arrays['labels']
+        results['relative_brightness'] = arrays['relative_brightness']
+        results['valid_mask'] = np.unpackbits(
+            arrays['valid_mask'], count=shape[0] * shape[1]
+        ).reshape(shape).astype(bool)
+        return results
     except Exception as e:
         print(f"Error loading analysis: {str(e)}")
         return None
 
-def remap_colors(masked_car_rgb, target_color_rgb, analysis_results):
+def migrate_legacy_analysis(
+    base_dir: str,
+    image_uuid: str,
+    remove_legacy: bool = True,
+    params: Optional[Dict[str, Any]] = None,
+    mask_store: Optional[MaskStore] = None
+) -> bool:
     """
-    Remap colors using hybrid approach with special handling for extreme colors
+    Convert a legacy pickled analysis to the compact analysis format.
+    The cache key is computed from the upload in processed/ and its stored
+    mask, with params (default ANALYSIS_PARAMS) taken as the parameters the
+    legacy analysis was made with, so the converted analysis is reused.
+    With a mask_store it is stored under the image's content hash, and the
+    mask is added to the store if it has none. Analyses that already exist in
+    the compact format are left alone, as are legacy ones whose upload or
+    mask is gone. This is the only place pickled analyses are read; only run
+    it on analysis stores you trust.
     """
-    # Convert target color to both LAB and HSV
+    stem = os.path.splitext(image_uuid)[0]
+    legacy_path = os.path.join(base_dir, 'analyses', get_legacy_analysis_filename(stem))
+    if not os.path.exists(legacy_path):
+        return False
+
+    processed_dir = os.path.join(base_dir, 'processed')
+    image_names = [
+        name for name in (os.listdir(processed_dir) if os.path.isdir(processed_dir) else [])
+        if os.path.splitext(name)[0] == stem
+    ]
+    original = cv2.imread(os.path.join(processed_dir, image_names[0])) if image_names else None
+    mask = check_existing_mask(base_dir, get_mask_filename(stem))
+    if original is None or mask is None:
+        print(f"Cannot migrate legacy analysis of {stem}: its image or mask is missing")
+        return False
+
+    storage_name = stem
+    if mask_store is not None:
+        storage_name = mask_store.register(image_names[0], original)
+        if mask_store.get(storage_name) is None:
+            mask_store.put(storage_name, mask)
+    analysis_filename = get_analysis_filename(storage_name)
+    # Never replaced: a running service may have the analysis memory-mapped
+    if os.path.exists(os.path.join(base_dir, 'analyses', analysis_filename)):
+        return False
+
+    try:
+        with open(legacy_path, 'rb') as f:
+            results = pickle.load(f)
+    except Exception as e:
+        print(f"Error reading legacy analysis: {str(e)}")
+        return False
+
+    prepared_mask = prepare_mask(mask, original.shape)
+    if results['labels'].shape[:2] != prepared_mask.shape[:2]:
+        print(f"Cannot migrate legacy analysis of {stem}: it does not match its image")
+        return False
+    # Legacy analyses cover the whole frame, which analysis_bbox assumes without a 'bbox'
+    results['cache_key'] = compute_analysis_key(original, prepared_mask, params)
+
+    if not save_analysis(results, base_dir, analysis_filename):
+        return False
+    if remove_legacy:
+        os.remove(legacy_path)
+    return True
+
+def migrate_legacy_analyses(
+    base_dir: str,
+    remove_legacy: bool = True,
+    params: Optional[Dict[str, Any]] = None,
+    mask_store: Optional[MaskStore] = None
+) -> int:
+    """Convert every legacy pickled analysis in the analyses directory. Returns the number converted."""
+    analyses_dir = os.path.join(base_dir, 'analyses')
+    if not os.path.isdir(analyses_dir):
+        return 0
+
+    suffix = '_analysis.pkl'
+    return sum(
+        migrate_legacy_analysis(base_dir, filename[:-len(suffix)], remove_legacy, params, mask_store)
+        for filename in os.listdir(analyses_dir) if filename.endswith(suffix)
+    )
+
+def prepare_mask(mask: np.ndarray, image_shape: Tuple[int, ...]) -> np.ndarray:
+    """Resize a mask to the image size and threshold it to a binary mask."""
+    mask = cv2.resize(mask, (image_shape[1], image_shape[0]))
+    _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+    return mask
+
+def mask_bbox(mask: np.ndarray) -> Tuple[int, int, int, int]:
+    """(y0, x0, y1, x1) bounding box of the nonzero pixels of a mask; the whole frame if it is empty."""
+    x, y, width, height = cv2.boundingRect(mask)
+    if width == 0 or height == 0:
+        return 0, 0, mask.shape[0], mask.shape[1]
+    return y, x, y + height, x + width
+
+def analysis_bbox(analysis_results: Dict[str, Any]) -> Tuple[int, int, int, int]:
+    """
+    (y0, x0, y1, x1) region of the frame covered by an analysis. Analyses
+    stored before crop processing cover the whole frame.
+    """
+    bbox = analysis_results.get('bbox')
+    if bbox is None:
+        height, width = analysis_results['labels'].shape[:2]
+        return 0, 0, height, width
+    return tuple(int(value) for value in bbox)
+
+def _hash_array(array: np.ndarray) -> str:
+    """Hash the shape, dtype and contents of an array."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.shape}{array.dtype}".encode())
+    digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+def compute_analysis_key(
+    image: np.ndarray,
+    mask: np.ndarray,
+    params: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    Build the analysis cache key from the image hash, the mask hash and the
+    analysis parameters. Any change to one of them yields a different key.
+    """
+    params = ANALYSIS_PARAMS if params is None else params
+    params_json = json.dumps(params, sort_keys=True)
+    return f"{_hash_array(image)}-{_hash_array(mask)}-{hashlib.blake2b(params_json.encode(), digest_size=8).hexdigest()}"
+
+def get_or_create_analysis(
+    original: np.ndarray,
+    mask: np.ndarray,
+    base_dir: str,
+    analysis_filename: str,
+    params: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Return the analysis for an image and its prepared binary mask.
+    The stored analysis is reused when its cache key matches; otherwise the
+    car is re-analyzed and the stored entry is replaced. Only the mask's
+    bounding box is analyzed: the label, brightness and valid maps are
+    crop-sized and 'bbox' records where the crop sits in the frame.
+    """
+    params = ANALYSIS_PARAMS if params is None else params
+    with span('analysis.cache_key'):
+        cache_key = compute_analysis_key(original, mask, params)
+
+    with span('analysis.load'):
+        analysis_results = load_analysis(base_dir, analysis_filename)
+    if analysis_results is not None and analysis_results.get('cache_key') == cache_key:
+        return analysis_results
+
+    y0, x0, y1, x1 = bbox = mask_bbox(mask)
+    # Same pixels as analyze_car on the masked crop, read straight from the original
+    car_region = original[y0:y1, x0:x1]
+    valid_mask = (mask[y0:y1, x0:x1] > 0) & _nonblack(car_region)
+    analysis_results = analyze_car_pixels(car_region, valid_mask, **params)
+    analysis_results['bbox'] = bbox
+    analysis_results['cache_key'] = cache_key
+    # Hand back the stored (compact) arrays so fresh and cached analyses
+    # render identically, e.g. a preview and the later full-resolution export
+    with span('analysis.save'):
+        saved = save_analysis(analysis_results, base_dir, analysis_filename)
+    if saved:
+        return load_analysis(base_dir, analysis_filename) or analysis_results
+    return analysis_results
+
+def _pixels_to_lab(pixels_bgr: np.ndarray, to_lab: int = cv2.COLOR_BGR2LAB) -> np.ndarray:
+    """LAB values of an (n, 3) array of BGR (or, with to_lab=cv2.COLOR_RGB2LAB, RGB) pixels."""
+    if len(pixels_bgr) == 0:
+        return np.empty((0, 3), dtype=np.uint8)
+    return cv2.cvtColor(pixels_bgr.reshape(-1, 1, 3), to_lab).reshape(-1, 3)
+
+def update_analysis_for_mask(
+    original: np.ndarray,
+    mask: np.ndarray,
+    analysis_results: Dict[str, Any],
+    max_drift: float = MAX_MASK_DRIFT
+) -> Optional[Dict[str, Any]]:
+    """
+    Update an analysis for an edited mask without re-clustering.
+    Newly masked pixels are assigned to the nearest existing cluster center
+    and unmasked pixels are dropped; percentages, the dominant cluster and
+    the brightness stats are updated from the changed pixels only. Returns a
+    new analysis (the given one, possibly memory-mapped, is not modified), or
+    None once the pixels changed since the last clustering exceed max_drift
+    of the clustered car and the car should be re-analyzed.
+    """
+    old_y0, old_x0, old_y1, old_x1 = analysis_bbox(analysis_results)
+    new_y0, new_x0, new_y1, new_x1 = mask_bbox(mask)
+    # Work in the union of the old and new crops, then trim to the new one
+    y0, x0 = min(old_y0, new_y0), min(old_x0, new_x0)
+    y1, x1 = max(old_y1, new_y1), max(old_x1, new_x1)
+    old_region = np.s_[old_y0 - y0:old_y1 - y0, old_x0 - x0:old_x1 - x0]
+
+    labels = np.zeros((y1 - y0, x1 - x0), dtype=analysis_results['labels'].dtype)
+    relative_brightness = np.zeros(labels.shape, dtype=np.float32)
+    old_valid = np.zeros(labels.shape, dtype=bool)
+    labels[old_region] = analysis_results['labels']
+    relative_brightness[old_region] = analysis_results['relative_brightness']
+    old_valid[old_region] = analysis_results['valid_mask']
+    lit_pixels = int(np.count_nonzero(old_valid & (relative_brightness > 0)))
+
+    region = original[y0:y1, x0:x1]
+    new_valid = (mask[y0:y1, x0:x1] > 0) & np.any(region > 0, axis=2)
+    added = new_valid & ~old_valid
+    removed = old_valid & ~new_valid
+
+    old_pixels = int(np.count_nonzero(old_valid))
+    reference_pixels = analysis_results.get('reference_pixels', old_pixels)
+    drift_pixels = analysis_results.get('drift_pixels', 0) + int(np.count_nonzero(added | removed))
+    if not new_valid.any() or drift_pixels > max_drift * reference_pixels:
+        return None
+
+    centers_lab = analysis_results['centers_lab']
+    centers_hsv = analysis_results['centers_hsv']
+    added_lab = _pixels_to_lab(region[added])
+    labels[added] = assign_to_centers(added_lab, centers_lab)
+    labels[removed] = 0
+
+    counts = np.bincount(labels[new_valid], minlength=len(centers_lab))
+    percentages = counts / counts.sum() * 100
+    old_dominant = int(analysis_results['dominant_idx'])
+    dominant_idx = np.argmax(percentages)
+
+    # Relative brightness is relative to the dominant cluster's lightness
+    old_base = centers_lab[old_dominant][0]
+    base_brightness = centers_lab[dominant_idx][0]
+    if dominant_idx != old_dominant:
+        relative_brightness *= np.float32(old_base / base_brightness)
+    relative_brightness[removed] = 0
+    relative_brightness[added] = added_lab[:, 0] / base_brightness
+
+    # Brightness stats cover the masked pixels of nonzero lightness; update
+    # their running sums with the added and removed pixels
+    stats = analysis_results['brightness_stats']
+    total = stats['mean'] * lit_pixels
+    total_sq = (stats['std'] ** 2 + stats['mean'] ** 2) * lit_pixels
+    removed_l = _pixels_to_lab(region[removed])[:, 0].astype(float)
+    added_l = added_lab[:, 0].astype(float)
+    removed_l, added_l = removed_l[removed_l > 0], added_l[added_l > 0]
+    lit_pixels += len(added_l) - len(removed_l)
+    total += added_l.sum() - removed_l.sum()
+    total_sq += np.square(added_l).sum() - np.square(removed_l).sum()
+    brightness_mean = total / lit_pixels
+    brightness_std = np.sqrt(max(total_sq / lit_pixels - brightness_mean ** 2, 0.0))
+    dark_measure = centers_hsv[dominant_idx][2]
+
+    crop = np.s_[new_y0 - y0:new_y1 - y0, new_x0 - x0:new_x1 - x0]
+    updated = dict(analysis_results)
+    updated.update({
+        'labels': labels[crop],
+        'percentages': percentages,
+        'dominant_idx': dominant_idx,
+        'relative_brightness': relative_brightness[crop],
+        'brightness_stats': {
+            'mean': brightness_mean,
+            'std': brightness_std,
+            'is_dark_car': dark_measure < 40,
+            'is_bright_car': dark_measure > 160,
+        },
+        'valid_mask': new_valid[crop],
+        'bbox': (new_y0, new_x0, new_y1, new_x1),
+        'reference_pixels': reference_pixels,
+        'drift_pixels': drift_pixels,
+    })
+    return updated
+
+def update_analysis(
+    original: np.ndarray,
+    mask: np.ndarray,
+    base_dir: str,
+    analysis_filename: str,
+    params: Optional[Dict[str, Any]] = None,
+    max_drift: float = MAX_MASK_DRIFT,
+    base_filename: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Return the analysis for an image and its edited binary mask.
+    When the stored analysis is of the same image and parameters but another
+    mask, it is updated incrementally (see update_analysis_for_mask) and
+    stored under the new mask's cache key, so get_or_create_analysis reuses
+    it; otherwise, or once the drift exceeds max_drift, this falls back to a
+    full analysis. The stored analysis is read from analysis_filename, or
+    from base_filename (e.g. the unedited mask's analysis, which is never
+    written) when analysis_filename has none yet.
+    """
+    params = ANALYSIS_PARAMS if params is None else params
+    cache_key = compute_analysis_key(original, mask, params)
+    with span('analysis.load'):
+        analysis_results = load_analysis(base_dir, analysis_filename)
+        if analysis_results is None and base_filename is not None:
+            analysis_results = load_analysis(base_dir, base_filename)
+    if analysis_results is not None and analysis_results.get('cache_key') == cache_key:
+        return analysis_results
+
+    # Keys are <image hash>-<mask hash>-<params hash>
+    updated = None
+    if analysis_results is not None and \
+            cache_key.split('-')[::2] == (analysis_results.get('cache_key') or '').split('-')[::2]:
+        with span('analysis.incremental'):
+            updated = update_analysis_for_mask(original, mask, analysis_results, max_drift)
+    # The stored arrays are memory-mapped and analysis_filename is replaced
+    # below, which fails on Windows while a mapping of it is open
+    analysis_results = None
+    if updated is None:
+        return get_or_create_analysis(original, mask, base_dir, analysis_filename, params)
+
+    updated['cache_key'] = cache_key
+    with span('analysis.save'):
+        saved = save_analysis(updated, base_dir, analysis_filename)
+    if saved:
+        return load_analysis(base_dir, analysis_filename) or updated
+    return updated
+
+def evaluate_analysis_backends(
+    masked_car_rgb: np.ndarray,
+    backends: Optional[list] = None,
+    k: int = 200
+) -> Dict[str, Dict[str, float]]:
+    """
+    Run analyze_car with each backend and score it against the exact 'kmeans' path.
+    For every backend returns the runtime, the mean delta E between pixels and
+    their cluster center, that error relative to the exact path, and the delta E
+    between its dominant color and the exact dominant color.
+    """
+    backends = backends or ['kmeans', 'subsample', 'minibatch', 'histogram']
+    if 'kmeans' not in backends:
+        backends = ['kmeans'] + list(backends)
+
+    valid = _nonblack(masked_car_rgb)
+    pixels_lab = _pixels_to_lab(masked_car_rgb[valid], cv2.COLOR_RGB2LAB)
+    lab_scale = np.array([100.0 / 255.0, 1.0, 1.0])
+
+    report = {}
+    for name in backends:
+        start = time.perf_counter()
+        analysis = analyze_car(masked_car_rgb, k=k, backend=name)
+        elapsed = time.perf_counter() - start
+
+        report[name] = {
+            'seconds': elapsed,
+            'mean_delta_e': quantization_error(
+                pixels_lab, analysis['labels'][valid], analysis['centers_lab']
+            ),
+            'dominant_lab': analysis['centers_lab'][analysis['dominant_idx']],
+        }
+
+    exact_error = max(report['kmeans']['mean_delta_e'], 1e-6)
+    exact_dominant = report['kmeans']['dominant_lab']
+    for entry in report.values():
+        entry['relative_error'] = entry['mean_delta_e'] / exact_error
+        entry['dominant_delta_e'] = float(np.linalg.norm(
+            (entry.pop('dominant_lab') - exact_dominant) * lab_scale
+        ))
+
+    return report
+
+def compute_palette(
+    target_color_rgb: np.ndarray,
+    analysis_results: Dict[str, Any]
+) -> Tuple[np.ndarray, float]:
+    """
+    Compute the recolored palette for every cluster, with special handling for
+    extreme colors. Returns the new cluster colors (k x 3, RGB uint8) and the
+    exponent applied to the relative brightness map.
+    """
+    target_color_rgb = np.asarray(target_color_rgb)
+
+    # Convert target color to HSV
     target_color_bgr = target_color_rgb[::-1].reshape(1, 1, 3).astype(np.uint8)
-    target_color_lab = cv2.cvtColor(target_color_bgr, cv2.COLOR_BGR2LAB)[0, 0]
-    target_color_hsv = cv2.cvtColor(target_color_bgr, cv2.COLOR_BGR2HSV)[0, 0]
+    target_color_hsv = cv2.cvtColor(target_color_bgr, cv2.COLOR_BGR2HSV)[0, 0].astype(float)
+    target_hue, target_saturation, target_value = target_color_hsv
 
-    # Get dominant color information
-    dominant_idx = analysis_results['dominant_idx']
-    dominant_color_hsv = analysis_results['centers_hsv'][dominant_idx]
-    
     # Determine target color characteristics
     is_white = np.all(target_color_rgb >= 250)
     is_black = np.all(target_color_rgb <= 5)
     is_dark_car = analysis_results['brightness_stats']['is_dark_car']
-    
+
     # Calculate target brightness (grayscale)
     target_brightness = np.mean(target_color_rgb)
-    is_extreme_color = target_brightness > 240 or target_brightness < 30
 
-    # Create new colors using HSV
-    centers_hsv = analysis_results['centers_hsv'].copy()
+    # Work on all cluster centers at once in float, then truncate to uint8
+    centers_hsv = analysis_results['centers_hsv'].astype(float)
+    hue, saturation, value = centers_hsv[:, 0], centers_hsv[:, 1], centers_hsv[:, 2]
+    new_hsv = centers_hsv.copy()
 
     if is_white:
-        # Special handling for white target
-        for i in range(len(centers_hsv)):
-            value_ratio = centers_hsv[i, 2] / 255.0
-            centers_hsv[i, 0] = 0  # Hue doesn't matter
-            centers_hsv[i, 1] = 0  # No saturation for white
-            centers_hsv[i, 2] = np.clip(170 + (value_ratio * 10), 0, 255)  # High value with variation
-    
+        # No hue or saturation for white, high value with variation
+        new_hsv[:, 0] = 0
+        new_hsv[:, 1] = 0
+        new_hsv[:, 2] = np.clip(170 + (value / 255.0) * 10, 0, 255)
+
     elif is_black:
-        # Special handling for black target
-        for i in range(len(centers_hsv)):
-            value_ratio = centers_hsv[i, 2] / 255.0
-            centers_hsv[i, 0] = 0  # Hue doesn't matter
-            centers_hsv[i, 1] = 0  # No saturation for black
-            centers_hsv[i, 2] = np.clip(value_ratio * 50, 0, 255)  # Keep low value with variation
-    
-    elif is_dark_car:
-        dark_value_min, dark_value_max = 0, 100  # Original range for dark car value
-        target_value_min, target_value_max = 50, target_color_hsv[2]  # Target range for normalization
-        
-        for i in range(len(centers_hsv)):
-            # Normalize Value (V) - Map from dark_value range to target_value range
-            current_value = centers_hsv[i, 2]
-            normalized_value = ((current_value - dark_value_min) / (dark_value_max - dark_value_min + 1e-6)) * \
-                            (target_value_max - target_value_min) + target_value_min
-            centers_hsv[i, 2] = np.clip(normalized_value, 0, 255)
-    
-            # Weighted Saturation Adjustment - Blend original and target saturation
-            original_saturation = centers_hsv[i, 1]
-            target_saturation = target_color_hsv[1]
-            blend_ratio = 0.6 if current_value < 50 else 0.3
-            adjusted_saturation = (1 - blend_ratio) * original_saturation + blend_ratio * target_saturation
-            centers_hsv[i, 1] = np.clip(adjusted_saturation, 100, 255)
-    
-            # Optionally adjust hue to match the target
-            centers_hsv[i, 0] = target_color_hsv[0]
+        # No hue or saturation for black, low value with variation
+        new_hsv[:, 0] = 0
+        new_hsv[:, 1] = 0
+        new_hsv[:, 2] = np.clip((value / 255.0) * 50, 0, 255)
 
     else:
-        print("Normal car detected")
-        for i in range(len(centers_hsv)):
-
-            # hue_diff = float(target_color_hsv[0]) - centers_hsv[i,0]
-            # if abs(hue_diff) > 90:  # If shift is too large, go the other way
-            #     if hue_diff > 0:
-            #         hue_diff -= 180
-            #     else:
-            #         hue_diff += 180
-            dark_value_min, dark_value_max = 0, 100  # Original range for dark car value
-            target_value_min, target_value_max = 50, target_color_hsv[2]  # Target range for normalization
-            centers_hsv[i, 0] = target_color_hsv[0]
-            current_value = centers_hsv[i, 2]
-            # Adjust saturation while preserving relative differences
-            original_saturation = centers_hsv[i, 1]
-            target_saturation = target_color_hsv[1]
-            blend_ratio = 0.6 if current_value < 50 else 0.3
-            adjusted_saturation = (1 - blend_ratio) * original_saturation + blend_ratio * target_saturation
-            centers_hsv[i, 1] = np.clip(adjusted_saturation, 110, 255)
-    # Convert to RGB and create remapped image
-    new_colors_bgr = cv2.cvtColor(centers_hsv.reshape(-1, 1, 3).astype(np.uint8), 
-                                 cv2.COLOR_HSV2BGR).reshape(-1, 3)
-    new_colors_rgb = new_colors_bgr[:, ::-1]
-
-    remapped = np.zeros_like(masked_car_rgb)
-    labels = analysis_results['labels']
-
-    # Apply colors
-    for i in range(len(new_colors_rgb)):
-        color_mask = labels == i
-        remapped[color_mask] = new_colors_rgb[i]
-    # Apply brightness modulation
-    relative_brightness = analysis_results['relative_brightness']
-    brightness_factor = np.stack([relative_brightness] * 3, axis=2)
-    
-    if is_extreme_color:
-        # For extreme colors, adjust brightness factor power
-        if target_brightness > 240:  # Very bright
-            brightness_factor = brightness_factor ** 0.7
-        else:  # Very dark
-            brightness_factor = brightness_factor ** 1.2
+        # Blend original and target saturation, more strongly for dark clusters
+        blend_ratio = np.where(value < 50, 0.6, 0.3)
+        adjusted_saturation = (1 - blend_ratio) * saturation + blend_ratio * target_saturation
+        new_hsv[:, 0] = target_hue
+
+        if is_dark_car:
+            # Map value from the dark car range (0-100) to the range [50, target value]
+            dark_value_min, dark_value_max = 0, 100
+            target_value_min, target_value_max = 50, target_value
+            normalized_value = ((value - dark_value_min) / (dark_value_max - dark_value_min + 1e-6)) * \
+                (target_value_max - target_value_min) + target_value_min
+            new_hsv[:, 2] = np.clip(normalized_value, 0, 255)
+            new_hsv[:, 1] = np.clip(adjusted_saturation, 100, 255)
+        else:
+            new_hsv[:, 1] = np.clip(adjusted_saturation, 110, 255)
+
+    # Convert to RGB
+    new_colors_bgr = cv2.cvtColor(new_hsv.astype(np.uint8).reshape(-1, 1, 3),
+                                  cv2.COLOR_HSV2BGR).reshape(-1, 3)
+    new_colors_rgb = np.ascontiguousarray(new_colors_bgr[:, ::-1])
+
+    # Brightness exponent: soften for very bright targets, deepen for very dark
+    # ones, and flatten strongly for dark cars
+    brightness_exponent = 1.0
+    if target_brightness > 240:
+        brightness_exponent *= 0.7
+    elif target_brightness < 30:
+        brightness_exponent *= 1.2
     if is_dark_car:
-        brightness_factor = brightness_factor ** 0.1
-    remapped = np.clip(remapped * brightness_factor, 0, 255).astype(np.uint8)
-    remapped[~analysis_results['valid_mask']] = 0
+        brightness_exponent *= 0.1
+
+    return new_colors_rgb, brightness_exponent
 
+def apply_palette(
+    labels: np.ndarray,
+    relative_brightness: np.ndarray,
+    valid_mask: np.ndarray,
+    new_colors_rgb: np.ndarray,
+    brightness_exponent: float
+) -> np.ndarray:
+    """
+    Paint every pixel with its cluster's new color through a single lookup-table
+    gather, then modulate by the relative brightness in float32, in place.
+    """
+    remapped = new_colors_rgb[labels]
+
+    brightness_factor = relative_brightness.astype(np.float32)
+    if brightness_exponent != 1.0:
+        np.power(brightness_factor, np.float32(brightness_exponent), out=brightness_factor)
+
+    modulated = remapped.astype(np.float32)
+    modulated *= brightness_factor[..., None]
+    np.clip(modulated, 0, 255, out=modulated)
+
+    remapped = modulated.astype(np.uint8)
+    remapped[~valid_mask] = 0
     return remapped
+
+def remap_colors(masked_car_rgb, target_color_rgb, analysis_results):
+    """
+    Remap colors using hybrid approach with special handling for extreme colors.
+    Cost scales with the pixel count only, not with pixels x clusters. Output
+    matches the original per-cluster loop to within 1 intensity level per
+    channel (float32 instead of float64 brightness modulation).
+    """
+    new_colors_rgb, brightness_exponent = compute_palette(target_color_rgb, analysis_results)
+    return apply_palette(
+        analysis_results['labels'],
+        analysis_results['relative_brightness'],
+        analysis_results['valid_mask'],
+        new_colors_rgb,
+        brightness_exponent
+    )
+
+def _paste_recolored(
+    result: np.ndarray,
+    original: np.ndarray,
+    mask: np.ndarray,
+    remapped_rgb: np.ndarray,
+    bbox: Tuple[int, int, int, int]
+):
+    """Write the recolored (RGB) bbox region over its background into result (BGR)."""
+    y0, x0, y1, x1 = bbox
+    if remapped_rgb.size == 0:
+        return
+    region = original[y0:y1, x0:x1]
+    background = cv2.bitwise_and(region, region, mask=cv2.bitwise_not(mask[y0:y1, x0:x1]))
+    result[y0:y1, x0:x1] = cv2.add(background, cv2.cvtColor(remapped_rgb, cv2.COLOR_RGB2BGR))
+
+def composite_recolor(
+    original: np.ndarray,
+    mask: np.ndarray,
+    remapped_rgb: np.ndarray,
+    bbox: Optional[Tuple[int, int, int, int]] = None
+) -> np.ndarray:
+    """
+    Paste the recolored car (RGB) over the background of the original image (BGR).
+    remapped_rgb covers the (y0, x0, y1, x1) bbox of the frame, by default the
+    whole frame; everything outside it is copied from the original unchanged.
+    """
+    result = original.copy()
+    _paste_recolored(result, original, mask, remapped_rgb, bbox or (0, 0) + original.shape[:2])
+    return result
+
+def render_recolored(
+    original: np.ndarray,
+    mask: np.ndarray,
+    target_color_rgb: np.ndarray,
+    analysis_results: Dict[str, Any]
+) -> np.ndarray:
+    """Recolor the car in an image (BGR) from its analysis and composite it over the background."""
+    new_colors_rgb, brightness_exponent = compute_palette(target_color_rgb, analysis_results)
+    remapped = apply_palette(
+        analysis_results['labels'],
+        analysis_results['relative_brightness'],
+        analysis_results['valid_mask'],
+        new_colors_rgb,
+        brightness_exponent
+    )
+    return composite_recolor(original, mask, remapped, analysis_bbox(analysis_results))
+
+def render_recolored_tiled(
+    original: np.ndarray,
+    mask: np.ndarray,
+    target_color_rgb: np.ndarray,
+    analysis_results: Dict[str, Any],
+    tile_rows: int = TILE_ROWS,
+    out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    render_recolored in bands of tile_rows rows of the analysis crop.
+    The palette is computed once for the whole car, so the output is
+    identical; the per-pixel intermediates (palette gather, float32
+    brightness product, background) only ever hold one band. The result is
+    written into out, which may be original itself to recolor in place.
+    """
+    new_colors_rgb, brightness_exponent = compute_palette(target_color_rgb, analysis_results)
+
+    if out is None:
+        out = original.copy()
+    elif out is not original:
+        np.copyto(out, original)
+
+    y0, x0, y1, x1 = analysis_bbox(analysis_results)
+    for top in range(0, y1 - y0, tile_rows):
+        bottom = min(top + tile_rows, y1 - y0)
+        remapped = apply_palette(
+            analysis_results['labels'][top:bottom],
+            analysis_results['relative_brightness'][top:bottom],
+            analysis_results['valid_mask'][top:bottom],
+            new_colors_rgb,
+            brightness_exponent
+        )
+        _paste_recolored(out, original, mask, remapped, (y0 + top, x0, y0 + bottom, x1))
+    return out
+
+def _nearest_indices(size: int, new_size: int) -> np.ndarray:
+    """Source indices of a nearest-neighbour resize along one axis."""
+    return np.minimum(((np.arange(new_size) + 0.5) * size / new_size).astype(np.intp), size - 1)
+
+def build_preview_proxy(
+    original: np.ndarray,
+    mask: np.ndarray,
+    analysis_results: Dict[str, Any],
+    max_side: int = PREVIEW_MAX_SIDE
+) -> Dict[str, Any]:
+    """
+    Downscale an image, its mask and its analysis maps for interactive previews.
+    Labels, brightness and masks are resampled nearest-neighbour so every proxy
+    pixel keeps the cluster of a real pixel; the cluster centers and brightness
+    stats are shared with the full-resolution analysis, so the palette computed
+    for a preview is exactly the one used for the full render. The proxy maps
+    cover the preview pixels that sample the analysis crop.
+    """
+    height, width = original.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    new_height, new_width = max(1, round(height * scale)), max(1, round(width * scale))
+
+    rows = _nearest_indices(height, new_height)
+    cols = _nearest_indices(width, new_width)
+
+    # Preview rows/columns whose source pixel falls inside the analysis crop
+    y0, x0, y1, x1 = analysis_bbox(analysis_results)
+    top, bottom = np.searchsorted(rows, [y0, y1])
+    left, right = np.searchsorted(cols, [x0, x1])
+    crop_rows = (rows[top:bottom] - y0)[:, None]
+    crop_cols = (cols[left:right] - x0)[None, :]
+
+    return {
+        'scale': scale,
+        'original': cv2.resize(original, (new_width, new_height), interpolation=cv2.INTER_AREA),
+        'mask': np.ascontiguousarray(mask[rows[:, None], cols[None, :]]),
+        'bbox': (int(top), int(left), int(bottom), int(right)),
+        'labels': np.ascontiguousarray(analysis_results['labels'][crop_rows, crop_cols]),
+        'relative_brightness': np.ascontiguousarray(
+            analysis_results['relative_brightness'][crop_rows, crop_cols]
+        ),
+        'valid_mask': np.ascontiguousarray(analysis_results['valid_mask'][crop_rows, crop_cols]),
+        'centers_hsv': analysis_results['centers_hsv'],
+        'brightness_stats': analysis_results['brightness_stats'],
+        'cache_key': analysis_results.get('cache_key'),
+    }
+
+def render_preview(proxy: Dict[str, Any], target_color: Tuple[int, int, int]) -> np.ndarray:
+    """Recolor a preview proxy in memory. Returns the composited image as RGB."""
+    if not verify_color_format(target_color):
+        raise CarRecolorError("Invalid color format. Must be BGR tuple with values 0-255")
+
+    with span('preview'):
+        result = render_recolored(proxy['original'], proxy['mask'], np.array(target_color), proxy)
+    return cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
+
+def compute_palettes(
+    target_colors_rgb: np.ndarray,
+    analysis_results: Dict[str, Any]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the recolored palettes of N target colors at once.
+    Returns an (N, k, 3) RGB uint8 table and the N brightness exponents. The
+    per-target work is only k clusters; the per-pixel work is shared by
+    apply_palettes.
+    """
+    palettes = [compute_palette(color, analysis_results) for color in np.asarray(target_colors_rgb)]
+    return (
+        np.stack([colors for colors, _ in palettes]),
+        np.array([exponent for _, exponent in palettes], dtype=np.float32)
+    )
+
+def apply_palettes(
+    labels: np.ndarray,
+    relative_brightness: np.ndarray,
+    valid_mask: np.ndarray,
+    palettes: np.ndarray,
+    brightness_exponents: np.ndarray
+) -> np.ndarray:
+    """
+    Paint N variants from one label map. The valid pixels, their labels and
+    the brightness factor of each distinct exponent are extracted once and
+    shared by all palettes. Returns an (N, H, W, 3) uint8 stack in the
+    channel order of the palettes, equal to N apply_palette calls.
+    """
+    valid_idx = np.flatnonzero(valid_mask)
+    valid_labels = labels.reshape(-1)[valid_idx]
+    brightness = relative_brightness.reshape(-1)[valid_idx].astype(np.float32)
+
+    factors = {}
+    for exponent in np.unique(brightness_exponents):
+        if exponent == 1.0:
+            factors[exponent] = brightness[:, None]
+        else:
+            factors[exponent] = np.power(brightness, np.float32(exponent))[:, None]
+
+    outputs = np.zeros((len(palettes),) + tuple(valid_mask.shape) + (3,), dtype=np.uint8)
+    for output, palette, exponent in zip(outputs, palettes, brightness_exponents):
+        modulated = palette[valid_labels].astype(np.float32)
+        modulated *= factors[exponent]
+        np.clip(modulated, 0, 255, out=modulated)
+        output.reshape(-1, 3)[valid_idx] = modulated
+
+    return outputs
+
+def remap_colors_many(masked_car_rgb, target_colors_rgb, analysis_results):
+    """Remap colors into N target colors at once; returns an (N, h, w, 3) RGB stack over the analysis crop."""
+    palettes, brightness_exponents = compute_palettes(target_colors_rgb, analysis_results)
+    return apply_palettes(
+        analysis_results['labels'],
+        analysis_results['relative_brightness'],
+        analysis_results['valid_mask'],
+        palettes,
+        brightness_exponents
+    )
+
+def render_recolored_many(
+    original: np.ndarray,
+    mask: np.ndarray,
+    target_colors_rgb: np.ndarray,
+    analysis_results: Dict[str, Any]
+) -> np.ndarray:
+    """
+    Recolor the car in an image (BGR) into N target colors; returns an (N, H, W, 3) BGR stack.
+    Only the analysis crop is painted; the rest of each frame is the original.
+    """
+    palettes, brightness_exponents = compute_palettes(target_colors_rgb, analysis_results)
+    # Paint straight into BGR by reversing the palettes instead of converting N images
+    outputs = apply_palettes(
+        analysis_results['labels'],
+        analysis_results['relative_brightness'],
+        analysis_results['valid_mask'],
+        np.ascontiguousarray(palettes[:, :, ::-1]),
+        brightness_exponents
+    )
+    results = np.repeat(original[None], len(outputs), axis=0)
+    if outputs.size == 0:
+        return results
+    y0, x0, y1, x1 = analysis_bbox(analysis_results)
+    region = original[y0:y1, x0:x1]
+    background = cv2.bitwise_and(region, region, mask=cv2.bitwise_not(mask[y0:y1, x0:x1]))
+    for result, output in zip(results, outputs):
+        cv2.add(background, output, dst=output)
+        result[y0:y1, x0:x1] = output
+    return results
+
+def render_previews(proxy: Dict[str, Any], target_colors: List[Tuple[int, int, int]]) -> np.ndarray:
+    """Recolor a preview proxy into several colors in memory. Returns an (N, h, w, 3) RGB stack."""
+    for color in target_colors:
+        if not verify_color_format(color):
+            raise CarRecolorError("Invalid color format. Must be BGR tuple with values 0-255")
+
+    with span('preview_palette'):
+        outputs = render_recolored_many(proxy['original'], proxy['mask'], np.array(target_colors), proxy)
+    for output in outputs:
+        cv2.cvtColor(output, cv2.COLOR_BGR2RGB, dst=output)
+    return outputs
+
+def get_masked_car(original: np.ndarray, mask: np.ndarray, analysis_results: Dict[str, Any]) -> np.ndarray:
+    """Masked car (BGR), cropped to the analysis bbox."""
+    y0, x0, y1, x1 = analysis_bbox(analysis_results)
+    car_region = original[y0:y1, x0:x1]
+    return cv2.bitwise_and(car_region, car_region, mask=mask[y0:y1, x0:x1])
+
+def recolor_prepared(
+    original: np.ndarray,
+    mask: np.ndarray,
+    analysis_results: Dict[str, Any],
+    target_color: Tuple[int, int, int],
+    masked_car: Optional[np.ndarray] = None,
+    tile_rows: Optional[int] = None,
+    in_place: bool = False
+) -> np.ndarray:
+    """
+    Recolor stage of recolor_car on an already decoded image, its prepared
+    mask and its analysis; returns the BGR result. masked_car (see
+    get_masked_car) is reused when given. With tile_rows the car is
+    recolored in bands, into original itself when in_place is set.
+    """
+    target_rgb = np.array(target_color)  # Convert BGR to RGB
+    if tile_rows:
+        with span('recolor_tiled'):
+            return render_recolored_tiled(
+                original, mask, target_rgb, analysis_results, tile_rows,
+                out=original if in_place else None
+            )
+
+    with span('remap'):
+        if masked_car is None:
+            masked_car = get_masked_car(original, mask, analysis_results)
+        remapped = remap_colors(
+            masked_car,
+            target_rgb,
+            analysis_results
+        )
+    # Convert back to BGR and create final image
+    with span('composite'):
+        return composite_recolor(original, mask, remapped, analysis_bbox(analysis_results))
+
 def verify_color_format(color: tuple) -> bool:
     """Verify if the color format is valid (BGR tuple with values between 0-255)."""
     if not isinstance(color, tuple) or len(color) != 3:
@@ -298,9 +1332,54 @@ def recolor_car(
     api_url: str,
     output_path: Optional[str] = None,
     preserve_luminance: bool = True,
-    reflection_threshold: int = 200
+    reflection_threshold: int = 200,
+    analysis_params: Optional[Dict[str, Any]] = None,
+    mask_client: Optional[MaskClient] = None,
+    mask_store: Optional[MaskStore] = None,
+    tile_rows: Optional[int] = None,
+    unpaintable_parts: Optional[List[str]] = None,
+    output_format: Optional[OutputFormat] = None,
+    output_writer: Optional[OutputWriter] = None
+) -> Dict[str, Union[bool, str]]:
+    """
+    Main function to recolor a car image using the mask generation API.
+    The result dictionary carries the per-stage 'timings' of the call
+    (empty when instrumentation is disabled). With tile_rows the car is
+    recolored in place in bands of that many rows (see
+    render_recolored_tiled), bounding the recolor's extra memory by the
+    band size instead of the car size; the output is identical.
+    unpaintable_parts (names from car_parts.category_mapping_parts) overrides
+    which parts are left unpainted; the mask is then built locally from the
+    image's cached part map, which requires a mask_store.
+    With output_format the result is encoded in memory, with display and
+    thumbnail renditions, and returned as an EncodedOutput under 'output';
+    the file (given that format's extension by default) is then written by
+    output_writer in the background when one is given.
+    """
+    with collect() as timings:
+        result = _recolor_car(
+            image_uuid, target_color, base_dir, api_url, output_path,
+            analysis_params, mask_client, mask_store, tile_rows, unpaintable_parts,
+            output_format, output_writer
+        )
+    result['timings'] = timings
+    return result
+
+def _recolor_car(
+    image_uuid: str,
+    target_color: Tuple[int, int, int],
+    base_dir: str,
+    api_url: str,
+    output_path: Optional[str],
+    analysis_params: Optional[Dict[str, Any]],
+    mask_client: Optional[MaskClient],
+    mask_store: Optional[MaskStore],
+    tile_rows: Optional[int],
+    unpaintable_parts: Optional[List[str]],
+    output_format: Optional[OutputFormat],
+    output_writer: Optional[OutputWriter]
 ) -> Dict[str, Union[bool, str]]:
-    """Main function to recolor a car image using the mask generation API."""
+    """Body of recolor_car."""
     try:
         if not verify_color_format(target_color):
             raise CarRecolorError("Invalid color format. Must be BGR tuple with values 0-255")
@@ -310,54 +1389,78 @@ def recolor_car(
         os.makedirs(processed_dir, exist_ok=True)
         
         new_image_path = os.path.join(processed_dir, image_uuid)
-        
-        # Check for existing mask or generate new one
-        mask_filename = get_mask_filename(image_uuid)
-        mask = check_existing_mask(base_dir, mask_filename)
-        
-        if mask is None:
-            try:
-                mask = get_mask_from_api(new_image_path, api_url)
-                save_mask(mask, base_dir, mask_filename)
-            except Exception as e:
-                raise CarRecolorError(f"Failed to generate/save mask: {str(e)}")
-        
-        # Create masked car and perform analysis
-        original = cv2.imread(new_image_path)
+
+        with span('image_decode'):
+            original = cv2.imread(new_image_path)
         if original is None:
             raise CarRecolorError("Failed to load image")
-        
+
+        # Check for existing mask or generate new one
+        try:
+            mask, storage_name = load_or_fetch_mask(
+                image_uuid, new_image_path, original, base_dir, api_url, mask_client, mask_store
+            )
+        except Exception as e:
+            raise CarRecolorError(f"Failed to generate/save mask: {str(e)}")
+
+        if unpaintable_parts is not None:
+            if mask_store is None:
+                raise CarRecolorError("Choosing unpaintable parts requires a mask store")
+            part_map = load_or_fetch_part_map(
+                new_image_path, mask_store.resolve(image_uuid), api_url, mask_client, mask_store
+            )
+            with span('mask.parts'):
+                mask = build_paintable_mask(part_map, unpaintable_parts)
+
         # Ensure mask is proper size and binary
-        mask = cv2.resize(mask, (original.shape[1], original.shape[0]))
-        _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
-        
-        # Create masked car
-        masked_car = cv2.bitwise_and(original, original, mask=mask)
-        
-        # Perform and save analysis
-        analysis_filename = get_analysis_filename(image_uuid)
-        analysis_results = analyze_car(cv2.cvtColor(masked_car, cv2.COLOR_BGR2RGB))
-        save_analysis(analysis_results, base_dir, analysis_filename)
-        
-        # Perform recoloring
-        target_rgb = np.array(target_color)  # Convert BGR to RGB
-        remapped = remap_colors(
-            masked_car,
-            target_rgb,
-            analysis_results
+        with span('mask.prepare'):
+            mask = prepare_mask(mask, original.shape)
+
+        # Reuse the cached analysis, re-analyzing only if the image, mask or parameters
+        # changed; a part selection is a mask edit, so it updates the analysis incrementally
+        # into a file of its own mask, leaving the plain mask's analysis for later recolors
+        analysis_filename = get_analysis_filename(storage_name)
+        if unpaintable_parts is None:
+            analysis_results = get_or_create_analysis(
+                original, mask, base_dir, analysis_filename, analysis_params
+            )
+        else:
+            analysis_results = update_analysis(
+                original, mask, base_dir,
+                get_analysis_filename(f"{storage_name}_{_hash_array(mask)[:16]}"), analysis_params,
+                base_filename=analysis_filename
+            )
+
+        # Perform recoloring; the decoded original is not needed afterwards,
+        # so the tiled path may recolor it in place
+        result = recolor_prepared(
+            original, mask, analysis_results, target_color, tile_rows=tile_rows, in_place=True
         )
-        # Convert back to BGR and create final image
-        remapped_bgr = cv2.cvtColor(remapped, cv2.COLOR_RGB2BGR)
-        result = cv2.bitwise_and(original, original, mask=cv2.bitwise_not(mask))
-        result = cv2.add(result, remapped_bgr)
         
         # Save the result
         if output_path is None:
             output_filename = f"{image_uuid}"
+            if output_format is not None:
+                output_filename = os.path.splitext(image_uuid)[0] + output_format.extension
             output_path = os.path.join(base_dir, 'output', f"{output_filename}")
+
+        if output_format is not None:
+            encoded = encode_renditions(result, output_format)
+            if output_writer is not None:
+                output_writer.submit(output_path, encoded.full)
+            else:
+                with span('write'):
+                    write_bytes(output_path, encoded.full)
+            return {
+                'success': True,
+                'image_path': output_path,
+                'output': encoded,
+                'message': 'Image successfully recolored'
+            }
         
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        cv2.imwrite(output_path, result)
+        with span('write'):
+            cv2.imwrite(output_path, result)
         
         return {
             'success': True,
@@ -384,7 +1487,7 @@ if __name__ == "__main__":
     IMAGE_PATH ="0aab9769-7340-4afa-8974-9cb814762cbd.jpg"
     TARGET_COLOR = (255, 0, 255)  # Blue in BGR
     BASE_DIR = "images"  # Base directory for all processed files
-    API_URL = "https://512e-34-143-213-141.ngrok-free.app"
+    API_URL = os.environ.get("MASK_API_URL", "https://512e-34-143-213-141.ngrok-free.app")
     # Process the image
     result = recolor_car(
         image_uuid=IMAGE_PATH,